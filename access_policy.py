@@ -0,0 +1,153 @@
+# access_policy.py - Which topics need a login, kept in the centralized user database
+import os
+import sqlite3
+import threading
+import time
+
+from dynamic_db_handler import dynamic_db_handler
+
+# Wildcard for "every subject" / "every topic" rows, e.g. ('*', '*') is the site default
+ANY = '*'
+
+# Used when no policy row matches at all: content requires login unless marked free
+DEFAULT_REQUIRES_LOGIN = True
+
+ACCESS_POLICY_SCHEMA = {
+    'topic_access_policy': '''
+        CREATE TABLE IF NOT EXISTS topic_access_policy (
+            subject TEXT NOT NULL COLLATE NOCASE,
+            topic TEXT NOT NULL COLLATE NOCASE,
+            requires_login INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (subject, topic)
+        )
+    ''',
+    # Single row bumped by every policy write so other workers know to reload
+    'topic_access_policy_version': '''
+        CREATE TABLE IF NOT EXISTS topic_access_policy_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    '''
+}
+
+
+class TopicAccessPolicy:
+    """Versioned in-memory copy of topic_access_policy; request-time checks are dict lookups"""
+
+    def __init__(self, db_file, refresh_interval=None):
+        self.db_file = db_file
+        if refresh_interval is None:
+            refresh_interval = float(os.environ.get('ACCESS_POLICY_REFRESH', 5))
+        self.refresh_interval = refresh_interval
+        self._map = {}  # (subject.lower(), topic.lower()) -> requires_login
+        self.version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def initialize(self, qbank_files=()):
+        """Create the tables; on first run carry over topics marked free via qbank.is_premium"""
+        conn = dynamic_db_handler.get_connection(self.db_file, readonly=False)
+        try:
+            for create_sql in ACCESS_POLICY_SCHEMA.values():
+                conn.execute(create_sql)
+            first_run = conn.execute(
+                'SELECT version FROM topic_access_policy_version WHERE id = 1').fetchone() is None
+            conn.commit()
+        finally:
+            conn.close()
+
+        if first_run:
+            free_topics = self._legacy_free_topics(qbank_files)
+            self._write([(subject, topic, 0) for subject, topic in free_topics])
+            if free_topics:
+                print(f"✅ Imported {len(free_topics)} free topics from qbank.is_premium")
+        self.refresh(force=True)
+
+    def _legacy_free_topics(self, qbank_files):
+        free_topics = set()
+        for db_file in qbank_files:
+            try:
+                conn = dynamic_db_handler.get_connection(db_file)
+                rows = conn.execute('''
+                    SELECT subject, topic FROM qbank
+                    WHERE subject IS NOT NULL AND topic IS NOT NULL
+                    GROUP BY subject COLLATE NOCASE, topic COLLATE NOCASE
+                    HAVING MAX(is_premium) = 0
+                ''').fetchall()
+                conn.close()
+            except sqlite3.OperationalError:
+                # No is_premium column (e.g. the shipped 3rd_year.db): nothing to carry over
+                continue
+            free_topics.update((row['subject'], row['topic']) for row in rows)
+        return sorted(free_topics)
+
+    def _write(self, rows, replace=False):
+        """Upsert (subject, topic, requires_login) rows and bump the version in one transaction"""
+        conn = dynamic_db_handler.get_connection(self.db_file, readonly=False)
+        try:
+            if replace:
+                conn.execute('DELETE FROM topic_access_policy')
+            conn.executemany('''
+                INSERT INTO topic_access_policy (subject, topic, requires_login)
+                VALUES (?, ?, ?)
+                ON CONFLICT (subject, topic) DO UPDATE
+                    SET requires_login = excluded.requires_login, updated_at = CURRENT_TIMESTAMP
+            ''', rows)
+            conn.execute('''
+                INSERT INTO topic_access_policy_version (id, version) VALUES (1, 1)
+                ON CONFLICT (id) DO UPDATE SET version = version + 1
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+        self.refresh(force=True)
+
+    def refresh(self, force=False):
+        """Reload the map if the stored version moved; checked at most once per interval"""
+        if not force and time.monotonic() - self._checked_at < self.refresh_interval:
+            return
+        # One thread checks at a time; the others keep using the current map
+        if not self._lock.acquire(blocking=force):
+            return
+        try:
+            self._checked_at = time.monotonic()
+            conn = dynamic_db_handler.get_connection(self.db_file)
+            try:
+                row = conn.execute(
+                    'SELECT version FROM topic_access_policy_version WHERE id = 1').fetchone()
+                version = row['version'] if row else 0
+                if version == self.version and not force:
+                    return
+                rows = conn.execute(
+                    'SELECT subject, topic, requires_login FROM topic_access_policy').fetchall()
+            finally:
+                conn.close()
+            # Swap in the finished map in one assignment
+            self._map = {(row['subject'].lower(), row['topic'].lower()): bool(row['requires_login'])
+                         for row in rows}
+            self.version = version
+        except sqlite3.Error as e:
+            print(f"Error refreshing topic access policy: {e}")
+        finally:
+            self._lock.release()
+
+    def requires_login(self, subject, topic):
+        """Topic row, then subject default, then site default"""
+        self.refresh()
+        policy = self._map
+        subject, topic = subject.lower(), topic.lower()
+        for key in ((subject, topic), (subject, ANY), (ANY, ANY)):
+            if key in policy:
+                return policy[key]
+        return DEFAULT_REQUIRES_LOGIN
+
+    def set_topic(self, subject, topic, requires_login):
+        """Set one topic's policy"""
+        self._write([(subject, topic, int(requires_login))])
+
+    def replace_all(self, free_topics, default_requires_login=DEFAULT_REQUIRES_LOGIN):
+        """Replace every rule: a site default plus the given free (subject, topic) pairs"""
+        rows = [(ANY, ANY, int(default_requires_login))]
+        rows += [(subject, topic, 0) for subject, topic in free_topics]
+        self._write(rows, replace=True)
@@ -1,7 +1,8 @@
 # admin.py
 
 from flask import Blueprint, render_template, request, redirect, url_for, session, flash
-from werkzeug.security import check_password_hash
+from password_hashing import password_hasher, PasswordHashingBusy
+from rate_limiter import rate_limiter
 import sqlite3
 from functools import wraps
 
@@ -27,6 +28,8 @@ def admin_required(f):
 
 # Admin login route
 @admin_bp.route('/login', methods=['GET', 'POST'])
+@rate_limiter.limit('admin_login', methods=('POST',), template='admin_login.html',
+                    account_field='username')
 def admin_login():
     if request.method == 'POST':
         email = request.form.get('username', '').strip().lower()
@@ -36,7 +39,13 @@ def admin_login():
         user = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
         conn.close()
 
-        if user and check_password_hash(user['password'], password):
+        try:
+            valid = user is not None and password_hasher.check_user(user, password, get_user_db_connection)
+        except PasswordHashingBusy:
+            flash('Too many sign-ins right now. Please try again in a few seconds.', 'danger')
+            return render_template('admin_login.html'), 503
+
+        if valid:
             if user['user_type'] == 'admin':
                 session['user_id'] = user['id']
                 session['username'] = user['username']
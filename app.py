@@ -1,13 +1,20 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
 import datetime
 import json
 import os
+import re
+import html
 # Add this import at the top of app.py
 from mcq import register_mcq_routes
 from flask import Flask
 from test import test_bp   # Import the test blueprint (replace with your module name)
+from access_policy import TopicAccessPolicy
+from study_analytics import StudyActivityAggregator
+from user_shards import UserShardRouter
+from password_hashing import password_hasher, PasswordHashingBusy
+from rate_limiter import rate_limiter
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 
 app = Flask(__name__)
@@ -17,7 +24,7 @@ app.secret_key = 'your-secret-key'  # Required for sessions and flashes
 import os
 
 # PERSISTENT STORAGE PATHS
-DATA_DIR = '/var/data'
+DATA_DIR = os.environ.get('DATA_DIR', '/var/data')
 os.makedirs(DATA_DIR, exist_ok=True)
 
 USER_DB_FILE = os.path.join(DATA_DIR, 'admin_users.db')
@@ -32,9 +39,9 @@ TEST_DB_FILE = os.path.join(DATA_DIR, 'test.db')  # Your test database!
 
 # Try this import method first
 try:
-    from dynamic_db_handler import dynamic_db_handler, register_dynamic_db_routes, find_subject_database, get_all_qbank_subjects
+    from dynamic_db_handler import dynamic_db_handler, register_dynamic_db_routes, find_subject_database, get_all_qbank_subjects, QBANK_QUERIES, find_question_position
 except ImportError:
-    from dynamic_db_handler import DynamicDatabaseHandler, register_dynamic_db_routes, find_subject_database, get_all_qbank_subjects
+    from dynamic_db_handler import DynamicDatabaseHandler, register_dynamic_db_routes, find_subject_database, get_all_qbank_subjects, QBANK_QUERIES, find_question_position
     dynamic_db_handler = DynamicDatabaseHandler()
 
 # CENTRALIZED USER DATABASE CONFIGURATION
@@ -43,6 +50,12 @@ DB_FILE = '1st_year.db'
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'
+# Behind the host's reverse proxy every request comes from the proxy's address; trust
+# this many X-Forwarded-* hops so remote_addr (and the rate limits) see the real client.
+# Set PROXY_FIX_HOPS=0 when the app is reached directly, or clients could spoof it.
+PROXY_FIX_HOPS = int(os.environ.get('PROXY_FIX_HOPS', 1))
+if PROXY_FIX_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIX_HOPS, x_proto=PROXY_FIX_HOPS)
 print("Registered endpoints:")
 for rule in app.url_map.iter_rules():
     print(rule.endpoint, "->", rule.rule)
@@ -57,16 +70,24 @@ for rule in app.url_map.iter_rules():
 # --------------------
 
 
-def get_user_db_connection():
-    """ONLY connection function for ALL user operations"""
-    conn = sqlite3.connect(USER_DB_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
+def get_user_db_connection(user_id=None):
+    """ONLY connection function for ALL user operations (pooled).
+
+    With a user_id: that user's activity shard (bookmarks, notes, completions, analytics).
+    Without: admin_users.db itself (users, logins, access policy).
+    """
+    return user_shards.get_connection(user_id)
 
 def get_db_connection():
     """Redirect ALL user operations to centralized database"""
     return get_user_db_connection()
 
+# Bookmarks shown per page; pages are keyed by (created_at, id), not OFFSET
+BOOKMARKS_PAGE_SIZE = 50
+
+# Ids per "IN (...)" query, well under SQLite's bound-variable limit
+SQL_IN_CHUNK_SIZE = 500
+
 def get_dynamic_subject_connection(subject_name):
     """Keep this ONLY for content (questions) - NOT for users"""
     db_file = find_subject_database(subject_name)
@@ -122,7 +143,8 @@ def create_centralized_user_database():
             source_database TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(user_id, question_id, source_database)
         )
     ''')
     
@@ -160,9 +182,28 @@ def create_centralized_user_database():
     conn.commit()
     conn.close()
 
+# Login-required / free flags per topic, cached in memory
+topic_access = TopicAccessPolicy(USER_DB_FILE)
+
+# Which shard file holds each user's activity rows; each file also gets its own
+# write-behind queue for coalesced writes (last_login, note autosaves, completion pings)
+user_shards = UserShardRouter(USER_DB_FILE)
+
+# Daily per-user study counters (user_analytics), aggregated in memory
+study_activity = StudyActivityAggregator(user_shards.shard_file)
+
 def init_db():
     """Initialize centralized user database"""
     create_centralized_user_database()
+    # Indexes, unique keys and mcq_results (see migrations.py)
+    success, message = dynamic_db_handler.migrate_database(USER_DB_FILE, 'users')
+    if not success:
+        print(f"❌ {message}")
+    user_shards.initialize()
+    # Fork the hashing processes before any background thread exists
+    password_hasher.start()
+    topic_access.initialize(
+        [db_info['file'] for db_info in dynamic_db_handler.discovered_databases.get('qbank', ())])
     print("✅ Centralized admin_users.db initialized successfully!")
 
 # Initialize database when app starts
@@ -188,64 +229,24 @@ def setup_free_content():
         ('Pharmacology', 'Basic Pharmacokinetics')
     ]
     
-    # Apply to all discovered databases
-    for category, databases in dynamic_db_handler.discovered_databases.items():
-        if category == 'qbank':
-            for db_info in databases:
-                try:
-                    conn = dynamic_db_handler.get_connection(db_info['file'])
-                    
-                    # First, mark ALL topics as requiring login (premium = 1)
-                    conn.execute('UPDATE qbank SET is_premium = 1')
-                    
-                    # Then mark only specific topics as free (premium = 0)
-                    for subject, topic in free_topics:
-                        conn.execute('''
-                            UPDATE qbank 
-                            SET is_premium = 0 
-                            WHERE LOWER(subject) = ? AND LOWER(topic) = ?
-                        ''', (subject.lower(), topic.lower()))
-                    
-                    conn.commit()
-                    conn.close()
-                except Exception as e:
-                    print(f"Error setting up content in {db_info['file']}: {e}")
+    # One policy table for all databases: login required by default, these topics free
+    try:
+        topic_access.replace_all(free_topics, default_requires_login=True)
+    except Exception as e:
+        print(f"Error setting up content access policy: {e}")
+        return False
     
     print(f"Content setup completed. {len(free_topics)} topics are free across all databases.")
     return True
 
 def is_topic_login_required(subject, topic):
     """Check if a topic requires user login (returns True if login required)"""
-    source_db = find_subject_database(subject)
-    try:
-        conn = dynamic_db_handler.get_connection(source_db)
-        result = conn.execute('''
-            SELECT DISTINCT is_premium 
-            FROM qbank 
-            WHERE LOWER(subject) = ? AND LOWER(topic) = ?
-            LIMIT 1
-        ''', (subject.lower(), topic.lower())).fetchone()
-        conn.close()
-        
-        # If is_premium = 1, login is required
-        # If is_premium = 0, topic is free
-        return result and result['is_premium'] == 1
-    except Exception as e:
-        print(f"Error checking topic access: {e}")
-        return True  # Default to requiring login
+    return topic_access.requires_login(subject, topic)
 
 def mark_topic_as_login_required(subject, topic):
     """Mark a specific topic as requiring login (admin function)"""
-    source_db = find_subject_database(subject)
     try:
-        conn = dynamic_db_handler.get_connection(source_db)
-        conn.execute('''
-            UPDATE qbank 
-            SET is_premium = 1 
-            WHERE LOWER(subject) = ? AND LOWER(topic) = ?
-        ''', (subject.lower(), topic.lower()))
-        conn.commit()
-        conn.close()
+        topic_access.set_topic(subject, topic, requires_login=True)
         return True
     except Exception as e:
         print(f"Error marking topic as login required: {e}")
@@ -253,16 +254,8 @@ def mark_topic_as_login_required(subject, topic):
 
 def mark_topic_as_free(subject, topic):
     """Mark a specific topic as free access (admin function)"""
-    source_db = find_subject_database(subject)
     try:
-        conn = dynamic_db_handler.get_connection(source_db)
-        conn.execute('''
-            UPDATE qbank 
-            SET is_premium = 0 
-            WHERE LOWER(subject) = ? AND LOWER(topic) = ?
-        ''', (subject.lower(), topic.lower()))
-        conn.commit()
-        conn.close()
+        topic_access.set_topic(subject, topic, requires_login=False)
         return True
     except Exception as e:
         print(f"Error marking topic as free: {e}")
@@ -286,74 +279,123 @@ def create_user_session(user_id, username, user_type):
 # --------------------
 # CENTRALIZED HELPER FUNCTIONS
 # --------------------
-def get_question_count(conn, subject_name, topic_name):
-    """Get the count of questions for a specific topic"""
-    result = conn.execute(
-        'SELECT COUNT(*) as count FROM qbank WHERE LOWER(subject) = ? AND topic = ?',
-        (subject_name.lower(), topic_name)
-    ).fetchone()
-    return result['count'] if result else 0
+def get_question_user_state(user_id, question_id, subject, topic):
+    """Bookmark, note and topic completion for one question in a single query.
 
-def is_bookmarked(conn_unused, user_id, question_id):
-    """Check bookmark in centralized database (ignore conn parameter)"""
+    Scoped to the question's source database and memoized for the request.
+    """
     if not user_id:
-        return False
+        return {'bookmarked': False, 'note': None, 'topic_completed': False}
     
-    user_conn = get_user_db_connection()  # Always admin_users.db
+    source_db = find_subject_database(subject)
+    key = (user_id, question_id, source_db, subject.lower(), topic)
+    memo = g.setdefault('_question_user_state', {})
+    if key in memo:
+        return memo[key]
+    
+    user_shards.wait_for_owner(user_id)
+    user_conn = get_user_db_connection(user_id)
     try:
-        result = user_conn.execute(
-            'SELECT id FROM user_bookmarks WHERE user_id = ? AND question_id = ?',
-            (user_id, question_id)
-        ).fetchone()
-        return result is not None
+        row = user_conn.execute('''
+            SELECT
+                EXISTS (SELECT 1 FROM user_bookmarks
+                        WHERE user_id = :user_id AND question_id = :question_id
+                          AND source_database = :source_db) as bookmarked,
+                (SELECT note FROM user_notes
+                 WHERE user_id = :user_id AND question_id = :question_id
+                   AND source_database = :source_db
+                 ORDER BY updated_at DESC, id DESC LIMIT 1) as note,
+                EXISTS (SELECT 1 FROM user_topic_completion
+                        WHERE user_id = :user_id AND LOWER(subject) = :subject AND topic = :topic
+                          AND source_database = :source_db) as topic_completed
+        ''', {'user_id': user_id, 'question_id': question_id, 'source_db': source_db,
+              'subject': subject.lower(), 'topic': topic}).fetchone()
     finally:
         user_conn.close()
+    
+    state = {
+        'bookmarked': bool(row['bookmarked']),
+        'note': row['note'],
+        'topic_completed': bool(row['topic_completed'])
+    }
+    memo[key] = state
+    return state
 
-def is_topic_completed(conn_unused, user_id, subject, topic):
-    """Check completion in centralized database"""
+def get_completed_topics(user_id, subject, source_db):
+    """All topics of a subject the user has completed, in one query"""
     if not user_id:
-        return False
+        return set()
     
-    source_db = find_subject_database(subject)
-    user_conn = get_user_db_connection()  # Always admin_users.db
+    user_shards.wait_for_owner(user_id)
+    user_conn = get_user_db_connection(user_id)
     try:
-        result = user_conn.execute(
-            '''SELECT id FROM user_topic_completion 
-               WHERE user_id = ? AND LOWER(subject) = ? AND topic = ? AND source_database = ?''',
-            (user_id, subject.lower(), topic, source_db)
-        ).fetchone()
-        return result is not None
+        rows = user_conn.execute(
+            '''SELECT topic FROM user_topic_completion 
+               WHERE user_id = ? AND LOWER(subject) = ? AND source_database = ?''',
+            (user_id, subject.lower(), source_db)
+        ).fetchall()
+        return {row['topic'] for row in rows}
     finally:
         user_conn.close()
 
-def get_user_note(conn_unused, user_id, question_id):
-    """Get note from centralized database"""
+# Totals last pushed into subject_topic_totals/user_progress by this process
+_synced_progress_totals = {'rows': None}
+
+def sync_progress_totals():
+    """Refresh user_progress.total_topics after qbank content changed (no-op otherwise)"""
+    rows = sorted((subject, db_info['database'], db_info['topic_count'])
+                  for subject, db_list in get_all_qbank_subjects().items() for db_info in db_list)
+    if rows == _synced_progress_totals['rows']:
+        return False
+    
+    # Every shard keeps its own copy; new shards start from the central one
+    for db_file in dict.fromkeys([USER_DB_FILE] + user_shards.active_files()):
+        user_conn = dynamic_db_handler.get_connection(db_file)
+        try:
+            user_conn.execute('DELETE FROM subject_topic_totals')
+            user_conn.executemany(
+                'INSERT OR REPLACE INTO subject_topic_totals (subject, source_database, total_topics) VALUES (?, ?, ?)',
+                rows)
+            user_conn.execute('''
+                UPDATE user_progress SET total_topics = totals.total_topics
+                FROM subject_topic_totals AS totals
+                WHERE user_progress.subject = totals.subject
+                  AND user_progress.source_database = totals.source_database
+                  AND user_progress.total_topics != totals.total_topics
+            ''')
+            user_conn.commit()
+        finally:
+            user_conn.close()
+    _synced_progress_totals['rows'] = rows
+    return True
+
+def get_user_progress(user_id):
+    """{(lowercased subject, source_database): user_progress row} for one user"""
     if not user_id:
-        return None
+        return {}
     
-    user_conn = get_user_db_connection()  # Always admin_users.db
+    user_shards.wait_for_owner(user_id)
+    sync_progress_totals()
+    user_conn = get_user_db_connection(user_id)
     try:
-        result = user_conn.execute(
-            'SELECT note FROM user_notes WHERE user_id = ? AND question_id = ?',
-            (user_id, question_id)
-        ).fetchone()
-        return result['note'] if result else None
+        rows = user_conn.execute(
+            '''SELECT subject, source_database, completed_topics, total_topics, last_activity
+               FROM user_progress WHERE user_id = ?''',
+            (user_id,)
+        ).fetchall()
     finally:
         user_conn.close()
+    return {(row['subject'].lower(), row['source_database']): row for row in rows}
 
 def get_next_topic(conn, subject_name, current_topic):
     """Get next topic sorted by CHAPTER first, then topic name"""
     topics = conn.execute(
-        '''
-        SELECT DISTINCT topic 
-        FROM qbank 
-        WHERE LOWER(subject) = ? AND topic != "" AND topic != "None"
-        ORDER BY chapter ASC, topic ASC
-        ''',
-        (subject_name.lower(),)
+        QBANK_QUERIES['subject_topics_ordered'],
+        (subject_name,)
     ).fetchall()
     
-    topic_list = [t['topic'] for t in topics]
+    # A topic listed under several chapters keeps its first position
+    topic_list = list(dict.fromkeys(t['topic'] for t in topics))
     try:
         current_index = topic_list.index(current_topic)
         if current_index < len(topic_list) - 1:
@@ -368,10 +410,10 @@ def get_next_topic(conn, subject_name, current_topic):
 # CENTRALIZED DATABASE OPERATIONS
 # --------------------
 def add_bookmark_to_db(user_id, question_id, subject, topic):
-    """ALL bookmarks go to admin_users.db regardless of source"""
+    """ALL bookmarks go to the user's shard regardless of source"""
     source_db = find_subject_database(subject)
     
-    conn = get_user_db_connection()  # Always admin_users.db
+    conn = get_user_db_connection(user_id)
     try:
         conn.execute('''
             INSERT INTO user_bookmarks 
@@ -388,14 +430,14 @@ def add_bookmark_to_db(user_id, question_id, subject, topic):
     finally:
         conn.close()
 
-def remove_bookmark_from_db(user_id, question_id):
-    """Remove bookmark from centralized database"""
-    conn = get_user_db_connection()  # Always admin_users.db
+def remove_bookmark_from_db(user_id, question_id, source_db):
+    """Remove bookmark from the user's shard"""
+    conn = get_user_db_connection(user_id)
     try:
         cursor = conn.cursor()
         cursor.execute(
-            'DELETE FROM user_bookmarks WHERE user_id = ? AND question_id = ?',
-            (user_id, question_id)
+            'DELETE FROM user_bookmarks WHERE user_id = ? AND question_id = ? AND source_database = ?',
+            (user_id, question_id, source_db)
         )
         success = cursor.rowcount > 0
         conn.commit()
@@ -406,6 +448,164 @@ def remove_bookmark_from_db(user_id, question_id):
     finally:
         conn.close()
 
+# --------------------
+# BATCHED USER-STATE MUTATIONS
+# --------------------
+# Most operations a single /api/user_state/batch request may carry
+USER_STATE_BATCH_LIMIT = 100
+
+def _require_fields(op, *fields):
+    missing = [field for field in fields if op.get(field) in (None, '')]
+    if missing:
+        raise ValueError(f"Missing {', '.join(missing)}")
+
+def _bookmark_on(conn, user_id, op, source_db):
+    row = conn.execute('''
+        INSERT INTO user_bookmarks (user_id, question_id, subject, topic, source_database)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, question_id, source_database) DO NOTHING
+        RETURNING id
+    ''', (user_id, op['question_id'], op['subject'], op['topic'], source_db)).fetchall()
+    return {'bookmarked': True, 'changed': bool(row)}
+
+def _bookmark_off(conn, user_id, op, source_db):
+    row = conn.execute('''
+        DELETE FROM user_bookmarks
+        WHERE user_id = ? AND question_id = ? AND source_database = ?
+        RETURNING id
+    ''', (user_id, op['question_id'], source_db)).fetchall()
+    return {'bookmarked': False, 'changed': bool(row)}
+
+def _bookmark_toggle(conn, user_id, op, source_db):
+    # Delete-or-insert inside the batch transaction: no window between check and write
+    result = _bookmark_off(conn, user_id, op, source_db)
+    if result['changed']:
+        return result
+    return _bookmark_on(conn, user_id, op, source_db)
+
+def _note_upsert(conn, user_id, op, source_db):
+    # An empty note clears the saved one
+    note = (op.get('note') or '').strip()
+    if not note:
+        return _note_delete(conn, user_id, op, source_db)
+    row = conn.execute('''
+        INSERT INTO user_notes (user_id, question_id, note, source_database)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id, question_id, source_database) DO UPDATE
+            SET note = excluded.note, updated_at = CURRENT_TIMESTAMP
+        RETURNING id
+    ''', (user_id, op['question_id'], note, source_db)).fetchall()
+    return {'note_id': row[0]['id']}
+
+def _note_delete(conn, user_id, op, source_db):
+    row = conn.execute('''
+        DELETE FROM user_notes
+        WHERE user_id = ? AND question_id = ? AND source_database = ?
+        RETURNING id
+    ''', (user_id, op['question_id'], source_db)).fetchall()
+    return {'changed': bool(row)}
+
+def _topic_complete(conn, user_id, op, source_db):
+    # Same subject in another letter case counts as already completed
+    row = conn.execute('''
+        INSERT INTO user_topic_completion (user_id, subject, topic, source_database)
+        SELECT ?, ?, ?, ?
+        WHERE NOT EXISTS (
+            SELECT 1 FROM user_topic_completion
+            WHERE user_id = ? AND LOWER(subject) = ? AND topic = ? AND source_database = ?
+        )
+        ON CONFLICT (user_id, subject, topic, source_database) DO NOTHING
+        RETURNING id
+    ''', (user_id, op['subject'], op['topic'], source_db,
+          user_id, op['subject'].lower(), op['topic'], source_db)).fetchall()
+    return {'completed': True, 'changed': bool(row)}
+
+# op name -> (required fields, handler)
+USER_STATE_OPERATIONS = {
+    'bookmark_on': (('question_id', 'subject', 'topic'), _bookmark_on),
+    'bookmark_off': (('question_id', 'subject'), _bookmark_off),
+    'bookmark_toggle': (('question_id', 'subject', 'topic'), _bookmark_toggle),
+    'note_upsert': (('question_id', 'subject'), _note_upsert),
+    'note_delete': (('question_id', 'subject'), _note_delete),
+    'topic_complete': (('subject', 'topic'), _topic_complete),
+}
+
+def apply_user_state_operations(user_id, operations):
+    """Apply bookmark/note/completion operations in one transaction; one result per operation.
+
+    Each operation runs in its own savepoint, so a bad one is reported without
+    undoing the others.
+    """
+    # Queued writes for this user land first so they can't overwrite these later
+    user_shards.wait_for_owner(user_id)
+    conn = get_user_db_connection(user_id)
+    results = []
+    try:
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+        for index, op in enumerate(operations):
+            name = op.get('op') if isinstance(op, dict) else None
+            if name not in USER_STATE_OPERATIONS:
+                results.append({'op': name, 'success': False, 'message': 'Unknown operation'})
+                continue
+            fields, handler = USER_STATE_OPERATIONS[name]
+            conn.execute(f'SAVEPOINT user_state_op_{index}')
+            try:
+                _require_fields(op, *fields)
+                result = handler(conn, user_id, op, find_subject_database(op['subject']))
+                conn.execute(f'RELEASE user_state_op_{index}')
+                results.append({'op': name, 'success': True, **result})
+            except (ValueError, TypeError, AttributeError, sqlite3.Error) as e:
+                conn.execute(f'ROLLBACK TO user_state_op_{index}')
+                conn.execute(f'RELEASE user_state_op_{index}')
+                results.append({'op': name, 'success': False, 'message': str(e)})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return results
+
+def _write_behind_key(user_id, op, source_db):
+    if op['op'] == 'topic_complete':
+        return ('topic_complete', user_id, op['subject'].lower(), op['topic'], source_db)
+    return ('note', user_id, op['question_id'], source_db)
+
+def queue_user_state_operation(user_id, op):
+    """Hand a note_upsert/topic_complete to the write-behind queue; written now if it is full"""
+    fields, handler = USER_STATE_OPERATIONS[op['op']]
+    _require_fields(op, *fields)
+    source_db = find_subject_database(op['subject'])
+    if user_shards.write_queue(user_id).submit(_write_behind_key(user_id, op, source_db), handler,
+                                               (user_id, op, source_db), owner=user_id):
+        return {'op': op['op'], 'success': True, 'queued': True}
+    return apply_user_state_operations(user_id, [op])[0]
+
+def _touch_last_login(conn, user_id, logged_in_at):
+    conn.execute('UPDATE users SET last_login = ? WHERE id = ?', (logged_in_at, user_id))
+
+@app.route('/api/user_state/batch', methods=['POST'])
+def user_state_batch():
+    """Apply a client-side queue of bookmark/note/completion actions in one request"""
+    user_id = ensure_user_session()
+    if not user_id:
+        return jsonify({'success': False, 'message': 'Please login first'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'success': False, 'message': 'operations must be a non-empty list'}), 400
+    if len(operations) > USER_STATE_BATCH_LIMIT:
+        return jsonify({'success': False,
+                        'message': f'At most {USER_STATE_BATCH_LIMIT} operations per batch'}), 400
+    
+    try:
+        results = apply_user_state_operations(user_id, operations)
+    except sqlite3.Error as e:
+        return jsonify({'success': False, 'message': f'Database error: {str(e)}'}), 503
+    return jsonify({'success': all(result['success'] for result in results), 'results': results})
+
 # --------------------
 # BOOKMARK ROUTES
 # --------------------
@@ -428,34 +628,17 @@ def toggle_bookmark():
         if not all([question_id, subject, topic]):
             return jsonify({'success': False, 'message': 'Missing required data'})
         
-        # Check if bookmark already exists in centralized database
-        conn = get_user_db_connection()
-        existing = conn.execute(
-            'SELECT id FROM user_bookmarks WHERE user_id = ? AND question_id = ?',
-            (user_id, question_id)
-        ).fetchone()
-        conn.close()
-        
-        if existing:
-            success = remove_bookmark_from_db(user_id, question_id)
-            if success:
-                return jsonify({
-                    'success': True, 
-                    'bookmarked': False, 
-                    'message': 'Bookmark removed successfully'
-                })
-            else:
-                return jsonify({'success': False, 'message': 'Failed to remove bookmark'})
-        else:
-            success = add_bookmark_to_db(user_id, question_id, subject, topic)
-            if success:
-                return jsonify({
-                    'success': True, 
-                    'bookmarked': True, 
-                    'message': 'Bookmark added successfully'
-                })
-            else:
-                return jsonify({'success': False, 'message': 'Bookmark already exists or failed to add'})
+        # Remove-or-add in one transaction (no race between the check and the write)
+        result = apply_user_state_operations(user_id, [{
+            'op': 'bookmark_toggle', 'question_id': question_id, 'subject': subject, 'topic': topic
+        }])[0]
+        if not result['success']:
+            return jsonify({'success': False, 'message': f"Failed to update bookmark: {result['message']}"})
+        return jsonify({
+            'success': True, 
+            'bookmarked': result['bookmarked'], 
+            'message': 'Bookmark added successfully' if result['bookmarked'] else 'Bookmark removed successfully'
+        })
                 
     except Exception as e:
         return jsonify({'success': False, 'message': f'Server error: {str(e)}'})
@@ -485,49 +668,110 @@ def add_bookmark():
     
     return redirect(request.referrer or url_for('home'))
 
+def parse_bookmark_cursor(cursor):
+    """'<created_at>,<id>' from the previous page -> (created_at, id), or None"""
+    try:
+        created_at, bookmark_id = cursor.rsplit(',', 1)
+        return created_at, int(bookmark_id)
+    except (AttributeError, ValueError):
+        return None
+
+def load_bookmark_page(user_conn, user_id, subject=None, cursor=None, page_size=BOOKMARKS_PAGE_SIZE):
+    """One page of bookmarks, newest first, plus the cursor of the next page (or None)"""
+    query = 'SELECT * FROM user_bookmarks WHERE user_id = ?'
+    params = [user_id]
+    if subject:
+        query += ' AND subject = ? COLLATE NOCASE'
+        params.append(subject)
+    position = parse_bookmark_cursor(cursor)
+    if position:
+        query += ' AND (created_at, id) < (?, ?)'
+        params.extend(position)
+    query += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+    params.append(page_size + 1)  # one extra row tells us whether another page exists
+    
+    rows = user_conn.execute(query, params).fetchall()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = f"{rows[-1]['created_at']},{rows[-1]['id']}"
+    return rows, next_cursor
+
+def get_bookmark_subject_counts(user_conn, user_id, subject=None):
+    """Bookmark count per subject for the page header (index-only)"""
+    query = 'SELECT subject, COUNT(*) as count FROM user_bookmarks WHERE user_id = ?'
+    params = [user_id]
+    if subject:
+        query += ' AND subject = ? COLLATE NOCASE'
+        params.append(subject)
+    query += ' GROUP BY subject ORDER BY subject'
+    return {row['subject']: row['count'] for row in user_conn.execute(query, params).fetchall()}
+
+def load_questions(refs, columns='id, question, answer'):
+    """qbank rows for (source_database, question_id) pairs: one chunked IN query per database"""
+    ids_by_database = {}
+    for source_database, question_id in refs:
+        ids_by_database.setdefault(source_database, []).append(question_id)
+    
+    questions = {}  # (source_database, question_id) -> row
+    for source_database, question_ids in ids_by_database.items():
+        try:
+            source_conn = dynamic_db_handler.get_connection(source_database)
+            try:
+                for start in range(0, len(question_ids), SQL_IN_CHUNK_SIZE):
+                    chunk = question_ids[start:start + SQL_IN_CHUNK_SIZE]
+                    placeholders = ','.join('?' * len(chunk))
+                    rows = source_conn.execute(
+                        f'SELECT {columns} FROM qbank WHERE id IN ({placeholders})',
+                        chunk
+                    ).fetchall()
+                    for row in rows:
+                        questions[(source_database, row['id'])] = row
+            finally:
+                source_conn.close()
+        except Exception as e:
+            print(f"Error loading questions from {source_database}: {e}")
+    return questions
+
+def enrich_bookmarks(bookmarks):
+    """Attach question/answer text to a page of bookmarks"""
+    questions = load_questions((bookmark['source_database'], bookmark['question_id'])
+                               for bookmark in bookmarks)
+    
+    enriched_bookmarks = []
+    for bookmark in bookmarks:
+        question = questions.get((bookmark['source_database'], bookmark['question_id']))
+        if question:
+            enriched_bookmarks.append({
+                'bookmark_id': bookmark['id'],
+                'question_id': bookmark['question_id'],
+                'subject': bookmark['subject'],
+                'topic': bookmark['topic'],
+                'source_database': bookmark['source_database'],
+                'created_at': bookmark['created_at'],
+                'question': question['question'],
+                'answer': question['answer']
+            })
+    return enriched_bookmarks
+
 @app.route('/bookmarks')
 def bookmarks():
-    """Get ALL bookmarks from centralized database"""
+    """Get bookmarks from centralized database, one page at a time"""
     user_id = ensure_user_session()
     if not user_id:
         flash('Please login to view your bookmarks')
         return redirect(url_for('login'))
     
-    user_conn = get_user_db_connection()  # Always admin_users.db
+    user_conn = get_user_db_connection(user_id)
     try:
-        # Get bookmarks with source database info
-        bookmarks = user_conn.execute('''
-            SELECT * FROM user_bookmarks 
-            WHERE user_id = ? 
-            ORDER BY created_at DESC
-        ''', (user_id,)).fetchall()
-        
-        # Enrich with actual question data from source databases
-        enriched_bookmarks = []
-        for bookmark in bookmarks:
-            try:
-                source_conn = dynamic_db_handler.get_connection(bookmark['source_database'])
-                question = source_conn.execute(
-                    'SELECT question, answer FROM qbank WHERE id = ?',
-                    (bookmark['question_id'],)
-                ).fetchone()
-                
-                if question:
-                    enriched_bookmarks.append({
-                        'bookmark_id': bookmark['id'],
-                        'question_id': bookmark['question_id'],
-                        'subject': bookmark['subject'],
-                        'topic': bookmark['topic'],
-                        'source_database': bookmark['source_database'],
-                        'created_at': bookmark['created_at'],
-                        'question': question['question'],
-                        'answer': question['answer']
-                    })
-                source_conn.close()
-            except Exception as e:
-                print(f"Error enriching bookmark from {bookmark['source_database']}: {e}")
-        
-        return render_template('bookmarks.html', bookmarks=enriched_bookmarks)
+        page, next_cursor = load_bookmark_page(user_conn, user_id, cursor=request.args.get('before'))
+        subject_counts = get_bookmark_subject_counts(user_conn, user_id)
+        
+        return render_template('bookmarks.html',
+                             bookmarks=enrich_bookmarks(page),
+                             subject_counts=subject_counts,
+                             total_bookmarks=sum(subject_counts.values()),
+                             next_page_url=url_for('bookmarks', before=next_cursor) if next_cursor else None)
     finally:
         user_conn.close()
 
@@ -539,42 +783,19 @@ def bookmarks_by_subject(subject_name):
         flash('Please login first')
         return redirect(url_for('login'))
     
-    user_conn = get_user_db_connection()
+    user_conn = get_user_db_connection(user_id)
     try:
-        bookmarks = user_conn.execute('''
-            SELECT * FROM user_bookmarks 
-            WHERE user_id = ? AND LOWER(subject) = ?
-            ORDER BY created_at DESC
-        ''', (user_id, subject_name.lower())).fetchall()
-        
-        # Enrich bookmarks with actual question data
-        enriched_bookmarks = []
-        for bookmark in bookmarks:
-            try:
-                source_conn = dynamic_db_handler.get_connection(bookmark['source_database'])
-                question = source_conn.execute(
-                    'SELECT question, answer FROM qbank WHERE id = ?',
-                    (bookmark['question_id'],)
-                ).fetchone()
-                
-                if question:
-                    enriched_bookmarks.append({
-                        'bookmark_id': bookmark['id'],
-                        'question_id': bookmark['question_id'],
-                        'subject': bookmark['subject'],
-                        'topic': bookmark['topic'],
-                        'source_database': bookmark['source_database'],
-                        'created_at': bookmark['created_at'],
-                        'question': question['question'],
-                        'answer': question['answer']
-                    })
-                source_conn.close()
-            except Exception as e:
-                print(f"Error enriching bookmark: {e}")
+        page, next_cursor = load_bookmark_page(user_conn, user_id, subject=subject_name,
+                                               cursor=request.args.get('before'))
+        subject_counts = get_bookmark_subject_counts(user_conn, user_id, subject=subject_name)
         
         return render_template('bookmarks.html', 
-                             bookmarks=enriched_bookmarks, 
-                             filtered_subject=subject_name)
+                             bookmarks=enrich_bookmarks(page), 
+                             filtered_subject=subject_name,
+                             subject_counts=subject_counts,
+                             total_bookmarks=sum(subject_counts.values()),
+                             next_page_url=url_for('bookmarks_by_subject', subject_name=subject_name,
+                                                   before=next_cursor) if next_cursor else None)
     finally:
         user_conn.close()
 
@@ -585,11 +806,11 @@ def remove_bookmark_by_id(bookmark_id):
     if not user_id:
         return jsonify({'success': False, 'message': 'Please login first'})
     
-    conn = get_user_db_connection()
+    conn = get_user_db_connection(user_id)
     try:
         # Verify bookmark belongs to user and get question_id
         bookmark = conn.execute(
-            'SELECT question_id FROM user_bookmarks WHERE id = ? AND user_id = ?',
+            'SELECT question_id, source_database FROM user_bookmarks WHERE id = ? AND user_id = ?',
             (bookmark_id, user_id)
         ).fetchone()
         
@@ -597,7 +818,7 @@ def remove_bookmark_by_id(bookmark_id):
             return jsonify({'success': False, 'message': 'Bookmark not found'})
         
         # Remove bookmark using existing function
-        success = remove_bookmark_from_db(user_id, bookmark['question_id'])
+        success = remove_bookmark_from_db(user_id, bookmark['question_id'], bookmark['source_database'])
         
         if success:
             return jsonify({'success': True, 'message': 'Bookmark removed successfully'})
@@ -650,27 +871,12 @@ def complete_topic():
     
     try:
         data = request.get_json()
-        subject = data.get('subject')
-        topic = data.get('topic')
-        source_db = find_subject_database(subject)
-        
-        conn = get_user_db_connection()  # Always admin_users.db
-        
-        # Check if already completed
-        existing = conn.execute('''
-            SELECT id FROM user_topic_completion 
-            WHERE user_id = ? AND LOWER(subject) = ? AND topic = ? AND source_database = ?
-        ''', (user_id, subject.lower(), topic, source_db)).fetchone()
-        
-        if not existing:
-            conn.execute('''
-                INSERT INTO user_topic_completion 
-                (user_id, subject, topic, source_database) 
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, subject, topic, source_db))
-            conn.commit()
-        
-        conn.close()
+        result = queue_user_state_operation(user_id, {
+            'op': 'topic_complete', 'subject': data.get('subject'), 'topic': data.get('topic')
+        })
+        if not result['success']:
+            return jsonify({'success': False, 'message': result['message']})
+        study_activity.record(user_id, 'topic_completed', find_subject_database(data.get('subject')))
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
@@ -683,39 +889,102 @@ def save_note():
     
     try:
         data = request.get_json()
-        question_id = data.get('question_id')
-        note = data.get('note', '').strip()
-        subject = data.get('subject', '')
-        source_db = find_subject_database(subject)
-        
-        conn = get_user_db_connection()  # Always admin_users.db
-        
-        if note:
-            conn.execute('''
-                INSERT OR REPLACE INTO user_notes 
-                (user_id, question_id, note, source_database, updated_at)
-                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (user_id, question_id, note, source_db))
-        else:
-            conn.execute(
-                'DELETE FROM user_notes WHERE user_id = ? AND question_id = ?',
-                (user_id, question_id)
-            )
-        
-        conn.commit()
-        conn.close()
+        result = queue_user_state_operation(user_id, {
+            'op': 'note_upsert', 'question_id': data.get('question_id'),
+            'subject': data.get('subject', ''), 'note': data.get('note') or ''
+        })
+        if not result['success']:
+            return jsonify({'success': False, 'message': result['message']})
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+# Snippet delimiters that can't occur in note text; swapped for <mark> after HTML-escaping
+_SNIPPET_START, _SNIPPET_END = '\x02', '\x03'
+NOTES_SEARCH_MAX_RESULTS = 50
+
+def build_notes_match(user_id, text):
+    """FTS5 query for the user's notes containing every word of text (last word as a prefix)"""
+    terms = re.findall(r'\w+', text)[:16]
+    if not terms:
+        return None
+    # Quoted terms can't be read as FTS5 operators or column filters
+    phrases = [f'"{term}"' for term in terms]
+    phrases[-1] += '*'
+    return f'owner : u{int(user_id)} AND note : ({" ".join(phrases)})'
+
+def search_user_notes(user_id, text, limit=20):
+    """Ranked note matches for one user with highlighted snippets and question metadata"""
+    match = build_notes_match(user_id, text)
+    if match is None:
+        return []
+    
+    user_shards.wait_for_owner(user_id)
+    user_conn = get_user_db_connection(user_id)
+    try:
+        hits = user_conn.execute('''
+            SELECT user_notes.id, user_notes.question_id, user_notes.source_database,
+                   user_notes.updated_at,
+                   snippet(user_notes_fts, 0, ?, ?, '…', 16) as snippet
+            FROM user_notes_fts
+            JOIN user_notes ON user_notes.id = user_notes_fts.rowid
+            WHERE user_notes_fts MATCH ?
+            ORDER BY bm25(user_notes_fts, 1.0, 0.0)
+            LIMIT ?
+        ''', (_SNIPPET_START, _SNIPPET_END, match, limit)).fetchall()
+    finally:
+        user_conn.close()
+    
+    questions = load_questions(((hit['source_database'], hit['question_id']) for hit in hits),
+                               columns='id, subject, topic, question')
+    results = []
+    for hit in hits:
+        question = questions.get((hit['source_database'], hit['question_id']))
+        snippet = (html.escape(hit['snippet'])
+                   .replace(_SNIPPET_START, '<mark>').replace(_SNIPPET_END, '</mark>'))
+        results.append({
+            'note_id': hit['id'],
+            'question_id': hit['question_id'],
+            'source_database': hit['source_database'],
+            'updated_at': hit['updated_at'],
+            'snippet': snippet,
+            'subject': question['subject'] if question else None,
+            'topic': question['topic'] if question else None,
+            'question': question['question'][:200] if question else None
+        })
+    return results
+
+@app.route('/notes/search')
+def notes_search():
+    """Full-text search over the logged-in user's notes"""
+    user_id = ensure_user_session()
+    if not user_id:
+        return jsonify({'success': False, 'message': 'Please login to search notes'}), 401
+    
+    query = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', 20, type=int), 1), NOTES_SEARCH_MAX_RESULTS)
+    try:
+        results = search_user_notes(user_id, query, limit)
+    except sqlite3.Error as e:
+        return jsonify({'success': False, 'message': f'Search failed: {str(e)}'}), 503
+    return jsonify({'success': True, 'query': query, 'results': results})
+
 # --------------------
 # AUTHENTICATION ROUTES
 # --------------------
+# Shown with a 503 when every password hashing slot is busy (e.g. just before a scheduled test)
+HASHING_BUSY_MESSAGE = 'Too many people are signing in right now. Please try again in a few seconds.'
+
+def check_login_password(user, password):
+    """Verify in the hashing pool; store a fresh hash if the configured cost changed"""
+    return password_hasher.check_user(user, password, get_user_db_connection)
+
 @app.route('/')
 def landing():
     return render_template('index.html')
 
 @app.route('/signup', methods=['GET', 'POST'])
+@rate_limiter.limit('signup', methods=('POST',), template='signup.html', account_field='email')
 def signup():
     # Check if user came from login-required content redirect
     from_restricted = request.args.get('restricted', False)
@@ -737,7 +1006,12 @@ def signup():
             flash('Email already registered.')
             return redirect(url_for('signup'))
 
-        hashed_pw = generate_password_hash(password)
+        try:
+            hashed_pw = password_hasher.hash(password)
+        except PasswordHashingBusy:
+            conn.close()
+            flash(HASHING_BUSY_MESSAGE)
+            return render_template('signup.html', from_restricted=from_restricted), 503
         conn.execute("INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
                      (username, email, hashed_pw))
         conn.commit()
@@ -748,6 +1022,7 @@ def signup():
     return render_template('signup.html', from_restricted=from_restricted)
 
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limiter.limit('login', methods=('POST',), template='login.html', account_field='username')
 def login():
     if request.method == 'POST':
         email = request.form['username'].strip().lower()
@@ -757,15 +1032,21 @@ def login():
         user = conn.execute("SELECT * FROM users WHERE email = ?", (email,)).fetchone()
         conn.close()
 
-        if user and check_password_hash(user['password'], password):
-            # Update last login
-            user_conn = get_user_db_connection()
-            user_conn.execute(
-                "UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?",
-                (user['id'],)
-            )
-            user_conn.commit()
-            user_conn.close()
+        try:
+            valid = user is not None and check_login_password(user, password)
+        except PasswordHashingBusy:
+            flash(HASHING_BUSY_MESSAGE)
+            return render_template('login.html'), 503
+
+        if valid:
+            # Update last login (coalesced in the background; same UTC format as CURRENT_TIMESTAMP)
+            logged_in_at = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            if not user_shards.write_queue().submit(('last_login', user['id']), _touch_last_login,
+                                                    (user['id'], logged_in_at)):
+                user_conn = get_user_db_connection()
+                _touch_last_login(user_conn, user['id'], logged_in_at)
+                user_conn.commit()
+                user_conn.close()
             
             # If user is admin, optionally redirect to admin login route
             if user['user_type'] == 'admin':
@@ -784,6 +1065,8 @@ def login():
     return render_template('login.html')
 
 @app.route('/admin/login', methods=['GET', 'POST'])
+@rate_limiter.limit('admin_login', methods=('POST',), template='admin_home.html',
+                    account_field='username')
 def admin_login():
     if request.method == 'POST':
         email = request.form['username'].strip().lower()
@@ -793,7 +1076,13 @@ def admin_login():
         user = conn.execute("SELECT * FROM users WHERE email = ?", (email,)).fetchone()
         conn.close()
 
-        if user and check_password_hash(user['password'], password) and user['user_type'] == 'admin':
+        try:
+            valid = user is not None and check_login_password(user, password)
+        except PasswordHashingBusy:
+            flash(HASHING_BUSY_MESSAGE, 'danger')
+            return render_template('admin_home.html'), 503
+
+        if valid and user['user_type'] == 'admin':
             create_user_session(user['id'], user['username'], 'admin')
             flash(f'Welcome Admin {user["username"]}!', 'success')
             return redirect(url_for('admin_dashboard'))  # your admin dashboard or panel
@@ -884,6 +1173,7 @@ def debug_users():
         return f"<h2>❌ Debug Error:</h2><p>{str(e)}</p><p><a href='/admin/dynamic_db_manager'>Back</a></p>"
     
 @app.route('/admin/migrate_users_with_passwords')
+@rate_limiter.limit('admin_migrate_users')
 def migrate_users_with_passwords():
     """Migrate users while preserving password hashes correctly"""
     try:
@@ -967,6 +1257,7 @@ def migrate_users_with_passwords():
 
 
 @app.route('/admin/force_migrate_users')
+@rate_limiter.limit('admin_migrate_users')
 def force_migrate_users():
     """Force migrate users with detailed logging"""
     try:
@@ -1012,6 +1303,7 @@ def force_migrate_users():
         return f"Error: {str(e)}"
 
 @app.route('/admin/migrate_users_manual')
+@rate_limiter.limit('admin_migrate_users')
 def migrate_users_manual():
     """Manual migration trigger for existing users - FIXED for missing columns"""
     try:
@@ -1062,8 +1354,10 @@ def migrate_users_manual():
         
         old_conn.close()
         
-        # Insert into centralized database
+        # Users go to the centralized database, their activity rows to each user's shard
+        # (request connections, one per file: each is committed below)
         new_conn = get_user_db_connection()
+        shard_conns = set()
         
         migrated_users = 0
         migrated_bookmarks = 0
@@ -1087,7 +1381,9 @@ def migrate_users_manual():
         for bookmark in bookmarks:
             try:
                 created_at = bookmark.get('created_at', datetime.datetime.now().isoformat())
-                new_conn.execute('''
+                shard_conn = get_user_db_connection(bookmark['user_id'])
+                shard_conns.add(shard_conn)
+                shard_conn.execute('''
                     INSERT OR IGNORE INTO user_bookmarks 
                     (user_id, question_id, subject, topic, source_database, created_at)
                     VALUES (?, ?, ?, ?, ?, ?)
@@ -1102,7 +1398,9 @@ def migrate_users_manual():
             try:
                 created_at = note.get('created_at', datetime.datetime.now().isoformat())
                 updated_at = note.get('updated_at', created_at)
-                new_conn.execute('''
+                shard_conn = get_user_db_connection(note['user_id'])
+                shard_conns.add(shard_conn)
+                shard_conn.execute('''
                     INSERT OR IGNORE INTO user_notes 
                     (user_id, question_id, note, source_database, created_at, updated_at)
                     VALUES (?, ?, ?, ?, ?, ?)
@@ -1116,7 +1414,9 @@ def migrate_users_manual():
         for completion in completions:
             try:
                 completed_at = completion.get('completed_at', datetime.datetime.now().isoformat())
-                new_conn.execute('''
+                shard_conn = get_user_db_connection(completion['user_id'])
+                shard_conns.add(shard_conn)
+                shard_conn.execute('''
                     INSERT OR IGNORE INTO user_topic_completion 
                     (user_id, subject, topic, source_database, completed_at)
                     VALUES (?, ?, ?, ?, ?)
@@ -1126,6 +1426,8 @@ def migrate_users_manual():
             except Exception as e:
                 print(f"Error migrating completion: {e}")
         
+        for shard_conn in shard_conns:
+            shard_conn.commit()
         new_conn.commit()
         new_conn.close()
         
@@ -1162,7 +1464,7 @@ def home():
         conn = get_dynamic_subject_connection('Anatomy')  # Use any subject for fallback
         rows = conn.execute('SELECT DISTINCT subject FROM qbank ORDER BY subject').fetchall()
         db_subjects = {row['subject'].strip().lower() for row in rows if row['subject']}
-        all_subjects = {s.title(): [{'database': find_subject_database(s), 'question_count': 0}] for s in db_subjects}
+        all_subjects = {s.title(): [{'database': find_subject_database(s), 'question_count': 0, 'topic_count': 0}] for s in db_subjects}
         conn.close()
 
     # Hardcoded MBBS Subject to Prof Year Mapping
@@ -1176,6 +1478,13 @@ def home():
 
     grouped_subjects = {}
 
+    # One user_progress row per subject the user has started
+    progress = {}
+    try:
+        progress = get_user_progress(user_id)
+    except Exception as e:
+        print(f"Error getting user progress: {e}")
+
     # Categorize subjects found in databases
     for year, subjects in PROF_YEAR_MAP.items():
         matched_subjects = []
@@ -1188,25 +1497,10 @@ def home():
                 completed_topics = 0
                 total_topics = 0
                 if user_id:
-                    try:
-                        conn = dynamic_db_handler.get_connection(db_info['database'])
-                        total_topics_result = conn.execute(
-                            'SELECT COUNT(DISTINCT topic) as count FROM qbank WHERE LOWER(subject) = ?',
-                            (subject.lower(),)
-                        ).fetchone()
-                        total_topics = total_topics_result['count'] if total_topics_result else 0
-                        
-                        # Get completion from centralized database
-                        user_conn = get_user_db_connection()
-                        completed_topics_result = user_conn.execute(
-                            'SELECT COUNT(*) as count FROM user_topic_completion WHERE user_id = ? AND LOWER(subject) = ? AND source_database = ?',
-                            (user_id, subject.lower(), db_info['database'])
-                        ).fetchone()
-                        completed_topics = completed_topics_result['count'] if completed_topics_result else 0
-                        user_conn.close()
-                        conn.close()
-                    except Exception as e:
-                        print(f"Error getting completion for {subject}: {e}")
+                    total_topics = db_info['topic_count']
+                    row = progress.get((subject.lower(), db_info['database']))
+                    if row:
+                        completed_topics = row['completed_topics']
                 
                 matched_subjects.append({
                     'name': subject,
@@ -1242,74 +1536,62 @@ def show_subject(subject_name):
         print(f"Error with dynamic connection, falling back to default: {e}")
         conn = get_dynamic_subject_connection('Anatomy')  # Fallback
 
-    # Rest of your existing code stays exactly the same!
-    chapters = conn.execute(
-        '''
-        SELECT DISTINCT chapter 
-        FROM qbank 
-        WHERE LOWER(subject) = ? AND chapter != "" 
-        ORDER BY chapter
-        ''',
-        (subject_name.lower(),)
+    # Two queries however many topics the subject has: outline and completions
+    outline = conn.execute(
+        QBANK_QUERIES['subject_outline'],
+        (subject_name,)
     ).fetchall()
+    completed = get_completed_topics(user_id, subject_name, find_subject_database(subject_name))
 
-    # For each chapter, get the topics with question counts
     chapters_with_topics = []
-    for row in chapters:
-        chapter = row['chapter']
-        topics = conn.execute(
-            '''
-            SELECT DISTINCT topic 
-            FROM qbank 
-            WHERE LOWER(subject) = ? AND chapter = ? AND topic != "" 
-            ORDER BY topic
-            ''',
-            (subject_name.lower(), chapter)
-        ).fetchall()
+    enhanced_topics = None
+    current_chapter = None
+    for topic_row in outline:
+        chapter = topic_row['chapter']
+        if enhanced_topics is None or chapter != current_chapter:
+            # Rows arrive ordered by chapter, so each chapter is one contiguous run
+            current_chapter = chapter
+            enhanced_topics = []
+            chapters_with_topics.append({
+                'chapter': chapter, 
+                'topics': enhanced_topics
+            })
         
-        # Enhanced topic list with question counts and access information
-        enhanced_topics = []
-        for topic_row in topics:
-            topic_name = topic_row['topic']
-            question_count = get_question_count(conn, subject_name, topic_name)
-            is_completed = is_topic_completed(conn, user_id, subject_name, topic_name)
-            
-            # Check if topic requires login (FIXED: Only show lock if user is NOT logged in)
-            topic_requires_login = is_topic_login_required(subject_name, topic_name)
-            show_lock = topic_requires_login and not user_id  # Only show lock if login required AND user not logged in
-            
-            # Generate a rating based on question count
-            if question_count >= 50:
-                rating = 4.8
-            elif question_count >= 30:
-                rating = 4.5
-            elif question_count >= 15:
-                rating = 4.2
-            elif question_count >= 5:
-                rating = 4.0
-            else:
-                rating = 3.8
-            
-            # Determine status - show login required only if user not logged in
-            if show_lock:
-                status = 'LOGIN REQUIRED'
-            else:
-                status = 'FREE'
-            
-            topic_data = {
-                'name': topic_name,
-                'question_count': question_count,
-                'rating': rating,
-                'status': status,
-                'completed': is_completed,
-                'requires_login': show_lock  # This controls the lock icon
-            }
-            enhanced_topics.append(topic_data)
-        
-        chapters_with_topics.append({
-            'chapter': chapter, 
-            'topics': enhanced_topics
-        })
+        topic_name = topic_row['topic']
+        question_count = topic_row['question_count']
+        is_completed = topic_name in completed
+        
+        # Check if topic requires login (FIXED: Only show lock if user is NOT logged in)
+        topic_requires_login = is_topic_login_required(subject_name, topic_name)
+        show_lock = topic_requires_login and not user_id  # Only show lock if login required AND user not logged in
+        
+        # Generate a rating based on question count
+        if question_count >= 50:
+            rating = 4.8
+        elif question_count >= 30:
+            rating = 4.5
+        elif question_count >= 15:
+            rating = 4.2
+        elif question_count >= 5:
+            rating = 4.0
+        else:
+            rating = 3.8
+        
+        # Determine status - show login required only if user not logged in
+        if show_lock:
+            status = 'LOGIN REQUIRED'
+        else:
+            status = 'FREE'
+        
+        topic_data = {
+            'name': topic_name,
+            'question_count': question_count,
+            'rating': rating,
+            'status': status,
+            'completed': is_completed,
+            'requires_login': show_lock  # This controls the lock icon
+        }
+        enhanced_topics.append(topic_data)
 
     conn.close()
     return render_template('subject_chapters.html',
@@ -1335,8 +1617,8 @@ def show_topic(subject_name, topic_name):
         conn = get_dynamic_subject_connection('Anatomy')
     
     row = conn.execute(
-        'SELECT id FROM qbank WHERE LOWER(subject)=? AND topic=? ORDER BY id LIMIT 1',
-        (subject_name.lower(), topic_name)
+        QBANK_QUERIES['topic_first_question'],
+        (subject_name, topic_name)
     ).fetchone()
     conn.close()
 
@@ -1369,16 +1651,12 @@ def show_question(subject_name, topic_name, qid):
     
     user_id = session.get('user_id')
 
-    # Get all question ids for pagination
-    all_ids = conn.execute(
-        'SELECT id FROM qbank WHERE LOWER(subject)=? AND topic=? ORDER BY id',
-        (subject_name.lower(), topic_name)
-    ).fetchall()
-    id_list = [r['id'] for r in all_ids]
+    # Ordered question ids for pagination (cached per topic until the database changes)
+    id_list = dynamic_db_handler.get_topic_question_ids(
+        find_subject_database(subject_name), subject_name, topic_name)
 
-    try:
-        index = id_list.index(qid)
-    except ValueError:
+    index = find_question_position(id_list, qid)
+    if index is None:
         conn.close()
         return "<h2>Question not found</h2>"
 
@@ -1387,7 +1665,8 @@ def show_question(subject_name, topic_name, qid):
     is_last_question = index == len(id_list) - 1
 
     question = conn.execute('SELECT * FROM qbank WHERE id=?', (qid,)).fetchone()
-    bookmarked = is_bookmarked(conn, user_id, qid)
+    user_state = get_question_user_state(user_id, qid, subject_name, topic_name)
+    study_activity.record(user_id, 'question_viewed', find_subject_database(subject_name))
     
     # Get next topic for navigation
     next_topic = get_next_topic(conn, subject_name, topic_name) if is_last_question else None
@@ -1405,7 +1684,8 @@ def show_question(subject_name, topic_name, qid):
         next_qid=next_qid,
         is_last_question=is_last_question,
         next_topic=next_topic,
-        bookmarked=bookmarked
+        bookmarked=user_state['bookmarked'],
+        user_state=user_state
     )
 
 @app.route('/subject/<subject_name>/topic/<topic_name>/answer/<int:qid>')
@@ -1428,15 +1708,12 @@ def show_answer(subject_name, topic_name, qid):
     
     user_id = session.get('user_id')
     
-    all_ids = conn.execute(
-        'SELECT id FROM qbank WHERE LOWER(subject)=? AND topic=? ORDER BY id',
-        (subject_name.lower(), topic_name)
-    ).fetchall()
-    id_list = [r['id'] for r in all_ids]
+    # Ordered question ids for pagination (cached per topic until the database changes)
+    id_list = dynamic_db_handler.get_topic_question_ids(
+        find_subject_database(subject_name), subject_name, topic_name)
 
-    try:
-        index = id_list.index(qid)
-    except ValueError:
+    index = find_question_position(id_list, qid)
+    if index is None:
         conn.close()
         return "<h2>Answer not found</h2>"
 
@@ -1445,8 +1722,8 @@ def show_answer(subject_name, topic_name, qid):
     is_last_question = index == len(id_list) - 1
 
     q = conn.execute('SELECT * FROM qbank WHERE id=?', (qid,)).fetchone()
-    bookmarked = is_bookmarked(conn, user_id, qid)
-    user_note = get_user_note(conn, user_id, qid)
+    user_state = get_question_user_state(user_id, qid, subject_name, topic_name)
+    study_activity.record(user_id, 'answer_viewed', find_subject_database(subject_name))
     
     # Get next topic for navigation
     next_topic = get_next_topic(conn, subject_name, topic_name) if is_last_question else None
@@ -1464,13 +1741,50 @@ def show_answer(subject_name, topic_name, qid):
         next_qid=next_qid,
         is_last_question=is_last_question,
         next_topic=next_topic,
-        bookmarked=bookmarked,
-        user_note=user_note
+        bookmarked=user_state['bookmarked'],
+        user_note=user_state['note'],
+        user_state=user_state
     )
 
+@app.route('/admin/write_behind_metrics')
+def write_behind_metrics():
+    """Shard layout plus runtime metrics for each shard's coalescing writer"""
+    if session.get('user_type') != 'admin':
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+    return jsonify(user_shards.get_stats())
+
+@app.route('/admin/password_hash_metrics')
+def password_hash_metrics():
+    """Runtime metrics for the password hashing pool"""
+    if session.get('user_type') != 'admin':
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+    return jsonify(password_hasher.get_stats())
+
+@app.route('/admin/rate_limit_metrics')
+def rate_limit_metrics():
+    """Configured limits plus allowed/rejected counters, per worker and across workers"""
+    if session.get('user_type') != 'admin':
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+    return jsonify(rate_limiter.get_stats())
+
+@app.route('/admin/user_progress/<int:user_id>')
+def admin_user_progress(user_id):
+    """One user's per-subject progress"""
+    if session.get('user_type') != 'admin':
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+    progress = [dict(row) for row in get_user_progress(user_id).values()]
+    return jsonify({'success': True, 'user_id': user_id, 'progress': progress})
+
+@app.route('/admin/study_analytics_metrics')
+def study_analytics_metrics():
+    """Runtime metrics for the study-activity aggregator"""
+    if session.get('user_type') != 'admin':
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+    return jsonify(study_activity.get_stats())
+
 # Add this line before if __name__ == '__main__':
-register_dynamic_db_routes(app, ensure_user_session)
-register_mcq_routes(app)
+register_dynamic_db_routes(app, ensure_user_session, user_shards)
+register_mcq_routes(app, user_shards)
 app.register_blueprint(test_bp)
 
 if __name__ == '__main__':
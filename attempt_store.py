@@ -0,0 +1,243 @@
+# attempt_store.py - Server-side state of in-progress test attempts
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from dynamic_db_handler import dynamic_db_handler
+
+# Stored answer byte: 0 = no answer, 1..4 = the option letter
+OPTIONS = 'ABCD'
+
+
+def _bit(bits, index):
+    return bool(bits[index >> 3] & (1 << (index & 7)))
+
+
+def _set_bit(bits, index, value):
+    if value:
+        bits[index >> 3] |= 1 << (index & 7)
+    else:
+        bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+
+class AttemptState:
+    """Answers, marks and skips of one attempt, indexed by question position (ORDER BY id)"""
+
+    def __init__(self, token, test_id, user_id, answers, marked, skipped, version=0):
+        self.token = token
+        self.test_id = test_id
+        self.user_id = user_id
+        self.answers = bytearray(answers)
+        self.marked = bytearray(marked)
+        self.skipped = bytearray(skipped)
+        self.version = version
+
+    @classmethod
+    def empty(cls, token, test_id, user_id, total):
+        state = cls(token, test_id, user_id, b'', b'', b'')
+        state.resize(total)
+        return state
+
+    def copy(self):
+        return AttemptState(self.token, self.test_id, self.user_id,
+                            self.answers, self.marked, self.skipped, self.version)
+
+    def resize(self, total):
+        """Fit the arrays to the test's question count (questions added or removed mid-attempt)"""
+        nbytes = (total + 7) // 8
+        for name, size in (('answers', total), ('marked', nbytes), ('skipped', nbytes)):
+            data = getattr(self, name)
+            if len(data) > size:
+                del data[size:]
+            else:
+                data.extend(bytes(size - len(data)))
+        # Drop flag bits past the last question so a later resize doesn't revive them
+        for bits in (self.marked, self.skipped):
+            for index in range(total, len(bits) * 8):
+                _set_bit(bits, index, False)
+
+    def answer(self, index):
+        code = self.answers[index]
+        return OPTIONS[code - 1] if 0 < code <= len(OPTIONS) else None
+
+    def set_answer(self, index, option):
+        option = (option or '').upper()
+        self.answers[index] = OPTIONS.index(option) + 1 if option and option in OPTIONS else 0
+
+    def is_marked(self, index):
+        return _bit(self.marked, index)
+
+    def set_marked(self, index, value):
+        _set_bit(self.marked, index, value)
+
+    def is_skipped(self, index):
+        return _bit(self.skipped, index)
+
+    def set_skipped(self, index, value):
+        _set_bit(self.skipped, index, value)
+
+    def as_dicts(self, question_ids):
+        """(answers {qid str: letter}, marked {qid str}, skipped {qid str}) as the templates use them"""
+        answers, marked, skipped = {}, set(), set()
+        for index, qid in enumerate(question_ids[:len(self.answers)]):
+            key = str(qid)
+            option = self.answer(index)
+            if option:
+                answers[key] = option
+            if self.is_marked(index):
+                marked.add(key)
+            if self.is_skipped(index):
+                skipped.add(key)
+        return answers, marked, skipped
+
+
+class AttemptStore:
+    """test_attempt_state rows in the test database, fronted by a small per-process cache.
+
+    The session cookie only carries the attempt token. A cached state is reused while
+    its stored version is unchanged (a one-column primary key read); writes are
+    compare-and-swap on that version, so two workers serving the same candidate
+    never overwrite each other's click.
+    """
+
+    def __init__(self, db_file, cache_size=None, ttl_hours=None):
+        self.db_file = db_file
+        if cache_size is None:
+            cache_size = int(os.environ.get('ATTEMPT_CACHE_SIZE', 2000))
+        if ttl_hours is None:
+            ttl_hours = float(os.environ.get('ATTEMPT_TTL_HOURS', 24))
+        self.cache_size = cache_size
+        self.ttl = ttl_hours * 3600
+        self._cache = OrderedDict()  # token -> AttemptState
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self.stats = {'created': 0, 'cache_hits': 0, 'cache_misses': 0, 'writes': 0,
+                      'write_conflicts': 0, 'deleted': 0, 'expired': 0}
+
+    def _connect(self):
+        return dynamic_db_handler.get_connection(self.db_file, readonly=False)
+
+    def _remember(self, state):
+        with self._lock:
+            self._cache[state.token] = state.copy()
+            self._cache.move_to_end(state.token)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _forget(self, token):
+        with self._lock:
+            self._cache.pop(token, None)
+
+    def create(self, test_id, user_id, total):
+        """New empty attempt; returns its state (state.token goes in the session)"""
+        state = AttemptState.empty(secrets.token_urlsafe(18), test_id, user_id, total)
+        conn = self._connect()
+        try:
+            self._purge_expired(conn)
+            conn.execute('''
+                INSERT INTO test_attempt_state
+                    (token, test_id, user_id, answers, marked, skipped, version, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, 0, ?)
+            ''', (state.token, test_id, user_id, bytes(state.answers), bytes(state.marked),
+                  bytes(state.skipped), time.time()))
+            conn.commit()
+        finally:
+            conn.close()
+        self._remember(state)
+        self.stats['created'] += 1
+        return state
+
+    def get(self, token, test_id, user_id):
+        """The attempt's current state, or None if the token is unknown, expired or someone else's"""
+        if not token:
+            return None
+        with self._lock:
+            cached = self._cache.get(token)
+        conn = self._connect()
+        try:
+            if cached is not None:
+                row = conn.execute('SELECT version FROM test_attempt_state WHERE token = ?',
+                                   (token,)).fetchone()
+                if row is None:
+                    self._forget(token)
+                    return None
+                if row[0] == cached.version:
+                    self.stats['cache_hits'] += 1
+                    state = cached.copy()
+                    return state if (state.test_id, state.user_id) == (test_id, user_id) else None
+            row = conn.execute('''
+                SELECT test_id, user_id, answers, marked, skipped, version
+                FROM test_attempt_state WHERE token = ?
+            ''', (token,)).fetchone()
+        finally:
+            conn.close()
+        self.stats['cache_misses'] += 1
+        if row is None:
+            self._forget(token)
+            return None
+        state = AttemptState(token, row[0], row[1], row[2], row[3], row[4], row[5])
+        self._remember(state)
+        if (state.test_id, state.user_id) != (test_id, user_id):
+            return None
+        return state
+
+    def update(self, state, change, retries=3):
+        """Apply change(state) and store it; on a concurrent write, reload and apply it again"""
+        for _ in range(retries):
+            change(state)
+            conn = self._connect()
+            try:
+                updated = conn.execute('''
+                    UPDATE test_attempt_state
+                    SET answers = ?, marked = ?, skipped = ?, version = version + 1, updated_at = ?
+                    WHERE token = ? AND version = ?
+                ''', (bytes(state.answers), bytes(state.marked), bytes(state.skipped),
+                      time.time(), state.token, state.version)).rowcount
+                conn.commit()
+            finally:
+                conn.close()
+            if updated:
+                state.version += 1
+                self._remember(state)
+                self.stats['writes'] += 1
+                return state
+            self.stats['write_conflicts'] += 1
+            self._forget(state.token)
+            total = len(state.answers)
+            state = self.get(state.token, state.test_id, state.user_id)
+            if state is None:
+                return None
+            state.resize(total)
+        print(f"⚠️ Attempt {state.token[:8]}… kept changing underneath, last click dropped")
+        return state
+
+    def delete(self, token):
+        self._forget(token)
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM test_attempt_state WHERE token = ?', (token,))
+            conn.commit()
+        finally:
+            conn.close()
+        self.stats['deleted'] += 1
+
+    def _purge_expired(self, conn):
+        # Abandoned attempts: at most one sweep per minute, piggybacked on create()
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        removed = conn.execute('DELETE FROM test_attempt_state WHERE updated_at < ?',
+                               (now - self.ttl,)).rowcount
+        if removed:
+            self.stats['expired'] += removed
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['cached'] = len(self._cache)
+        stats['cache_size'] = self.cache_size
+        stats['ttl_hours'] = self.ttl / 3600
+        return stats
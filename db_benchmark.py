@@ -0,0 +1,326 @@
+# db_benchmark.py - Standalone SQLite throughput benchmarks
+#
+# Usage:
+#   python db_benchmark.py pragmas [--seconds 5] [--writers 4] [--readers 8]
+#   python db_benchmark.py shards [--seconds 5] [--writers 8] [--counts 1 2 4 8] [--hold-ms 2]
+#   python db_benchmark.py logins [--seconds 10] [--clients 16] [--workers 2] [--max-queue 8]
+#
+# Runs against throwaway copies in a temp directory; never touches /var/data.
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from dynamic_db_handler import DEFAULT_PRAGMA_PROFILES, apply_pragma_profile
+from password_hashing import PasswordHasher, PasswordHashingBusy
+from user_shards import shard_index
+
+
+def create_user_database(path):
+    """Small admin_users.db look-alike with the bookmark table writers hit"""
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE user_bookmarks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            question_id INTEGER NOT NULL,
+            subject TEXT NOT NULL,
+            topic TEXT NOT NULL,
+            source_database TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, question_id, source_database)
+        )
+    ''')
+    conn.commit()
+    conn.close()
+
+
+def create_content_database(path, rows=20000):
+    """qbank look-alike with enough rows to make reads do real work"""
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE qbank (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            subject TEXT, chapter TEXT, topic TEXT, question TEXT, answer TEXT
+        )
+    ''')
+    conn.executemany(
+        'INSERT INTO qbank (subject, chapter, topic, question, answer) VALUES (?, ?, ?, ?, ?)',
+        [(f'Subject {i % 12}', f'Chapter {i % 40}', f'Topic {i % 400}', 'Q' * 200, 'A' * 800)
+         for i in range(rows)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def open_connection(path, pragmas, readonly=False):
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    if pragmas:
+        apply_pragma_profile(conn, pragmas, readonly)
+    return conn
+
+
+def run_mixed_load(user_db, pragmas, seconds, writers, readers):
+    """Writers insert+commit single bookmarks while readers query the same file"""
+    stop = threading.Event()
+    counts = {'writes': 0, 'reads': 0, 'busy_errors': 0}
+    lock = threading.Lock()
+
+    def writer(worker_id):
+        conn = open_connection(user_db, pragmas)
+        n = 0
+        while not stop.is_set():
+            try:
+                conn.execute(
+                    'INSERT OR IGNORE INTO user_bookmarks (user_id, question_id, subject, topic, source_database) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (worker_id, n, 'Anatomy', 'Kidney', 'bench.db'))
+                conn.commit()
+                n += 1
+            except sqlite3.OperationalError:
+                with lock:
+                    counts['busy_errors'] += 1
+        conn.close()
+        with lock:
+            counts['writes'] += n
+
+    def reader(worker_id):
+        conn = open_connection(user_db, pragmas, readonly=True)
+        n = 0
+        while not stop.is_set():
+            try:
+                conn.execute('SELECT COUNT(*) FROM user_bookmarks WHERE user_id = ?',
+                             (random.randrange(writers),)).fetchone()
+                n += 1
+            except sqlite3.OperationalError:
+                with lock:
+                    counts['busy_errors'] += 1
+        conn.close()
+        with lock:
+            counts['reads'] += n
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    threads += [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return {key: value / seconds if key != 'busy_errors' else value for key, value in counts.items()}
+
+
+def run_content_reads(content_db, pragmas, seconds, readers):
+    """Topic-page style reads against a qbank copy"""
+    stop = threading.Event()
+    total = [0]
+    lock = threading.Lock()
+
+    def reader():
+        conn = open_connection(content_db, pragmas, readonly=True)
+        n = 0
+        while not stop.is_set():
+            topic = f'Topic {random.randrange(400)}'
+            conn.execute('SELECT id, question, answer FROM qbank WHERE topic = ? ORDER BY id',
+                         (topic,)).fetchall()
+            n += 1
+        conn.close()
+        with lock:
+            total[0] += n
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return total[0] / seconds
+
+
+def bench_pragmas(args):
+    """Compare default SQLite settings against the write_heavy / read_heavy profiles"""
+    workdir = tempfile.mkdtemp(prefix='db_bench_')
+    try:
+        content_template = os.path.join(workdir, 'content_template.db')
+        create_content_database(content_template)
+
+        print(f"Mixed user-DB load: {args.writers} writers + {args.readers} readers, {args.seconds}s each")
+        for label, pragmas in (('default (rollback journal)', {}),
+                               ('write_heavy profile', DEFAULT_PRAGMA_PROFILES['write_heavy'])):
+            user_db = os.path.join(workdir, f"users_{label.split()[0]}.db")
+            create_user_database(user_db)
+            result = run_mixed_load(user_db, pragmas, args.seconds, args.writers, args.readers)
+            print(f"  {label:28s} writes/s={result['writes']:9.1f}  reads/s={result['reads']:10.1f}  "
+                  f"busy errors={result['busy_errors']}")
+
+        print(f"\nContent reads: {args.readers} readers, {args.seconds}s each")
+        for label, pragmas in (('default', {}),
+                               ('read_heavy profile', DEFAULT_PRAGMA_PROFILES['read_heavy'])):
+            content_db = os.path.join(workdir, f"content_{label.split()[0]}.db")
+            shutil.copy(content_template, content_db)
+            reads = run_content_reads(content_db, pragmas, args.seconds, args.readers)
+            print(f"  {label:28s} reads/s={reads:10.1f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _sharded_writer(shard_files, pragmas, hold, worker_id, start_at, stop_at, results):
+    # A separate process per writer, like separate app server workers
+    conns = [open_connection(path, pragmas) for path in shard_files]
+    rng = random.Random(worker_id)
+    n = errors = 0
+    while time.time() < start_at:
+        time.sleep(0.001)
+    while time.time() < stop_at:
+        user_id = rng.randrange(100000)
+        conn = conns[shard_index(user_id, len(conns))]
+        try:
+            conn.execute(
+                'INSERT OR IGNORE INTO user_bookmarks (user_id, question_id, subject, topic, source_database) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (user_id, worker_id * 10000000 + n, 'Anatomy', 'Kidney', 'bench.db'))
+            if hold:
+                time.sleep(hold)  # the shard's write lock is held until commit
+            conn.commit()
+            n += 1
+        except sqlite3.OperationalError:
+            conn.rollback()
+            errors += 1
+    for conn in conns:
+        conn.close()
+    results.put((n, errors))
+
+
+def run_sharded_writes(shard_files, pragmas, seconds, writers, hold_ms=0):
+    """Writer processes bookmark for random users, each write routed to its user's shard"""
+    results = multiprocessing.Queue()
+    start_at = time.time() + 1.0  # let every process open its connections first
+    processes = [multiprocessing.Process(target=_sharded_writer,
+                                         args=(shard_files, pragmas, hold_ms / 1000.0, i, start_at,
+                                               start_at + seconds, results))
+                 for i in range(writers)]
+    for p in processes:
+        p.start()
+    totals = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+    return sum(n for n, _ in totals) / seconds, sum(errors for _, errors in totals)
+
+
+def bench_shards(args):
+    """Concurrent user-activity write throughput as the number of user shards grows"""
+    pragmas = dict(DEFAULT_PRAGMA_PROFILES['write_heavy'], synchronous=args.synchronous)
+    workdir = tempfile.mkdtemp(prefix='db_bench_')
+    try:
+        print(f"Sharded user writes: {args.writers} writer processes, {args.seconds}s each, "
+              f"write_heavy profile with synchronous={args.synchronous}, "
+              f"write lock held {args.hold_ms}ms per transaction")
+        baseline = None
+        for shard_count in args.counts:
+            shard_files = [os.path.join(workdir, f'shard_{i}_of_{shard_count}.db')
+                           for i in range(shard_count)]
+            for path in shard_files:
+                create_user_database(path)
+                open_connection(path, pragmas).close()  # switch to WAL before writers race for it
+            writes, busy_errors = run_sharded_writes(shard_files, pragmas, args.seconds,
+                                                     args.writers, args.hold_ms)
+            baseline = baseline or writes
+            print(f"  {shard_count:3d} shard(s)  writes/s={writes:9.1f}  "
+                  f"x{writes / baseline:4.2f}  busy errors={busy_errors}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run_login_storm(hasher, stored_hash, seconds, clients):
+    """Request threads verifying passwords back to back; latencies in ms"""
+    stop = threading.Event()
+    accepted, rejected = [], []
+    lock = threading.Lock()
+
+    def client():
+        ok_ms, busy_ms = [], []
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                hasher.verify(stored_hash, 'correct horse battery staple')
+                ok_ms.append((time.perf_counter() - started) * 1000)
+            except PasswordHashingBusy:
+                busy_ms.append((time.perf_counter() - started) * 1000)
+                time.sleep(0.05)  # the user sees the 503 page and retries
+        with lock:
+            accepted.extend(ok_ms)
+            rejected.extend(busy_ms)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return accepted, rejected
+
+
+def bench_logins(args):
+    """Login password checks under a storm: inline in request threads vs the bounded pool"""
+    method = args.method or PasswordHasher(workers=0).method
+    stored_hash = PasswordHasher(workers=0, method=method).hash('correct horse battery staple')
+    print(f"Login storm: {args.clients} concurrent logins, {args.seconds}s each, {method}")
+    for label, hasher in (('inline', PasswordHasher(workers=0, method=method)),
+                          (f'pool ({args.workers} workers, queue {args.max_queue})',
+                           PasswordHasher(workers=args.workers, max_queue=args.max_queue,
+                                          method=method))):
+        hasher.start()
+        accepted, rejected = run_login_storm(hasher, stored_hash, args.seconds, args.clients)
+        print(f"  {label:30s} logins/s={len(accepted) / args.seconds:7.1f}  "
+              f"p50={percentile(accepted, 50):7.1f}ms  p99={percentile(accepted, 99):7.1f}ms  "
+              f"rejected={len(rejected)} (p99 {percentile(rejected, 99):.1f}ms)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite throughput benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    pragmas = subparsers.add_parser('pragmas', help='PRAGMA profiles before/after')
+    pragmas.add_argument('--seconds', type=float, default=5)
+    pragmas.add_argument('--writers', type=int, default=4)
+    pragmas.add_argument('--readers', type=int, default=8)
+    pragmas.set_defaults(func=bench_pragmas)
+
+    shards = subparsers.add_parser('shards', help='write throughput by user shard count')
+    shards.add_argument('--seconds', type=float, default=5)
+    shards.add_argument('--writers', type=int, default=8)
+    shards.add_argument('--counts', type=int, nargs='+', default=[1, 2, 4, 8])
+    shards.add_argument('--synchronous', default='FULL', choices=['OFF', 'NORMAL', 'FULL'],
+                        help='FULL makes every commit wait for the disk, like a durable deployment')
+    shards.add_argument('--hold-ms', type=float, default=2.0,
+                        help='time each write transaction keeps the lock (request work, slow disks)')
+    shards.set_defaults(func=bench_shards)
+
+    logins = subparsers.add_parser('logins', help='login p50/p99 latency under concurrency')
+    logins.add_argument('--seconds', type=float, default=10)
+    logins.add_argument('--clients', type=int, default=16)
+    logins.add_argument('--workers', type=int, default=2)
+    logins.add_argument('--max-queue', type=int, default=8)
+    logins.add_argument('--method', default=None, help='werkzeug hash method (default: PASSWORD_HASH_METHOD)')
+    logins.set_defaults(func=bench_logins)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# db_schema.py - Schema SQL shared by dynamic_db_handler.py and migrations.py
+#
+# Plain constants only: importing this module opens no database and runs nothing.
+
+
+# Lookup indexes added to every qbank database; subject is matched case-insensitively
+QBANK_INDEXES = {
+    'idx_qbank_subject_chapter_topic':
+        'CREATE INDEX IF NOT EXISTS idx_qbank_subject_chapter_topic '
+        'ON qbank (subject COLLATE NOCASE, chapter, topic, id)',
+    'idx_qbank_subject_topic':
+        'CREATE INDEX IF NOT EXISTS idx_qbank_subject_topic '
+        'ON qbank (subject COLLATE NOCASE, topic, id)',
+}
+
+# Materialized outline of a qbank table: one row per (subject, chapter, topic), kept
+# current by the triggers below. A NULL chapter is stored as ''; rows without a subject
+# or topic are not cataloged. ordinal is the (chapter, topic) position within the subject.
+CATALOG_TOPICS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS catalog_topics (
+        subject TEXT NOT NULL COLLATE NOCASE,
+        chapter TEXT NOT NULL DEFAULT '',
+        topic TEXT NOT NULL,
+        question_count INTEGER NOT NULL DEFAULT 0,
+        first_id INTEGER,
+        ordinal INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (subject, chapter, topic)
+    ) WITHOUT ROWID
+'''
+
+CATALOG_TOPICS_BUILD = '''
+    INSERT INTO catalog_topics (subject, chapter, topic, question_count, first_id, ordinal)
+    SELECT subject, chapter, topic, question_count, first_id,
+           ROW_NUMBER() OVER (PARTITION BY subject COLLATE NOCASE ORDER BY chapter, topic)
+    FROM (
+        SELECT subject, COALESCE(chapter, '') as chapter, topic,
+               COUNT(*) as question_count, MIN(id) as first_id
+        FROM qbank
+        WHERE subject IS NOT NULL AND topic IS NOT NULL
+        GROUP BY subject COLLATE NOCASE, COALESCE(chapter, ''), topic
+    )
+'''
+
+_CATALOG_KEY = "subject = {row}.subject AND chapter = COALESCE({row}.chapter, '') AND topic = {row}.topic"
+
+# Ordinals only move when a (chapter, topic) appears or disappears, hence the guard
+_CATALOG_RENUMBER = '''
+    UPDATE catalog_topics SET ordinal = numbered.ordinal
+    FROM (SELECT chapter, topic, ROW_NUMBER() OVER (ORDER BY chapter, topic) AS ordinal
+          FROM catalog_topics WHERE subject = {row}.subject) AS numbered
+    WHERE catalog_topics.subject = {row}.subject
+      AND catalog_topics.chapter = numbered.chapter
+      AND catalog_topics.topic = numbered.topic
+      AND {guard};
+'''
+
+_CATALOG_ADD = '''
+    INSERT INTO catalog_topics (subject, chapter, topic, question_count, first_id)
+    SELECT NEW.subject, COALESCE(NEW.chapter, ''), NEW.topic, 1, NEW.id
+    WHERE NEW.subject IS NOT NULL AND NEW.topic IS NOT NULL
+    ON CONFLICT (subject, chapter, topic) DO UPDATE
+        SET question_count = question_count + 1,
+            first_id = MIN(first_id, excluded.first_id);
+''' + _CATALOG_RENUMBER.format(
+    row='NEW',
+    guard=f"EXISTS (SELECT 1 FROM catalog_topics WHERE {_CATALOG_KEY.format(row='NEW')} AND question_count = 1)")
+
+_CATALOG_REMOVE = f'''
+    UPDATE catalog_topics
+    SET question_count = question_count - 1,
+        first_id = CASE WHEN first_id = OLD.id THEN (
+            SELECT MIN(id) FROM qbank
+            WHERE subject = OLD.subject COLLATE NOCASE AND topic = OLD.topic
+              AND COALESCE(chapter, '') = COALESCE(OLD.chapter, '')
+        ) ELSE first_id END
+    WHERE {_CATALOG_KEY.format(row='OLD')};
+    DELETE FROM catalog_topics WHERE {_CATALOG_KEY.format(row='OLD')} AND question_count <= 0;
+''' + _CATALOG_RENUMBER.format(
+    row='OLD',
+    guard=f"NOT EXISTS (SELECT 1 FROM catalog_topics WHERE {_CATALOG_KEY.format(row='OLD')})")
+
+CATALOG_TRIGGERS = {
+    'catalog_topics_after_insert':
+        f'CREATE TRIGGER catalog_topics_after_insert AFTER INSERT ON qbank BEGIN {_CATALOG_ADD} END',
+    'catalog_topics_after_delete':
+        f'CREATE TRIGGER catalog_topics_after_delete AFTER DELETE ON qbank BEGIN {_CATALOG_REMOVE} END',
+    'catalog_topics_after_update':
+        'CREATE TRIGGER catalog_topics_after_update AFTER UPDATE OF id, subject, chapter, topic ON qbank '
+        'WHEN OLD.id IS NOT NEW.id OR OLD.subject IS NOT NEW.subject '
+        'OR OLD.chapter IS NOT NEW.chapter OR OLD.topic IS NOT NEW.topic '
+        f'BEGIN {_CATALOG_REMOVE} {_CATALOG_ADD} END',
+}
+
+# Written by MCQ submissions into the user's activity database (created by migrations.py)
+MCQ_RESULTS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS mcq_results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        test_id INTEGER NOT NULL,
+        test_name TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        score INTEGER NOT NULL,
+        total_questions INTEGER NOT NULL,
+        percentage REAL NOT NULL,
+        time_taken_minutes INTEGER NOT NULL,
+        detailed_results TEXT,
+        completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+'''
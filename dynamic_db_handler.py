@@ -2,11 +2,401 @@
 import sqlite3
 import os
 import glob
-from flask import render_template, request, redirect, url_for, flash, jsonify, session
+import fnmatch
+from flask import render_template, request, redirect, url_for, flash, jsonify, session, g, has_app_context
 from datetime import datetime
 import shutil
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from types import MappingProxyType
+from urllib.parse import quote
 import traceback
+import json
+import re
 from werkzeug.utils import secure_filename
+from rate_limiter import rate_limiter
+from db_schema import MCQ_RESULTS_SCHEMA
+from migrations import (MIGRATIONS, mcq_missing_columns, migrate_connection, missing_mcq_columns,
+                        missing_qbank_structures, qbank_lookup_structures, table_exists)
+
+
+# Persistent disk holding the database files (override with DATA_DIR, e.g. for tests)
+DATA_DIR = os.environ.get('DATA_DIR', '/var/data')
+
+# Categories whose databases are served read-only unless a caller asks to write
+CONTENT_CATEGORIES = ('qbank', 'mcq')
+
+# Named PRAGMA profiles; each category in db_categories picks one via 'pragma_profile'.
+# Override or extend with DB_PRAGMA_PROFILES='{"read_heavy": {"cache_size": -64000}}'
+DEFAULT_PRAGMA_PROFILES = {
+    # Central user DB and test DBs: readers must not block on the writer during exam hours
+    'write_heavy': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 10000,
+    },
+    # Question content: mostly read, large page cache and memory-mapped I/O
+    'read_heavy': {
+        'cache_size': -32000,  # negative = KiB, i.e. ~32 MB
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+        'query_only': 'ON',
+    },
+}
+
+_PRAGMA_NAME_RE = re.compile(r'^[a-z_]+$')
+_PRAGMA_VALUE_RE = re.compile(r'^-?[A-Za-z0-9_]+$')
+
+
+def load_pragma_profiles():
+    """Default profiles merged with any JSON overrides from DB_PRAGMA_PROFILES"""
+    profiles = {name: dict(pragmas) for name, pragmas in DEFAULT_PRAGMA_PROFILES.items()}
+    overrides = os.environ.get('DB_PRAGMA_PROFILES')
+    if overrides:
+        try:
+            for name, pragmas in json.loads(overrides).items():
+                profiles.setdefault(name, {}).update(pragmas)
+        except (ValueError, AttributeError) as e:
+            print(f"⚠️  Ignoring invalid DB_PRAGMA_PROFILES: {e}")
+    return profiles
+
+
+def apply_pragma_profile(conn, pragmas, readonly=False):
+    """Apply a PRAGMA profile to a freshly opened connection"""
+    for name, value in pragmas.items():
+        # journal_mode needs write access; query_only would block the writers that asked for rw
+        if readonly and name == 'journal_mode':
+            continue
+        if not readonly and name == 'query_only':
+            continue
+        if not _PRAGMA_NAME_RE.match(name) or not _PRAGMA_VALUE_RE.match(str(value)):
+            print(f"⚠️  Skipping invalid pragma {name}={value}")
+            continue
+        try:
+            conn.execute(f"PRAGMA {name} = {value}").fetchall()
+        except sqlite3.Error as e:
+            print(f"⚠️  Could not apply PRAGMA {name}={value}: {e}")
+
+
+# User shards have no users table to point at (see get_user_shard_schema)
+USERS_FOREIGN_KEY_RE = re.compile(r',\s*FOREIGN KEY \(user_id\) REFERENCES users \(id\)')
+
+# Hot per-request content queries. Compare subject with COLLATE NOCASE, never LOWER(subject),
+# or the indexes can't be used; verify_qbank_query_plans() guards against that.
+QBANK_QUERIES = {
+    # (chapter, topic, questions in the whole topic) - a topic can span several chapters
+    'subject_outline': '''
+        SELECT chapter, topic, question_count FROM (
+            SELECT chapter, topic, ordinal,
+                   SUM(question_count) OVER (PARTITION BY topic) as question_count
+            FROM catalog_topics
+            WHERE subject = ? COLLATE NOCASE
+        )
+        WHERE chapter != '' AND topic != ''
+        ORDER BY ordinal
+    ''',
+    'subject_topics_ordered': '''
+        SELECT topic FROM catalog_topics
+        WHERE subject = ? COLLATE NOCASE AND topic != '' AND topic != 'None'
+        ORDER BY ordinal
+    ''',
+    'topic_question_ids': '''
+        SELECT id FROM qbank
+        WHERE subject = ? COLLATE NOCASE AND topic = ?
+        ORDER BY id
+    ''',
+    'topic_first_question': '''
+        SELECT first_id as id FROM catalog_topics
+        WHERE subject = ? COLLATE NOCASE AND topic = ?
+        ORDER BY first_id LIMIT 1
+    ''',
+}
+
+_SCAN_QBANK_RE = re.compile(r'^SCAN (qbank|catalog_topics)\b')
+
+
+class QueryPlanError(Exception):
+    """A hot content query would fall back to a full table scan"""
+
+
+def verify_qbank_query_plans(conn):
+    """EXPLAIN QUERY PLAN every hot content query; raise QueryPlanError on any full scan"""
+    regressions = []
+    for name, sql in QBANK_QUERIES.items():
+        params = ('',) * sql.count('?')
+        for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall():
+            detail = row[3]
+            if _SCAN_QBANK_RE.match(detail):
+                regressions.append(f"{name}: {detail}")
+    if regressions:
+        raise QueryPlanError("qbank queries regressed to full scans - " + '; '.join(regressions))
+
+
+class PooledConnection:
+    """Proxy around a pooled sqlite3 connection; close() returns it to the pool"""
+
+    def __init__(self, pool, conn):
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_released', False)
+        # Request-scoped connections ignore close(); the teardown handler releases them
+        object.__setattr__(self, '_request_scoped', False)
+
+    def __getattr__(self, name):
+        if self._released:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        # e.g. callers that set row_factory themselves
+        setattr(self._conn, name, value)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._conn.__exit__(*exc_info)
+
+    def close(self):
+        """Hand the connection back to its pool instead of closing it"""
+        if not self._request_scoped:
+            self._release()
+
+    def _release(self):
+        if not self._released:
+            object.__setattr__(self, '_released', True)
+            self._pool.release(self._conn)
+
+    def __del__(self):
+        # Safety net for code paths that return early without close()
+        try:
+            self._release()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """Bounded pool of sqlite3 connections to a single database file"""
+
+    def __init__(self, db_file, readonly=False, max_size=8, timeout=10.0,
+                 health_check_interval=30.0, pragmas=None, profile=None):
+        self.db_file = db_file
+        self.readonly = readonly
+        self.pragmas = pragmas or {}
+        self.profile = profile
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.pid = os.getpid()
+        self._idle = []  # [(conn, last_used)]
+        self._size = 0   # idle + checked out
+        self._cond = threading.Condition()
+        self.stats = {
+            'created': 0, 'checkouts': 0, 'waits': 0, 'timeouts': 0,
+            'discarded': 0, 'total_wait_ms': 0.0, 'max_wait_ms': 0.0
+        }
+
+    def _connect(self):
+        """Open a new connection with per-connection setup done once"""
+        if not os.path.exists(self.db_file):
+            raise FileNotFoundError(f"Database file {self.db_file} not found")
+        
+        if self.readonly:
+            uri = f"file:{quote(os.path.abspath(self.db_file))}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # Enable foreign keys
+        conn.execute("PRAGMA foreign_keys = ON")
+        apply_pragma_profile(conn, self.pragmas, self.readonly)
+        self.stats['created'] += 1
+        return conn
+
+    def _is_healthy(self, conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self.stats['discarded'] += 1
+            self._cond.notify()
+
+    def acquire(self):
+        """Check out a connection, waiting up to timeout seconds if the pool is full"""
+        start = time.monotonic()
+        conn = None
+        last_used = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise sqlite3.OperationalError(
+                        f"Connection pool for {self.db_file} exhausted after {self.timeout}s")
+                self.stats['waits'] += 1
+                self._cond.wait(remaining)
+            
+            wait_ms = (time.monotonic() - start) * 1000
+            self.stats['checkouts'] += 1
+            self.stats['total_wait_ms'] += wait_ms
+            self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], wait_ms)
+
+        # Health-check connections that sat idle for a while
+        if conn is not None and time.monotonic() - last_used > self.health_check_interval:
+            if not self._is_healthy(conn):
+                self._discard(conn)
+                with self._cond:
+                    self._size += 1
+                conn = None
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        """Return a connection, rolling back anything left uncommitted"""
+        if os.getpid() != self.pid:
+            # Inherited across fork: never reuse or close it in the child
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = sqlite3.Row
+        except Exception:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close_all(self):
+        """Close idle connections; checked-out ones are dropped when released"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self.max_size = 0
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+            stats['max_size'] = self.max_size
+            stats['readonly'] = self.readonly
+            stats['profile'] = self.profile
+        stats['avg_wait_ms'] = round(stats['total_wait_ms'] / stats['checkouts'], 3) if stats['checkouts'] else 0.0
+        return stats
+
+
+def file_signature(db_file):
+    """(mtime, size) of a database file and its WAL; changes whenever the content can have"""
+    signature = []
+    for path in (db_file, db_file + '-wal'):
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def find_question_position(id_list, qid):
+    """Index of qid in an ascending id sequence (None if absent)"""
+    index = bisect_left(id_list, qid)
+    if index < len(id_list) and id_list[index] == qid:
+        return index
+    return None
+
+
+class QuestionIdCache:
+    """LRU of ascending question-id arrays per (database, subject, topic) under a byte budget"""
+
+    ENTRY_OVERHEAD = 200  # key tuple, OrderedDict node, array header
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (signature, array('q'))
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0}
+
+    def _entry_size(self, ids):
+        return ids.itemsize * len(ids) + self.ENTRY_OVERHEAD
+
+    def get(self, key, signature):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            if entry[0] != signature:
+                # Source database changed since this array was loaded
+                self._bytes -= self._entry_size(self._entries.pop(key)[1])
+                self.stats['stale'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key, signature, ids):
+        size = self._entry_size(ids)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= self._entry_size(old[1])
+            self._entries[key] = (signature, ids)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= self._entry_size(evicted)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, db_path):
+        """Drop every cached topic of one database file"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == db_path]:
+                self._bytes -= self._entry_size(self._entries.pop(key)[1])
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+            stats['max_bytes'] = self.max_bytes
+        return stats
 
 
 class DynamicDatabaseHandler:
@@ -16,36 +406,80 @@ class DynamicDatabaseHandler:
                 'pattern': '*year*.db',
                 'description': 'Question Bank Databases',
                 'required_tables': ['qbank'],
-                'schema': self.get_qbank_schema()
+                'schema': self.get_qbank_schema(),
+                'pragma_profile': 'read_heavy'
             },
             'users': {
                 'pattern': 'admin_users.db',
                 'description': 'Centralized User Database',
                 'required_tables': ['users'],
-                'schema': self.get_centralized_user_schema()
+                'schema': self.get_centralized_user_schema(),
+                'pragma_profile': 'write_heavy'
+            },
+            # Per-user activity tables split by user_id hash (see user_shards.py)
+            'user_shards': {
+                'pattern': 'user_shard_*.db',
+                'description': 'User Activity Shards',
+                'required_tables': ['user_bookmarks'],
+                'schema': self.get_user_shard_schema(),
+                'pragma_profile': 'write_heavy'
             },
             'mcq': {
                 'pattern': '*mcq*.db',
                 'description': 'MCQ Databases',
                 'required_tables': ['mcq_questions'],
-                'schema': self.get_mcq_schema()
+                'schema': self.get_mcq_schema(),
+                'pragma_profile': 'read_heavy'
             },
             'admin': {
                 'pattern': 'admin*.db',
                 'description': 'Admin & System Data',
                 'required_tables': ['admin_actions'],
-                'schema': self.get_admin_schema()
+                'schema': self.get_admin_schema(),
+                'pragma_profile': 'write_heavy'
             },
             # ------ Add this block ------
             'test': {
                 'pattern': '*test*.db',
                 'description': 'Test Databases',
                 'required_tables': ['test_info', 'test_questions'],
-                'schema': self.get_test_schema()
+                'schema': self.get_test_schema(),
+                'pragma_profile': 'write_heavy'
             }
             # ------ End addition ------
         }
 
+        # Subject routing index: lowercased subject -> qbank database file
+        self.subject_index = {}
+        self.subject_index_stats = {'hits': 0, 'misses': 0, 'rebuilds': 0}
+        self._stats_lock = threading.Lock()
+
+        # Discovery snapshot: replaced wholesale, never mutated in place
+        self.discovery_interval = float(os.environ.get('DB_DISCOVERY_INTERVAL', 5))
+        self._snapshot = MappingProxyType({})
+        self._fingerprint = None  # until the first scan, see ensure_discovered
+        self._last_discovery_check = 0.0
+        self._discovery_lock = threading.Lock()
+        self.discovery_stats = {'checks': 0, 'rescans': 0, 'last_rescan': None}
+
+        # PRAGMA profiles applied to new connections per category
+        self.pragma_profiles = load_pragma_profiles()
+
+        # Per-file connection pools, rebuilt after a worker fork
+        self.pool_size = int(os.environ.get('DB_POOL_SIZE', 8))
+        self.pool_timeout = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        self._pools_pid = os.getpid()
+        self._inherited_pools = []  # parents' pools, see reset_pools_after_fork
+
+        # Per-file subject totals read from catalog_topics: path -> (file signature, rows)
+        self._subject_totals = {}
+
+        # Ordered question ids per topic for question/answer paging
+        self.question_id_cache = QuestionIdCache(
+            int(os.environ.get('QUESTION_ID_CACHE_BYTES', 8 * 1024 * 1024)))
+
     def get_test_schema(self):
         """Schema for test-type databases with subjects, topics, MCQs, and timing info"""
         return {
@@ -150,50 +584,380 @@ class DynamicDatabaseHandler:
             '''
         }
 
-        # Auto-discover databases on startup
-        self.discovered_databases = self.discover_databases()
-
     # Add the schema getter just below
     
+    def get_base_path(self):
+        """Directory that holds the database files"""
+        # 🔄 SCAN PERSISTENT DIRECTORY ONLY
+        base_path = DATA_DIR
+        if not os.path.exists(base_path):
+            print(f"⚠️  Persistent disk {DATA_DIR} not found - scanning current dir")
+            base_path = '.'
+        return base_path
+
     def discover_databases(self):
-    """Auto-discover databases from PERSISTENT /var/data"""
-    discovered = {}
-    
-    # 🔄 SCAN PERSISTENT DIRECTORY ONLY
-    base_path = '/var/data'
-    if not os.path.exists(base_path):
-        print(f"⚠️  Persistent disk /var/data not found - scanning current dir")
-        base_path = '.'
+        """Auto-discover databases from PERSISTENT /var/data"""
+        discovered = {}
+        base_path = self.get_base_path()
     
-    for category, config in self.db_categories.items():
-        discovered[category] = []
+        for category, config in self.db_categories.items():
+            discovered[category] = []
         
-        # Scan persistent directory
-        pattern = os.path.join(base_path, config['pattern'])
-        matching_files = glob.glob(pattern)
+            # Scan persistent directory
+            pattern = os.path.join(base_path, config['pattern'])
+            matching_files = glob.glob(pattern)
         
-        for db_file in matching_files:
-            if os.path.exists(db_file):
-                discovered[category].append({
-                    'file': db_file,
-                    'name': os.path.basename(os.path.splitext(db_file)[0]),
-                    'size': os.path.getsize(db_file),
-                    'modified': datetime.fromtimestamp(os.path.getmtime(db_file))
-                })
+            for db_file in matching_files:
+                if os.path.exists(db_file):
+                    discovered[category].append({
+                        'file': db_file,
+                        'name': os.path.basename(os.path.splitext(db_file)[0]),
+                        'size': os.path.getsize(db_file),
+                        'modified': datetime.fromtimestamp(os.path.getmtime(db_file))
+                    })
     
-    return discovered
+        return discovered
 
-    
-    def get_connection(self, db_file):
-        """Get connection to any database file with proper error handling"""
-        if not os.path.exists(db_file):
-            raise FileNotFoundError(f"Database file {db_file} not found")
+    @property
+    def discovered_databases(self):
+        """Current read-only discovery snapshot (re-validated at most once per interval)"""
+        self.ensure_discovered()
+        if time.monotonic() - self._last_discovery_check >= self.discovery_interval:
+            self.check_for_database_changes()
+        return self._snapshot
+
+    def _discovery_fingerprint(self, base_path, files):
+        """Names of the .db files in the directory plus a stat signature of every known one
+
+        Content files are compared by (mtime, size), since edits change the subject
+        index. User and test files are written all day and their WAL checkpoints would
+        look like changes, so only their identity (inode) counts; the same goes for the
+        -wal/-journal files coming and going, hence a name listing, not the dir mtime.
+        """
+        try:
+            names = tuple(sorted(name for name in os.listdir(base_path) if name.endswith('.db')))
+        except OSError:
+            names = None
         
-        conn = sqlite3.connect(db_file)
-        conn.row_factory = sqlite3.Row
-        # Enable foreign keys
-        conn.execute("PRAGMA foreign_keys = ON")
+        file_stats = []
+        for db_file in sorted(files):
+            try:
+                st = os.stat(db_file)
+            except OSError:
+                file_stats.append((db_file, None))
+                continue
+            if self.get_database_category(db_file) in CONTENT_CATEGORIES:
+                file_stats.append((db_file, (st.st_ino, st.st_mtime, st.st_size)))
+            else:
+                file_stats.append((db_file, (st.st_ino,)))
+        return (base_path, names, tuple(file_stats))
+
+    def _snapshot_files(self, snapshot):
+        """Unique database files referenced by a snapshot"""
+        return {db_info['file'] for databases in snapshot.values() for db_info in databases}
+
+    def check_for_database_changes(self):
+        """Rescan only if the data directory or a known file changed; returns True on rescan"""
+        # Only one thread checks at a time; the others keep reading the current snapshot
+        if not self._discovery_lock.acquire(blocking=False):
+            return False
+        try:
+            self._last_discovery_check = time.monotonic()
+            self.discovery_stats['checks'] += 1
+            fingerprint = self._discovery_fingerprint(self.get_base_path(),
+                                                      self._snapshot_files(self._snapshot))
+            if fingerprint == self._fingerprint:
+                return False
+            self._rescan()
+            return True
+        finally:
+            self._discovery_lock.release()
+
+    def _rescan(self):
+        """Full glob + stat scan, then atomically publish the new snapshot"""
+        discovered = self.discover_databases()
+        snapshot = MappingProxyType({
+            category: tuple(MappingProxyType(db_info) for db_info in databases)
+            for category, databases in discovered.items()
+        })
+        # Migrate before fingerprinting so the migration's own writes don't look like a change
+        for category in MIGRATIONS:
+            for db_info in snapshot.get(category, ()):
+                success, message = self.migrate_database(db_info['file'], category)
+                if not success:
+                    print(f"❌ {message}")
+        self._fingerprint = self._discovery_fingerprint(self.get_base_path(),
+                                                        self._snapshot_files(snapshot))
+        self._last_discovery_check = time.monotonic()
+        self._snapshot = snapshot
+        self.discovery_stats['rescans'] += 1
+        self.discovery_stats['last_rescan'] = datetime.now().isoformat()
+        self.build_subject_index()
+
+    def migrate_database(self, db_file, category=None):
+        """Apply pending schema migrations; qbank files also get their hot query plans checked"""
+        category = category or self.get_database_category(db_file)
+        # The file's PRAGMA user_version predates per-category versions; it can only be
+        # this category's if no other migrated category claims the file
+        migrated = [c for c in self.get_database_categories(db_file) if c in MIGRATIONS]
+        sole_category = migrated in ([], [category])
+        # Straight from the pool, not the request's connection: this must commit on its own
+        try:
+            conn = self._get_pool(db_file, readonly=False).acquire()
+        except Exception as e:
+            return False, f"Cannot open {db_file} for migration: {e}"
+
+        try:
+            # e.g. test_results.db matches *test*.db but holds no tests: nothing to migrate
+            required = self.db_categories.get(category, {}).get('required_tables', ())
+            missing = [table for table in required if not table_exists(conn, table)]
+            if missing:
+                return True, f"{db_file} has no {', '.join(missing)} table, not migrated as {category}"
+            applied = migrate_connection(conn, category, db_file, adopt_user_version=sole_category)
+            if category == 'qbank':
+                # Already migrated but an index or catalog trigger was dropped by hand
+                if not applied and missing_qbank_structures(conn):
+                    conn.execute('BEGIN IMMEDIATE')
+                    repaired = qbank_lookup_structures(conn)
+                    conn.commit()
+                    print(f"🔧 Repaired qbank schema of {db_file}: {', '.join(repaired)}")
+                verify_qbank_query_plans(conn)
+            elif category == 'mcq' and not applied and missing_mcq_columns(conn):
+                # A column dropped or a table recreated by hand after the migration ran
+                conn.execute('BEGIN IMMEDIATE')
+                repaired = mcq_missing_columns(conn)
+                conn.commit()
+                print(f"🔧 Repaired mcq schema of {db_file}: {', '.join(repaired)}")
+            return True, f"Schema of {db_file} is up to date"
+        except QueryPlanError as e:
+            return False, f"QUERY PLAN REGRESSION in {db_file}: {e}"
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.rollback()
+            return False, f"Schema migration failed for {db_file}: {e}"
+        finally:
+            conn.close()
+
+    def build_subject_index(self):
+        """Build the lowercased subject -> qbank database routing index"""
+        index = {}
+        for db_info in self._snapshot.get('qbank', ()):
+            db_file = db_info['file']
+            try:
+                conn = self.get_connection(db_file)
+                rows = conn.execute('''
+                    SELECT DISTINCT LOWER(subject) as subject
+                    FROM catalog_topics
+                ''').fetchall()
+                conn.close()
+            except Exception as e:
+                print(f"Error indexing subjects in {db_file}: {e}")
+                continue
+
+            for row in rows:
+                # First database wins, same as the old sequential scan
+                index.setdefault(row['subject'], db_file)
+
+        # Swap in the finished index in one assignment so readers never see a partial one
+        self.subject_index = index
+        with self._stats_lock:
+            self.subject_index_stats['rebuilds'] += 1
+        return index
+
+    def ensure_discovered(self):
+        """Run the first discovery scan unless one has already run; importing the module doesn't"""
+        if self._fingerprint is None:
+            with self._discovery_lock:
+                if self._fingerprint is None:
+                    self._rescan()
+
+    def refresh_databases(self):
+        """Force a re-scan of database files and rebuild the subject routing index"""
+        with self._discovery_lock:
+            self._rescan()
+
+    def lookup_subject_database(self, subject_name):
+        """O(1) lookup of the qbank database holding a subject (None if unknown)"""
+        self.ensure_discovered()
+        db_file = self.subject_index.get(subject_name.lower()) if subject_name else None
+        with self._stats_lock:
+            if db_file is None:
+                self.subject_index_stats['misses'] += 1
+            else:
+                self.subject_index_stats['hits'] += 1
+        return db_file
+
+    def get_subject_totals(self):
+        """{subject: [{'database', 'question_count', 'topic_count'}]} over every qbank database.
+
+        Each file's totals are cached until its signature changes.
+        """
+        all_subjects = {}
+        totals = {}
+        for db_info in self.discovered_databases.get('qbank', ()):
+            db_file = db_info['file']
+            signature = file_signature(db_file)
+            entry = self._subject_totals.get(db_file)
+            if entry is None or entry[0] != signature:
+                try:
+                    conn = self.get_connection(db_file)
+                    rows = conn.execute('''
+                        SELECT subject, SUM(question_count) as question_count,
+                               COUNT(DISTINCT topic) as topic_count
+                        FROM catalog_topics
+                        GROUP BY subject
+                        ORDER BY subject
+                    ''').fetchall()
+                    conn.close()
+                except Exception as e:
+                    print(f"Error reading subjects from {db_file}: {e}")
+                    continue
+                entry = (signature, tuple(tuple(row) for row in rows))
+            totals[db_file] = entry
+            
+            for subject, question_count, topic_count in entry[1]:
+                all_subjects.setdefault(subject, []).append({
+                    'database': db_file,
+                    'question_count': question_count,
+                    'topic_count': topic_count
+                })
+        
+        # Dropped databases fall out with the swap
+        self._subject_totals = totals
+        return all_subjects
+
+    def get_topic_question_ids(self, db_file, subject, topic):
+        """Ascending array('q') of a topic's question ids, cached until db_file changes"""
+        path = os.path.abspath(db_file)
+        key = (path, subject.lower(), topic)
+        # Taken before loading, so a write racing the load marks the entry stale
+        signature = file_signature(path)
+        ids = self.question_id_cache.get(key, signature)
+        if ids is None:
+            conn = self.get_connection(db_file)
+            rows = conn.execute(QBANK_QUERIES['topic_question_ids'], (subject, topic)).fetchall()
+            conn.close()
+            ids = array('q', (row['id'] for row in rows))
+            self.question_id_cache.put(key, signature, ids)
+        return ids
+
+    def get_subject_index_stats(self):
+        """Hit/miss counters and size of the subject routing index"""
+        self.ensure_discovered()
+        with self._stats_lock:
+            stats = dict(self.subject_index_stats)
+        stats['subjects'] = len(self.subject_index)
+        return stats
+
+    def get_database_categories(self, db_file):
+        """Every category whose filename pattern matches db_file, in configuration order"""
+        filename = os.path.basename(db_file)
+        return [category for category, config in self.db_categories.items()
+                if fnmatch.fnmatch(filename, config['pattern'])]
+
+    def get_database_category(self, db_file):
+        """Category whose filename pattern matches db_file (first match wins)"""
+        categories = self.get_database_categories(db_file)
+        return categories[0] if categories else None
+
+    def get_pragma_profile_name(self, db_file):
+        """Name of the PRAGMA profile configured for db_file's category"""
+        category = self.get_database_category(db_file)
+        if category is None:
+            return None
+        return self.db_categories[category].get('pragma_profile')
+
+    def get_connection(self, db_file, readonly=None):
+        """Get a pooled connection to any database file with proper error handling.
+
+        Content databases open read-only by default; pass readonly=False to write.
+        """
+        if readonly is None:
+            readonly = self.get_database_category(db_file) in CONTENT_CATEGORIES
+        if has_app_context():
+            return self._get_request_connection(db_file, readonly)
+        return self._get_pool(db_file, readonly).acquire()
+
+    def _get_request_connection(self, db_file, readonly):
+        """At most one connection per database file per request, kept on flask.g"""
+        connections = g.setdefault('_db_connections', {})
+        path = os.path.abspath(db_file)
+        conn = connections.get(path)
+        
+        # A read-write connection also serves readers; a read-only one can't serve writers
+        if conn is not None and (readonly or not conn._pool.readonly):
+            return conn
+        
+        if conn is not None:
+            # Keep the read-only one open until teardown: a caller may still be using it
+            g.setdefault('_db_retired_connections', []).append(conn)
+        conn = self._get_pool(db_file, readonly).acquire()
+        object.__setattr__(conn, '_request_scoped', True)
+        connections[path] = conn
+        g.db_connections_opened = g.get('db_connections_opened', 0) + 1
         return conn
+
+    def close_request_connections(self, exc=None):
+        """Teardown: roll back whatever the request left uncommitted and release its connections
+
+        Write paths commit explicitly; anything still pending here was left behind by
+        a helper that gave up half-way (and maybe swallowed the error), so it is dropped.
+        """
+        connections = list(g.pop('_db_connections', {}).values())
+        connections += g.pop('_db_retired_connections', [])
+        for conn in connections:
+            try:
+                if conn.in_transaction:
+                    print(f"⚠️ Rolling back uncommitted writes to {conn._pool.db_file}")
+                    conn.rollback()
+            except Exception as e:
+                print(f"Error finishing request transaction on {conn._pool.db_file}: {e}")
+            conn._release()
+
+    def _get_pool(self, db_file, readonly):
+        if os.getpid() != self._pools_pid:
+            self.reset_pools_after_fork()
+        
+        key = (os.path.abspath(db_file), readonly)
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._pools_lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    profile = self.get_pragma_profile_name(db_file)
+                    pool = ConnectionPool(db_file, readonly=readonly,
+                                          max_size=self.pool_size,
+                                          timeout=self.pool_timeout,
+                                          pragmas=self.pragma_profiles.get(profile),
+                                          profile=profile)
+                    self._pools[key] = pool
+        return pool
+
+    def reset_pools_after_fork(self):
+        """Forget pools inherited from the parent process (SQLite handles must not cross a fork)"""
+        # Another parent thread may have held the lock at fork time: replace it, never wait on it
+        self._pools_lock = threading.Lock()
+        # Still referenced so garbage collection never closes the parent's handles from here
+        self._inherited_pools.append(self._pools)
+        self._pools = {}
+        self._pools_pid = os.getpid()
+
+    def close_pool(self, db_file):
+        """Close every pooled connection to db_file (before deleting or replacing it)"""
+        path = os.path.abspath(db_file)
+        with self._pools_lock:
+            keys = [key for key in self._pools if key[0] == path]
+            pools = [self._pools.pop(key) for key in keys]
+        for pool in pools:
+            pool.close_all()
+        self.question_id_cache.invalidate(path)
+
+    def get_pool_stats(self):
+        """Size and wait-time metrics for every connection pool in this process"""
+        return {
+            f"{path}{' (ro)' if readonly else ''}": pool.get_stats()
+            for (path, readonly), pool in list(self._pools.items())
+        }
     
     def safe_table_name(self, table_name):
         """Safely quote table names for SQL queries"""
@@ -267,7 +1031,8 @@ class DynamicDatabaseHandler:
                     source_database TEXT NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (id)
+                    FOREIGN KEY (user_id) REFERENCES users (id),
+                    UNIQUE(user_id, question_id, source_database)
                 )
             ''',
             'user_topic_completion': '''
@@ -299,6 +1064,14 @@ class DynamicDatabaseHandler:
             '''
         }
     
+    def get_user_shard_schema(self):
+        """Activity tables of a user shard; users stays central, so no foreign keys to it"""
+        schema = {table: USERS_FOREIGN_KEY_RE.sub('', create_sql)
+                  for table, create_sql in self.get_centralized_user_schema().items()
+                  if table != 'users'}
+        schema['mcq_results'] = USERS_FOREIGN_KEY_RE.sub('', MCQ_RESULTS_SCHEMA)
+        return schema
+    
     def get_mcq_schema(self):
         """Schema for MCQ-type databases"""
         return {
@@ -412,8 +1185,12 @@ class DynamicDatabaseHandler:
             conn.commit()
             conn.close()
             
-            # Refresh discovered databases
-            self.discovered_databases = self.discover_databases()
+            success, message = self.migrate_database(db_file, category)
+            if not success:
+                return False, message
+            
+            # Refresh discovered databases and subject routing
+            self.refresh_databases()
             
             return True, f"Database {db_file} created successfully"
         
@@ -463,8 +1240,15 @@ class DynamicDatabaseHandler:
             
             conn.close()
             
-            # Refresh discovered databases
-            self.discovered_databases = self.discover_databases()
+            # Content must get its indexes before anything routes to it
+            success, message = self.migrate_database(filename, category)
+            if not success:
+                self.close_pool(filename)
+                os.remove(filename)
+                return False, message
+            
+            # Refresh discovered databases and subject routing
+            self.refresh_databases()
             
             return True, f"Database {filename} uploaded successfully"
             
@@ -540,16 +1324,28 @@ class DynamicDatabaseHandler:
         except Exception as e:
             return False, f"Backup failed: {str(e)}"
     
-    def migrate_users_to_centralized_db(self):
-        """Migrate users from all QBank databases to centralized admin_users.db"""
+    def migrate_users_to_centralized_db(self, shard_router):
+        """Migrate users from all QBank databases to centralized admin_users.db
+
+        Bookmarks and notes go to each user's activity shard (see user_shards.py).
+        """
         try:
             # Create centralized user database if it doesn't exist
-            if not os.path.exists('admin_users.db'):
+            if not os.path.exists(shard_router.central_db_file):
                 success, message = self.add_new_database('users', 'centralized')
                 if not success:
                     return False, f"Failed to create centralized user database: {message}"
             
-            centralized_conn = self.get_connection('admin_users.db')
+            centralized_conn = shard_router.get_connection()
+            # One connection per shard file; with a single shard that is the central file
+            shard_conns = {os.path.abspath(shard_router.central_db_file): centralized_conn}
+            
+            def shard_conn(user_id):
+                path = os.path.abspath(shard_router.shard_file(user_id))
+                if path not in shard_conns:
+                    shard_conns[path] = shard_router.get_connection(user_id)
+                return shard_conns[path]
+            
             migration_count = 0
             
             # Migrate from all QBank databases
@@ -585,7 +1381,7 @@ class DynamicDatabaseHandler:
                         bookmarks = source_conn.execute('SELECT * FROM bookmarks').fetchall()
                         for bookmark in bookmarks:
                             try:
-                                centralized_conn.execute('''
+                                shard_conn(bookmark['user_id']).execute('''
                                     INSERT OR IGNORE INTO user_bookmarks 
                                     (user_id, question_id, subject, topic, source_database, created_at)
                                     VALUES (?, ?, ?, ?, ?, ?)
@@ -594,16 +1390,31 @@ class DynamicDatabaseHandler:
                             except Exception as e:
                                 print(f"Bookmark migration error: {e}")
                     
+                    # Migrate notes if they exist
+                    if self.table_exists(source_conn, 'user_notes'):
+                        notes = source_conn.execute('SELECT * FROM user_notes').fetchall()
+                        for note in notes:
+                            try:
+                                shard_conn(note['user_id']).execute('''
+                                    INSERT OR IGNORE INTO user_notes 
+                                    (user_id, question_id, note, source_database, created_at, updated_at)
+                                    VALUES (?, ?, ?, ?, ?, ?)
+                                ''', (note['user_id'], note['question_id'], note['note'],
+                                      db_file, note['created_at'], note['updated_at']))
+                            except Exception as e:
+                                print(f"Note migration error: {e}")
+                    
                     source_conn.close()
                     
                 except Exception as e:
                     print(f"Error migrating from {db_file}: {e}")
             
-            centralized_conn.commit()
-            centralized_conn.close()
+            for conn in shard_conns.values():
+                conn.commit()
+                conn.close()
             
-            # Refresh discovered databases
-            self.discovered_databases = self.discover_databases()
+            # Refresh discovered databases and subject routing
+            self.refresh_databases()
             
             return True, f"Successfully migrated {migration_count} user records to admin_users.db"
             
@@ -614,6 +1425,10 @@ class DynamicDatabaseHandler:
 # Global instance
 dynamic_db_handler = DynamicDatabaseHandler()
 
+# gunicorn forks workers after import: give each child fresh pools
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=dynamic_db_handler.reset_pools_after_fork)
+
 
 # CENTRALIZED USER MANAGEMENT FUNCTIONS
 def create_centralized_user_database():
@@ -621,90 +1436,44 @@ def create_centralized_user_database():
     return dynamic_db_handler.add_new_database('users', 'centralized')
 
 
-def migrate_all_users_to_centralized_db():
+def migrate_all_users_to_centralized_db(shard_router):
     """Migrate ALL users from ALL databases to admin_users.db"""
-    return dynamic_db_handler.migrate_users_to_centralized_db()
+    return dynamic_db_handler.migrate_users_to_centralized_db(shard_router)
 
 
 # INTEGRATION FUNCTIONS FOR APP.PY
 def get_all_qbank_subjects():
-    """Get all subjects from all discovered QBank databases"""
-    all_subjects = {}
-    
-    # Refresh discovery first
-    dynamic_db_handler.discovered_databases = dynamic_db_handler.discover_databases()
-    
-    # Get all QBank databases
-    qbank_databases = dynamic_db_handler.discovered_databases.get('qbank', [])
-    
-    for db_info in qbank_databases:
-        db_file = db_info['file']
-        try:
-            conn = dynamic_db_handler.get_connection(db_file)
-            
-            # Get subjects from this database
-            subjects = conn.execute('''
-                SELECT DISTINCT subject, COUNT(*) as question_count
-                FROM qbank 
-                GROUP BY subject 
-                ORDER BY subject
-            ''').fetchall()
-            
-            for subject_row in subjects:
-                subject = subject_row['subject']
-                if subject not in all_subjects:
-                    all_subjects[subject] = []
-                
-                all_subjects[subject].append({
-                    'database': db_file,
-                    'question_count': subject_row['question_count']
-                })
-            
-            conn.close()
-        except Exception as e:
-            print(f"Error reading subjects from {db_file}: {e}")
-    
-    return all_subjects
+    """Get all subjects from all discovered QBank databases (cached topic catalogs)"""
+    return dynamic_db_handler.get_subject_totals()
 
 
 def find_subject_database(subject_name):
     """Find which database contains a specific subject"""
-    # Refresh discovery
-    dynamic_db_handler.discovered_databases = dynamic_db_handler.discover_databases()
-    
-    qbank_databases = dynamic_db_handler.discovered_databases.get('qbank', [])
-    
-    for db_info in qbank_databases:
-        db_file = db_info['file']
-        try:
-            conn = dynamic_db_handler.get_connection(db_file)
-            
-            # Check if subject exists in this database
-            result = conn.execute('''
-                SELECT COUNT(*) as count 
-                FROM qbank 
-                WHERE LOWER(subject) = ?
-            ''', (subject_name.lower(),)).fetchone()
-            
-            conn.close()
-            
-            if result['count'] > 0:
-                return db_file
-        except Exception as e:
-            print(f"Error checking subject in {db_file}: {e}")
+    db_file = dynamic_db_handler.lookup_subject_database(subject_name)
+    if db_file:
+        return db_file
     
     # Default fallback
     return '1st_year.db'
 
 
-def register_dynamic_db_routes(app, ensure_user_session_func):
+def register_dynamic_db_routes(app, ensure_user_session_func, shard_router):
     """Register dynamic database management routes with centralized user support"""
     
+    # One connection per database file per request, finished in teardown
+    app.teardown_appcontext(dynamic_db_handler.close_request_connections)
+    
+    @app.after_request
+    def add_db_connection_count(response):
+        """Expose how many connections this request opened, for verification"""
+        response.headers['X-DB-Connections-Opened'] = str(g.get('db_connections_opened', 0))
+        return response
+    
     @app.route('/admin/dynamic_db_manager')
     def dynamic_db_home():
         """Main dynamic database manager interface"""
-        # Refresh database discovery
-        dynamic_db_handler.discovered_databases = dynamic_db_handler.discover_databases()
+        # Pick up any files added or removed outside the admin routes
+        dynamic_db_handler.check_for_database_changes()
         
         # Get stats for each discovered database
         db_stats = {}
@@ -773,9 +1542,10 @@ def register_dynamic_db_routes(app, ensure_user_session_func):
                              categories=dynamic_db_handler.db_categories)
     
     @app.route('/admin/migrate_users')
+    @rate_limiter.limit('admin_migrate_users')
     def migrate_users():
         """Migrate users from all databases to centralized admin_users.db"""
-        success, message = dynamic_db_handler.migrate_users_to_centralized_db()
+        success, message = dynamic_db_handler.migrate_users_to_centralized_db(shard_router)
         
         if success:
             flash(message, 'success')
@@ -910,7 +1680,7 @@ def register_dynamic_db_routes(app, ensure_user_session_func):
     def edit_database_record(db_file, table_name, record_id):
         """FIXED: Edit a specific record with robust error handling"""
         try:
-            conn = dynamic_db_handler.get_connection(db_file)
+            conn = dynamic_db_handler.get_connection(db_file, readonly=False)
             safe_name = dynamic_db_handler.safe_table_name(table_name)
             
             if request.method == 'POST':
@@ -947,6 +1717,10 @@ def register_dynamic_db_routes(app, ensure_user_session_func):
                     conn.commit()
                     flash('Record updated successfully!', 'success')
                     conn.close()
+                    
+                    # A qbank edit can introduce or remove a subject
+                    if table_name == 'qbank':
+                        dynamic_db_handler.build_subject_index()
                     return redirect(url_for('edit_database_table', db_file=db_file, table_name=table_name))
             
             # GET request - get record and schema
@@ -983,7 +1757,7 @@ def register_dynamic_db_routes(app, ensure_user_session_func):
     def add_database_record(db_file, table_name):
         """FIXED: Add a new record to a table"""
         try:
-            conn = dynamic_db_handler.get_connection(db_file)
+            conn = dynamic_db_handler.get_connection(db_file, readonly=False)
             safe_name = dynamic_db_handler.safe_table_name(table_name)
             
             if request.method == 'POST':
@@ -1021,6 +1795,10 @@ def register_dynamic_db_routes(app, ensure_user_session_func):
                     conn.commit()
                     flash('Record added successfully!', 'success')
                     conn.close()
+                    
+                    # A qbank edit can introduce or remove a subject
+                    if table_name == 'qbank':
+                        dynamic_db_handler.build_subject_index()
                     return redirect(url_for('edit_database_table', db_file=db_file, table_name=table_name))
                 else:
                     flash('Please fill at least one field', 'error')
@@ -1040,7 +1818,20 @@ def register_dynamic_db_routes(app, ensure_user_session_func):
             flash(f'Error adding record: {str(e)}', 'error')
             return redirect(url_for('edit_database_table', db_file=db_file, table_name=table_name))
     
+    @app.route('/admin/db_metrics')
+    def db_metrics():
+        """Runtime metrics for database routing"""
+        if session.get('user_type') != 'admin':
+            return jsonify({'success': False, 'message': 'Admin access required'}), 403
+        return jsonify({
+            'subject_index': dynamic_db_handler.get_subject_index_stats(),
+            'discovery': dict(dynamic_db_handler.discovery_stats),
+            'pools': dynamic_db_handler.get_pool_stats(),
+            'question_id_cache': dynamic_db_handler.question_id_cache.get_stats()
+        })
+    
     @app.route('/admin/database_backup')
+    @rate_limiter.limit('admin_backup')
     def backup_all_databases():
         """Backup all discovered databases"""
         success, message = dynamic_db_handler.backup_all_databases()
@@ -1068,10 +1859,11 @@ def register_dynamic_db_routes(app, ensure_user_session_func):
                 shutil.copy2(db_file, os.path.join(backup_dir, os.path.basename(db_file)))
                 
                 # Delete the database
+                dynamic_db_handler.close_pool(db_file)
                 os.remove(db_file)
                 
-                # Refresh discovered databases
-                dynamic_db_handler.discovered_databases = dynamic_db_handler.discover_databases()
+                # Refresh discovered databases and subject routing
+                dynamic_db_handler.refresh_databases()
                 
                 flash(f'Database {db_file} deleted successfully. Backup saved to {backup_dir}', 'success')
             else:
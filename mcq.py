@@ -5,33 +5,41 @@ from datetime import datetime, timedelta
 import json
 import random
 from dynamic_db_handler import dynamic_db_handler
+from rate_limiter import rate_limiter
 import os
 
 # 🔄 PERSISTENT STORAGE - RENDER DISK
-DATA_DIR = '/var/data'
+DATA_DIR = os.environ.get('DATA_DIR', '/var/data')
 os.makedirs(DATA_DIR, exist_ok=True)
 MCQ_DB_PATH = os.path.join(DATA_DIR, 'general_mcq.db')
 USER_DB_PATH = os.path.join(DATA_DIR, 'admin_users.db')
 
+# mcq_results rows live in each user's activity shard (see user_shards.py).
+# The app's router is handed over in register_mcq_routes so both share one layout.
+user_shards = None
+
 
 # Create MCQ Blueprint
 mcq_bp = Blueprint('mcq', __name__, url_prefix='/mcq')
 
 
 # MCQ Database Configuration
-def get_mcq_db_connection(subject=None):
-    """Get connection to appropriate MCQ database - PERSISTENT STORAGE"""
+def get_mcq_db_connection(subject=None, readonly=False):
+    """Get connection to appropriate MCQ database - PERSISTENT STORAGE
+
+    Pass readonly=True from pure read paths to use the read-only pool.
+    """
     if subject:
         # Find MCQ database for specific subject in /var/data
         mcq_databases = dynamic_db_handler.discovered_databases.get('mcq', [])
         for db_info in mcq_databases:
             db_file = db_info['file']
-            if subject.lower() in db_file.lower() and '/var/data' in db_file:
-                return dynamic_db_handler.get_connection(db_file)
+            if subject.lower() in db_file.lower() and DATA_DIR in db_file:
+                return dynamic_db_handler.get_connection(db_file, readonly=readonly)
     
     # Default to persistent MCQ database
     if os.path.exists(MCQ_DB_PATH):
-        return dynamic_db_handler.get_connection(MCQ_DB_PATH)
+        return dynamic_db_handler.get_connection(MCQ_DB_PATH, readonly=readonly)
     
     # Fallback: create default MCQ database in persistent storage
     return create_default_mcq_database()
@@ -39,9 +47,12 @@ def get_mcq_db_connection(subject=None):
     
 
 
-def get_user_db_connection():
-    """Get centralized user database connection - PERSISTENT"""
-    return dynamic_db_handler.get_connection(USER_DB_PATH)
+def get_user_db_connection(user_id=None):
+    """Get centralized user database connection - PERSISTENT
+
+    With a user_id: the shard holding that user's mcq_results.
+    """
+    return user_shards.get_connection(user_id)
 
 
 def create_default_mcq_database():
@@ -114,6 +125,12 @@ def ensure_user_session():
     return session.get('user_id')
 
 
+def migrate_mcq_database(conn):
+    """Apply the pending mcq migrations (missing columns, indexes) to the file behind conn"""
+    db_file = conn.execute('PRAGMA database_list').fetchone()['file']
+    return dynamic_db_handler.migrate_database(db_file, 'mcq')
+
+
 # --------------------
 # DEBUG FUNCTIONS
 # --------------------
@@ -166,27 +183,10 @@ def debug_mcq_database_schema():
         
         debug_output.append(f"\n🔍 Missing columns: {missing_columns if missing_columns else 'None'}")
         
-        # Fix missing columns
+        # Missing columns are added by the mcq migrations (see migrations.py)
         if missing_columns:
-            debug_output.append("\n🔧 Adding missing columns...")
-            
-            column_definitions = {
-                'topic_filter': 'TEXT',
-                'difficulty_filter': 'TEXT',
-                'created_by': 'INTEGER',
-                'is_public': 'INTEGER DEFAULT 1'
-            }
-            
-            for col in missing_columns:
-                if col in column_definitions:
-                    try:
-                        alter_sql = f"ALTER TABLE mcq_tests ADD COLUMN {col} {column_definitions[col]}"
-                        conn.execute(alter_sql)
-                        debug_output.append(f"  ✅ Added column: {col}")
-                    except sqlite3.OperationalError as e:
-                        debug_output.append(f"  ❌ Error adding {col}: {e}")
-            
-            conn.commit()
+            success, message = migrate_mcq_database(conn)
+            debug_output.append(f"\n{'🔧' if success else '❌'} {message}")
         
         # Test a simple query
         debug_output.append("\n🧪 Testing difficulty_filter column access...")
@@ -207,87 +207,8 @@ def debug_mcq_database_schema():
         return f"Debug error: {str(e)}"
 
 
-def fix_mcq_schema_immediately():
-    """Quick fix for missing difficulty_filter column"""
-    try:
-        conn = get_mcq_db_connection()
-        
-        # Try to add missing columns
-        missing_columns = [
-            "ALTER TABLE mcq_tests ADD COLUMN topic_filter TEXT",
-            "ALTER TABLE mcq_tests ADD COLUMN difficulty_filter TEXT", 
-            "ALTER TABLE mcq_tests ADD COLUMN created_by INTEGER",
-            "ALTER TABLE mcq_tests ADD COLUMN is_public INTEGER DEFAULT 1"
-        ]
-        
-        for sql in missing_columns:
-            try:
-                conn.execute(sql)
-                print(f"✅ Executed: {sql}")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" not in str(e):
-                    print(f"❌ Error: {e}")
-        
-        conn.commit()
-        conn.close()
-        return True
-        
-    except Exception as e:
-        print(f"Error fixing schema: {e}")
-        return False
-
-
-def fix_mcq_questions_schema():
-    """Fix missing columns in mcq_questions table"""
-    try:
-        conn = get_mcq_db_connection()
-        
-        # Add missing columns for mcq_questions table, including chapter
-        missing_columns = [
-            "ALTER TABLE mcq_questions ADD COLUMN chapter TEXT",
-            "ALTER TABLE mcq_questions ADD COLUMN year_of_question INTEGER",
-            "ALTER TABLE mcq_questions ADD COLUMN source TEXT",
-            "ALTER TABLE mcq_questions ADD COLUMN explanation TEXT",
-            "ALTER TABLE mcq_questions ADD COLUMN difficulty TEXT DEFAULT 'medium'"
-        ]
-        
-        for sql in missing_columns:
-            try:
-                conn.execute(sql)
-                print(f"✅ Executed: {sql}")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" not in str(e):
-                    print(f"❌ Error: {e}")
-                else:
-                    print(f"✅ Column already exists: {sql.split()[-2]}")
-        
-        conn.commit()
-        conn.close()
-        return True
-        
-    except Exception as e:
-        print(f"Error fixing mcq_questions schema: {e}")
-        return False
-
-
-def fix_mcq_database_schema():
-    """Fix missing difficulty_filter column"""
-    try:
-        conn = get_mcq_db_connection()
-        
-        # Try to add the missing column
-        conn.execute("ALTER TABLE mcq_tests ADD COLUMN difficulty_filter TEXT")
-        conn.commit()
-        conn.close()
-        print("✅ Added missing difficulty_filter column")
-        
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e):
-            print("✅ Column already exists")
-        else:
-            print(f"❌ Error: {e}")
 def get_mcq_chapters(subject):
-    conn = get_mcq_db_connection(subject)
+    conn = get_mcq_db_connection(subject, readonly=True)
     try:
         chapters_rows = conn.execute('''
             SELECT DISTINCT chapter
@@ -300,7 +221,7 @@ def get_mcq_chapters(subject):
         conn.close()
 
 def get_chapters_with_topics(subject):
-    conn = get_mcq_db_connection(subject)
+    conn = get_mcq_db_connection(subject, readonly=True)
     try:
         rows = conn.execute('''
             SELECT DISTINCT chapter, topic
@@ -348,7 +269,7 @@ def get_all_mcq_subjects():
 
 def get_mcq_topics(subject):
     """Get all topics for a specific subject"""
-    conn = get_mcq_db_connection(subject)
+    conn = get_mcq_db_connection(subject, readonly=True)
     try:
         topics = conn.execute('''
             SELECT DISTINCT topic, COUNT(*) as question_count
@@ -370,19 +291,12 @@ def get_mcq_topics(subject):
 @mcq_bp.route('/')
 def mcq_home():
     """MCQ Home page showing all subjects"""
-    # Auto-fix schema issues for both tables
-    try:
-        fix_mcq_schema_immediately()    # For tests table
-        fix_mcq_questions_schema()      # For questions table (NEW)
-    except Exception as e:
-        print(f"Schema fix error: {e}")
-    
     subjects = get_all_mcq_subjects()
     
     # Get question counts for each subject
     subject_stats = []
     for subject in subjects:
-        conn = get_mcq_db_connection(subject)
+        conn = get_mcq_db_connection(subject, readonly=True)
         try:
             stats = conn.execute('''
                 SELECT 
@@ -409,7 +323,7 @@ def mcq_home():
 def mcq_subject(subject_name):
     chapter_topics = get_chapters_with_topics(subject_name)
     
-    conn = get_mcq_db_connection(subject_name)
+    conn = get_mcq_db_connection(subject_name, readonly=True)
     try:
         tests = conn.execute('''
             SELECT id, test_name, total_questions, duration_minutes, difficulty_filter
@@ -434,7 +348,7 @@ def mcq_practice_topic(subject_name, topic_name):
         return redirect(url_for('login'))
     
     # Get questions for this topic
-    conn = get_mcq_db_connection(subject_name)
+    conn = get_mcq_db_connection(subject_name, readonly=True)
     try:
         questions = conn.execute('''
             SELECT * FROM mcq_questions 
@@ -464,7 +378,7 @@ def mcq_test(test_id):
         return redirect(url_for('login'))
     
     # Get test details
-    conn = get_mcq_db_connection()
+    conn = get_mcq_db_connection(readonly=True)
     try:
         test = conn.execute('SELECT * FROM mcq_tests WHERE id = ?', (test_id,)).fetchone()
         if not test:
@@ -502,7 +416,7 @@ def submit_mcq_test():
         time_taken = data.get('time_taken', 0)  # in minutes
         
         # Get test and questions
-        conn = get_mcq_db_connection()
+        conn = get_mcq_db_connection(readonly=True)
         
         test = conn.execute('SELECT * FROM mcq_tests WHERE id = ?', (test_id,)).fetchone()
         if not test:
@@ -540,31 +454,16 @@ def submit_mcq_test():
         percentage = (correct_answers / total_questions) * 100 if total_questions > 0 else 0
         
         # Save result to centralized user database
-        user_conn = get_user_db_connection()
+        # mcq_results is created by the startup migrations (migrations.py)
+        user_conn = get_user_db_connection(user_id)
         user_conn.row_factory = sqlite3.Row
         
-        # Create MCQ results table if it doesn't exist
-        user_conn.execute('''
-            CREATE TABLE IF NOT EXISTS mcq_results (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                test_id INTEGER NOT NULL,
-                test_name TEXT NOT NULL,
-                subject TEXT NOT NULL,
-                score INTEGER NOT NULL,
-                total_questions INTEGER NOT NULL,
-                percentage REAL NOT NULL,
-                time_taken_minutes INTEGER NOT NULL,
-                detailed_results TEXT,
-                completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
+        # A double-submitted test within the same second is stored once
         user_conn.execute('''
             INSERT INTO mcq_results 
             (user_id, test_id, test_name, subject, score, total_questions, percentage, time_taken_minutes, detailed_results)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, test_id, completed_at) DO NOTHING
         ''', (user_id, test_id, test['test_name'], test['subject'], 
               correct_answers, total_questions, percentage, time_taken, json.dumps(results)))
         
@@ -592,7 +491,7 @@ def mcq_results():
         flash('Please login to view results', 'info')
         return redirect(url_for('login'))
     
-    user_conn = get_user_db_connection()
+    user_conn = get_user_db_connection(user_id)
     user_conn.row_factory = sqlite3.Row
     
     try:
@@ -615,6 +514,7 @@ def mcq_results():
 
 
 @mcq_bp.route('/create_test', methods=['GET', 'POST'])
+@rate_limiter.limit('mcq_create_test', methods=('POST',))
 def create_mcq_test():
     """Create a new MCQ test"""
     user_id = ensure_user_session()
@@ -830,9 +730,8 @@ def debug_add_question():
             missing_cols = [col for col in required_cols if col not in columns]
             if missing_cols:
                 debug_info.append(f"❌ Missing table columns: {missing_cols}")
-                # Try to fix schema
-                fix_mcq_questions_schema()
-                debug_info.append("🔧 Attempted schema fix")
+                success, message = migrate_mcq_database(conn)
+                debug_info.append(f"{'🔧' if success else '❌'} {message}")
             
             # Test insert query
             debug_info.append("🧪 Attempting to insert question...")
@@ -999,25 +898,9 @@ def debug_mcq_questions_schema():
         if missing_columns:
             schema_info += f"\n❌ Missing columns: {missing_columns}\n"
             
-            # Fix missing columns
-            column_definitions = {
-                'chapter': 'TEXT',
-                'year_of_question': 'INTEGER',
-                'source': 'TEXT',
-                'explanation': 'TEXT',
-                'difficulty': 'TEXT DEFAULT \"medium\"'
-            }
-            
-            for col in missing_columns:
-                if col in column_definitions:
-                    try:
-                        alter_sql = f"ALTER TABLE mcq_questions ADD COLUMN {col} {column_definitions[col]}"
-                        conn.execute(alter_sql)
-                        schema_info += f"✅ Added column: {col}\n"
-                    except sqlite3.OperationalError as e:
-                        schema_info += f"❌ Error adding {col}: {e}\n"
-            
-            conn.commit()
+            # Added by the mcq migrations (see migrations.py)
+            success, message = migrate_mcq_database(conn)
+            schema_info += f"{'🔧' if success else '❌'} {message}\n"
         else:
             schema_info += "\n✅ All required columns present\n"
         
@@ -1036,6 +919,8 @@ def debug_mcq_questions_schema():
         return f"<h2>❌ Debug Error:</h2><p>{str(e)}</p>"
 
 
-def register_mcq_routes(app):
-    """Register MCQ blueprint with the Flask app"""
+def register_mcq_routes(app, shard_router):
+    """Register MCQ blueprint with the Flask app, sharing its user shard router"""
+    global user_shards
+    user_shards = shard_router
     app.register_blueprint(mcq_bp)
@@ -0,0 +1,613 @@
+# migrations.py - Versioned schema migrations for every database category
+#
+# Usage (deploy step; the app also runs them at startup):
+#   python migrations.py [--status]
+#
+# Each database records the last migration applied per category in schema_migrations
+# (a file such as mcq_test.db belongs to several), so a migration runs exactly once per
+# file, inside one transaction with its version bump.
+import argparse
+import sqlite3
+
+from db_schema import (CATALOG_TOPICS_BUILD, CATALOG_TOPICS_SCHEMA, CATALOG_TRIGGERS,
+                       MCQ_RESULTS_SCHEMA, QBANK_INDEXES)
+
+
+def table_exists(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (table,)).fetchone() is not None
+
+
+def table_columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def has_unique_key(conn, table, columns):
+    """True if a UNIQUE constraint or index covers exactly these columns, in this order"""
+    for index in conn.execute(f"PRAGMA index_list({table})").fetchall():
+        if not index[2]:  # not unique
+            continue
+        indexed = [row[2] for row in conn.execute(f"PRAGMA index_info({index[1]})")]
+        if indexed == list(columns):
+            return True
+    return False
+
+
+def add_missing_columns(conn, table, column_definitions):
+    """ALTER TABLE ... ADD COLUMN for each column the table lacks"""
+    if not table_exists(conn, table):
+        return []
+    existing = table_columns(conn, table)
+    added = []
+    for column, definition in column_definitions:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            added.append(column)
+    return added
+
+
+def add_unique_key(conn, table, name, columns, keep_order='id DESC'):
+    """Delete duplicate rows (keeping the first by keep_order) then add a unique index"""
+    if not table_exists(conn, table) or has_unique_key(conn, table, columns):
+        return 0
+    key = ', '.join(columns)
+    removed = conn.execute(f'''
+        DELETE FROM {table} WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY {keep_order}) as copy
+                FROM {table}
+            ) WHERE copy > 1
+        )
+    ''').rowcount
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table} ({key})")
+    if removed:
+        print(f"🧹 Removed {removed} duplicate rows from {table}")
+    return removed
+
+
+def create_index(conn, table, create_sql):
+    if table_exists(conn, table):
+        conn.execute(create_sql)
+
+
+# --------------------
+# CENTRALIZED USER DATABASE (admin_users.db)
+# --------------------
+def users_lookup_indexes(conn):
+    # Keyset pagination of a user's bookmarks, newest first (optionally per subject)
+    create_index(conn, 'user_bookmarks', '''
+        CREATE INDEX IF NOT EXISTS idx_user_bookmarks_user_created
+        ON user_bookmarks (user_id, created_at, id)
+    ''')
+    create_index(conn, 'user_bookmarks', '''
+        CREATE INDEX IF NOT EXISTS idx_user_bookmarks_user_subject_created
+        ON user_bookmarks (user_id, subject COLLATE NOCASE, created_at, id)
+    ''')
+
+
+def users_unique_keys(conn):
+    # Older databases were created without these constraints
+    add_unique_key(conn, 'user_bookmarks', 'ux_user_bookmarks_user_question_source',
+                   ('user_id', 'question_id', 'source_database'), keep_order='id')
+    # INSERT OR REPLACE never replaced anything here: keep each question's newest note
+    add_unique_key(conn, 'user_notes', 'ux_user_notes_user_question_source',
+                   ('user_id', 'question_id', 'source_database'),
+                   keep_order='updated_at DESC, id DESC')
+    conn.execute('DROP INDEX IF EXISTS idx_user_notes_user_question')  # same columns, now unique
+    add_unique_key(conn, 'user_topic_completion', 'ux_user_topic_completion_user_topic',
+                   ('user_id', 'subject', 'topic', 'source_database'), keep_order='id')
+
+
+def users_mcq_results(conn):
+    # Was created lazily by every MCQ submission
+    conn.execute(MCQ_RESULTS_SCHEMA)
+    # A double-clicked submit lands twice in the same second
+    add_unique_key(conn, 'mcq_results', 'ux_mcq_results_user_test_completed',
+                   ('user_id', 'test_id', 'completed_at'), keep_order='id')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_mcq_results_user_completed
+        ON mcq_results (user_id, completed_at)
+    ''')
+
+
+# Full-text index over note text. Every row also carries an owner token ('u<user_id>') so a
+# search intersects with one user's notes inside FTS instead of filtering afterwards.
+# The note text itself stays in user_notes; the view maps it into the index's columns.
+USER_NOTES_FTS = [
+    '''
+    CREATE VIEW IF NOT EXISTS user_notes_fts_source AS
+    SELECT id, note, 'u' || user_id AS owner FROM user_notes
+    ''',
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS user_notes_fts USING fts5(
+        note, owner,
+        content = 'user_notes_fts_source', content_rowid = 'id',
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_notes_fts_after_insert AFTER INSERT ON user_notes BEGIN
+        INSERT INTO user_notes_fts (rowid, note, owner) VALUES (NEW.id, NEW.note, 'u' || NEW.user_id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_notes_fts_after_delete AFTER DELETE ON user_notes BEGIN
+        INSERT INTO user_notes_fts (user_notes_fts, rowid, note, owner)
+        VALUES ('delete', OLD.id, OLD.note, 'u' || OLD.user_id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_notes_fts_after_update
+    AFTER UPDATE OF note, user_id ON user_notes BEGIN
+        INSERT INTO user_notes_fts (user_notes_fts, rowid, note, owner)
+        VALUES ('delete', OLD.id, OLD.note, 'u' || OLD.user_id);
+        INSERT INTO user_notes_fts (rowid, note, owner) VALUES (NEW.id, NEW.note, 'u' || NEW.user_id);
+    END
+    ''',
+]
+
+
+def users_notes_fts(conn):
+    if not table_exists(conn, 'user_notes'):
+        return
+    for create_sql in USER_NOTES_FTS:
+        conn.execute(create_sql)
+    # Index the notes written before the triggers existed
+    conn.execute("INSERT INTO user_notes_fts (user_notes_fts) VALUES ('rebuild')")
+
+
+# Per-user, per-subject progress kept current by triggers on user_topic_completion.
+# subject_topic_totals mirrors the qbank catalogs (synced by the app when content changes)
+# so a new progress row starts with the right total.
+USER_PROGRESS_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS subject_topic_totals (
+        subject TEXT NOT NULL COLLATE NOCASE,
+        source_database TEXT NOT NULL,
+        total_topics INTEGER NOT NULL,
+        PRIMARY KEY (subject, source_database)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS user_progress (
+        user_id INTEGER NOT NULL,
+        subject TEXT NOT NULL COLLATE NOCASE,
+        source_database TEXT NOT NULL,
+        completed_topics INTEGER NOT NULL DEFAULT 0,
+        total_topics INTEGER NOT NULL DEFAULT 0,
+        last_activity TIMESTAMP,
+        PRIMARY KEY (user_id, subject, source_database)
+    ) WITHOUT ROWID
+    ''',
+    # The same topic under another letter case of the subject is not counted twice
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_progress_after_completion
+    AFTER INSERT ON user_topic_completion
+    WHEN NOT EXISTS (SELECT 1 FROM user_topic_completion
+                     WHERE user_id = NEW.user_id AND LOWER(subject) = LOWER(NEW.subject)
+                       AND topic = NEW.topic AND source_database = NEW.source_database
+                       AND id != NEW.id)
+    BEGIN
+        INSERT INTO user_progress (user_id, subject, source_database, completed_topics,
+                                   total_topics, last_activity)
+        VALUES (NEW.user_id, NEW.subject, NEW.source_database, 1,
+                COALESCE((SELECT total_topics FROM subject_topic_totals
+                          WHERE subject = NEW.subject AND source_database = NEW.source_database), 0),
+                COALESCE(NEW.completed_at, CURRENT_TIMESTAMP))
+        ON CONFLICT (user_id, subject, source_database) DO UPDATE
+            SET completed_topics = completed_topics + 1, last_activity = excluded.last_activity;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_progress_after_uncompletion
+    AFTER DELETE ON user_topic_completion
+    WHEN NOT EXISTS (SELECT 1 FROM user_topic_completion
+                     WHERE user_id = OLD.user_id AND LOWER(subject) = LOWER(OLD.subject)
+                       AND topic = OLD.topic AND source_database = OLD.source_database)
+    BEGIN
+        UPDATE user_progress SET completed_topics = MAX(completed_topics - 1, 0)
+        WHERE user_id = OLD.user_id AND subject = OLD.subject
+          AND source_database = OLD.source_database;
+    END
+    ''',
+]
+
+
+def users_progress(conn):
+    if not table_exists(conn, 'user_topic_completion'):
+        return
+    for create_sql in USER_PROGRESS_SCHEMA:
+        conn.execute(create_sql)
+    conn.execute('''
+        INSERT OR REPLACE INTO user_progress (user_id, subject, source_database,
+                                              completed_topics, last_activity)
+        SELECT user_id, MIN(subject), source_database,
+               COUNT(DISTINCT topic), MAX(completed_at)
+        FROM user_topic_completion
+        GROUP BY user_id, LOWER(subject), source_database
+    ''')
+
+
+# --------------------
+# MCQ DATABASES
+# --------------------
+# Columns later versions of mcq.py expect in older MCQ databases
+MCQ_COLUMNS = {
+    'mcq_tests': [
+        ('topic_filter', 'TEXT'),
+        ('difficulty_filter', 'TEXT'),
+        ('created_by', 'INTEGER'),
+        ('is_public', 'INTEGER DEFAULT 1'),
+    ],
+    'mcq_questions': [
+        ('chapter', 'TEXT'),
+        ('year_of_question', 'INTEGER'),
+        ('source', 'TEXT'),
+        ('explanation', 'TEXT'),
+        ('difficulty', "TEXT DEFAULT 'medium'"),
+    ],
+}
+
+
+def missing_mcq_columns(conn):
+    """'table.column' for each MCQ_COLUMNS column an existing table lacks"""
+    missing = []
+    for table, column_definitions in MCQ_COLUMNS.items():
+        if table_exists(conn, table):
+            existing = table_columns(conn, table)
+            missing += [f'{table}.{column}' for column, _ in column_definitions if column not in existing]
+    return missing
+
+
+def mcq_missing_columns(conn):
+    # Formerly ALTER TABLE calls in mcq.py, run on every /mcq/ view
+    added = []
+    for table, column_definitions in MCQ_COLUMNS.items():
+        added += [f'{table}.{column}' for column in add_missing_columns(conn, table, column_definitions)]
+    return added
+
+
+def mcq_lookup_indexes(conn):
+    create_index(conn, 'mcq_questions', '''
+        CREATE INDEX IF NOT EXISTS idx_mcq_questions_subject_topic
+        ON mcq_questions (subject, topic)
+    ''')
+    create_index(conn, 'mcq_tests', '''
+        CREATE INDEX IF NOT EXISTS idx_mcq_tests_subject_public
+        ON mcq_tests (subject, is_public)
+    ''')
+    create_index(conn, 'mcq_test_questions', '''
+        CREATE INDEX IF NOT EXISTS idx_mcq_test_questions_test_order
+        ON mcq_test_questions (test_id, question_order)
+    ''')
+
+
+# --------------------
+# TEST DATABASES
+# --------------------
+USER_RESPONSES_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS user_responses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        test_id INTEGER NOT NULL,
+        user_id INTEGER,
+        question_id INTEGER NOT NULL,
+        user_answer TEXT,
+        is_correct INTEGER DEFAULT 0,
+        taken_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (test_id) REFERENCES test_info (id),
+        FOREIGN KEY (question_id) REFERENCES test_questions (id)
+    )
+'''
+
+# In-progress test attempts (attempt_store.py): one byte per question, bitsets for flags
+ATTEMPT_STATE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS test_attempt_state (
+        token TEXT PRIMARY KEY,
+        test_id INTEGER NOT NULL,
+        user_id INTEGER,
+        answers BLOB NOT NULL,
+        marked BLOB NOT NULL,
+        skipped BLOB NOT NULL,
+        version INTEGER NOT NULL DEFAULT 0,
+        updated_at REAL NOT NULL
+    )
+'''
+
+# test_papers.py caches each compiled test until its row here changes; the triggers
+# give a test a fresh random version whenever its info or any of its questions change
+TEST_PAPER_VERSIONS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS test_paper_versions (
+        test_id INTEGER PRIMARY KEY,
+        version INTEGER NOT NULL
+    )
+'''
+
+_BUMP_PAPER = 'INSERT OR REPLACE INTO test_paper_versions (test_id, version) VALUES ({}, random());'
+
+TEST_PAPER_TRIGGERS = {
+    'test_paper_question_insert':
+        f'CREATE TRIGGER test_paper_question_insert AFTER INSERT ON test_questions '
+        f'BEGIN {_BUMP_PAPER.format("NEW.test_id")} END',
+    'test_paper_question_delete':
+        f'CREATE TRIGGER test_paper_question_delete AFTER DELETE ON test_questions '
+        f'BEGIN {_BUMP_PAPER.format("OLD.test_id")} END',
+    'test_paper_question_update':
+        f'CREATE TRIGGER test_paper_question_update AFTER UPDATE ON test_questions '
+        f'BEGIN {_BUMP_PAPER.format("OLD.test_id")} {_BUMP_PAPER.format("NEW.test_id")} END',
+    'test_paper_info_insert':
+        f'CREATE TRIGGER test_paper_info_insert AFTER INSERT ON test_info '
+        f'BEGIN {_BUMP_PAPER.format("NEW.id")} END',
+    'test_paper_info_delete':
+        f'CREATE TRIGGER test_paper_info_delete AFTER DELETE ON test_info '
+        f'BEGIN {_BUMP_PAPER.format("OLD.id")} END',
+    'test_paper_info_update':
+        f'CREATE TRIGGER test_paper_info_update AFTER UPDATE ON test_info '
+        f'BEGIN {_BUMP_PAPER.format("OLD.id")} {_BUMP_PAPER.format("NEW.id")} END',
+}
+
+# One row per submitted attempt, graded once at submit; user_responses rows point at it
+TEST_ATTEMPTS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS test_attempts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        test_id INTEGER NOT NULL,
+        user_id INTEGER,
+        token TEXT UNIQUE,
+        total INTEGER NOT NULL,
+        correct INTEGER NOT NULL,
+        wrong INTEGER NOT NULL,
+        unanswered INTEGER NOT NULL,
+        submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (test_id) REFERENCES test_info (id)
+    )
+'''
+
+
+def test_responses_unique(conn):
+    # submit_test writes here even in test databases uploaded without the table
+    conn.execute(USER_RESPONSES_SCHEMA)
+    # Each submit used to append a full set of responses, multiplying review rows
+    add_unique_key(conn, 'user_responses', 'ux_user_responses_test_user_question',
+                   ('test_id', 'user_id', 'question_id'), keep_order='id DESC')
+    create_index(conn, 'test_questions', '''
+        CREATE INDEX IF NOT EXISTS idx_test_questions_test
+        ON test_questions (test_id, id)
+    ''')
+
+
+def test_attempt_state(conn):
+    # Attempt answers used to ride in the signed session cookie
+    conn.execute(ATTEMPT_STATE_SCHEMA)
+    create_index(conn, 'test_attempt_state', '''
+        CREATE INDEX IF NOT EXISTS idx_test_attempt_state_updated
+        ON test_attempt_state (updated_at)
+    ''')
+
+
+def test_paper_versions(conn):
+    if not (table_exists(conn, 'test_info') and table_exists(conn, 'test_questions')):
+        return
+    conn.execute(TEST_PAPER_VERSIONS_SCHEMA)
+    for name, create_sql in TEST_PAPER_TRIGGERS.items():
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.execute(create_sql)
+    conn.execute('''
+        INSERT OR IGNORE INTO test_paper_versions (test_id, version)
+        SELECT id, random() FROM test_info
+        UNION SELECT test_id, random() FROM test_questions
+    ''')
+
+
+def test_attempt_responses(conn):
+    conn.execute(USER_RESPONSES_SCHEMA)
+    conn.execute(TEST_ATTEMPTS_SCHEMA)
+    add_missing_columns(conn, 'user_responses',
+                        [('attempt_id', 'INTEGER REFERENCES test_attempts (id)')])
+    # Earlier submits kept one set of responses per user and test: make each set an attempt
+    conn.execute('''
+        INSERT INTO test_attempts (test_id, user_id, total, correct, wrong, unanswered, submitted_at)
+        SELECT test_id, user_id, COUNT(*),
+               SUM(is_correct = 1),
+               SUM(is_correct = 0 AND user_answer IS NOT NULL),
+               SUM(is_correct = 0 AND user_answer IS NULL),
+               MAX(taken_at)
+        FROM user_responses WHERE attempt_id IS NULL
+        GROUP BY test_id, user_id
+    ''')
+    conn.execute('''
+        UPDATE user_responses SET attempt_id = a.id
+        FROM test_attempts a
+        WHERE user_responses.attempt_id IS NULL AND a.token IS NULL
+          AND a.test_id = user_responses.test_id AND a.user_id IS user_responses.user_id
+    ''')
+    # A user may now submit the same test many times; answers are unique within an attempt
+    conn.execute('DROP INDEX IF EXISTS ux_user_responses_test_user_question')
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_user_responses_attempt_question
+        ON user_responses (attempt_id, question_id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_responses_test_user_attempt
+        ON user_responses (test_id, user_id, attempt_id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_test_attempts_test_user
+        ON test_attempts (test_id, user_id, id)
+    ''')
+
+
+# --------------------
+# QBANK DATABASES
+# --------------------
+def build_topic_catalog(conn):
+    """(Re)create catalog_topics and its maintenance triggers from the current qbank rows"""
+    # A partial install (e.g. a trigger dropped by hand) can't be trusted: rebuild it all
+    for trigger in CATALOG_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    conn.execute('DROP TABLE IF EXISTS catalog_topics')
+    conn.execute(CATALOG_TOPICS_SCHEMA)
+    conn.execute(CATALOG_TOPICS_BUILD)
+    for create_sql in CATALOG_TRIGGERS.values():
+        conn.execute(create_sql)
+
+
+def missing_qbank_structures(conn):
+    """Names of the lookup indexes missing, plus 'catalog_topics' if the catalog is incomplete"""
+    existing = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE tbl_name IN ('qbank', 'catalog_topics')")}
+    missing = [name for name in QBANK_INDEXES if name not in existing]
+    if not ({'catalog_topics', *CATALOG_TRIGGERS} <= existing):
+        missing.append('catalog_topics')
+    return missing
+
+
+def qbank_lookup_structures(conn):
+    """Create any missing lookup index and (re)build an incomplete topic catalog"""
+    missing = missing_qbank_structures(conn)
+    for name in missing:
+        if name == 'catalog_topics':
+            build_topic_catalog(conn)
+        else:
+            conn.execute(QBANK_INDEXES[name])
+    if missing:
+        conn.execute('ANALYZE')
+    return missing
+
+
+# category -> [(version, name, step)], versions strictly increasing
+MIGRATIONS = {
+    'users': [
+        (1, 'user lookup indexes', users_lookup_indexes),
+        (2, 'unique user state keys', users_unique_keys),
+        (3, 'mcq_results table', users_mcq_results),
+        (4, 'user notes full-text index', users_notes_fts),
+        (5, 'incremental user progress', users_progress),
+    ],
+    'mcq': [
+        (1, 'mcq missing columns', mcq_missing_columns),
+        (2, 'mcq lookup indexes', mcq_lookup_indexes),
+    ],
+    'test': [
+        (1, 'unique test responses', test_responses_unique),
+        (2, 'server-side attempt state', test_attempt_state),
+        (3, 'test paper versions', test_paper_versions),
+        (4, 'attempt-keyed test responses', test_attempt_responses),
+    ],
+    'qbank': [
+        (1, 'qbank indexes and topic catalog', qbank_lookup_structures),
+    ],
+}
+# User shard files (user_shards.py) hold the central database's activity tables
+MIGRATIONS['user_shards'] = MIGRATIONS['users']
+
+
+SCHEMA_MIGRATIONS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        category TEXT PRIMARY KEY,
+        version INTEGER NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+
+def schema_version(conn, category):
+    """Last migration applied to the file for this category (None if it has no record)"""
+    if not table_exists(conn, 'schema_migrations'):
+        return None
+    row = conn.execute('SELECT version FROM schema_migrations WHERE category = ?',
+                       (category,)).fetchone()
+    return row[0] if row else None
+
+
+def migrate_connection(conn, category, label='', adopt_user_version=False):
+    """Apply the category's pending migrations, each in its own transaction; returns names applied
+
+    Files migrated before schema_migrations existed kept one PRAGMA user_version for
+    all their categories. It is taken over only when adopt_user_version (the file
+    belongs to this category alone); otherwise every step runs again, as they are
+    idempotent.
+    """
+    applied = []
+    current = schema_version(conn, category)
+    if current is None:
+        current = conn.execute('PRAGMA user_version').fetchone()[0] if adopt_user_version else 0
+    for version, name, step in MIGRATIONS.get(category, ()):
+        if version <= current:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            step(conn)
+            conn.execute(SCHEMA_MIGRATIONS_SCHEMA)
+            conn.execute('''
+                INSERT INTO schema_migrations (category, version) VALUES (?, ?)
+                ON CONFLICT (category) DO UPDATE
+                    SET version = excluded.version, applied_at = CURRENT_TIMESTAMP
+            ''', (category, version))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(name)
+        print(f"🔧 Migrated {label or category} to v{version}: {name}")
+    return applied
+
+
+def migrate_all(extra_files=()):
+    """Migrate every discovered database plus extra (db_file, category) pairs"""
+    from dynamic_db_handler import dynamic_db_handler
+
+    targets = {}
+    for category in MIGRATIONS:
+        for db_info in dynamic_db_handler.discovered_databases.get(category, ()):
+            targets[db_info['file']] = category
+    for db_file, category in extra_files:
+        targets.setdefault(db_file, category)
+
+    results = []
+    for db_file, category in sorted(targets.items()):
+        success, message = dynamic_db_handler.migrate_database(db_file, category)
+        results.append((db_file, success, message))
+        if not success:
+            print(f"❌ {message}")
+    return results
+
+
+def migration_status():
+    """(db_file, category, version, latest) for every database on disk; applies nothing"""
+    from dynamic_db_handler import dynamic_db_handler
+
+    # A plain scan and read-only connections: discovered_databases would migrate the files
+    status = []
+    discovered = dynamic_db_handler.discover_databases()
+    for category in MIGRATIONS:
+        latest = MIGRATIONS[category][-1][0]
+        for db_info in sorted(discovered.get(category, ()), key=lambda db_info: db_info['file']):
+            conn = sqlite3.connect(f"file:{db_info['file']}?mode=ro", uri=True)
+            try:
+                version = schema_version(conn, category) or 0
+            finally:
+                conn.close()
+            status.append((db_info['file'], category, version, latest))
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply versioned schema migrations')
+    parser.add_argument('--status', action='store_true',
+                        help='only report each database version')
+    args = parser.parse_args()
+
+    if args.status:
+        for db_file, category, version, latest in migration_status():
+            state = 'up to date' if version >= latest else f'{latest - version} pending'
+            print(f"{db_file}: {category} v{version} ({state})")
+        return
+
+    results = migrate_all()
+    for db_file, success, message in results:
+        print(f"{'✅' if success else '❌'} {message}")
+    if not all(success for _, success, _ in results):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
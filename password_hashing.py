@@ -0,0 +1,200 @@
+# password_hashing.py - Password hashing in a bounded process pool, off the request threads
+import multiprocessing
+import os
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# werkzeug's own default; e.g. 'scrypt:65536:8:1' or 'pbkdf2:sha256:1000000' to change the cost
+DEFAULT_HASH_METHOD = 'scrypt:32768:8:1'
+
+# Set in the thread that is forking hash workers; the workers inherit it and so
+# don't start pools of their own from the after-fork hook
+_forking = threading.local()
+
+
+class PasswordHashingBusy(Exception):
+    """Every hashing slot is taken; answer 503 and let the user retry"""
+
+
+def hash_method_prefix(method):
+    """The method part werkzeug writes in front of a hash ('scrypt' -> 'scrypt:32768:8:1')"""
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+def verify_and_rehash(stored_hash, password, method, method_prefix):
+    """(password matches, new hash if the stored one was made with other parameters)"""
+    if not check_password_hash(stored_hash, password):
+        return False, None
+    if stored_hash.split('$', 1)[0] == method_prefix:
+        return True, None
+    return True, generate_password_hash(password, method)
+
+
+class PasswordHasher:
+    """Runs werkzeug's deliberately slow hash functions in a few worker processes.
+
+    At most workers + max_queue hashes are running or waiting; past that a call raises
+    PasswordHashingBusy at once instead of tying up another request thread. Every
+    process (e.g. each gunicorn worker) gets its own pool. workers=0 hashes inline.
+
+    Workers are forked as soon as a pool is made: by start() before the app has
+    background threads, and in each forked server worker by an after-fork hook, where
+    the forking thread is still the only one. Only a pool replacing one whose worker
+    died is forked later, from whichever request finds it gone.
+    """
+
+    def __init__(self, workers=None, max_queue=None, timeout=None, method=None):
+        if workers is None:
+            workers = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+        if max_queue is None:
+            max_queue = int(os.environ.get('PASSWORD_HASH_MAX_QUEUE', 8))
+        if timeout is None:
+            timeout = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.method = method or os.environ.get('PASSWORD_HASH_METHOD', DEFAULT_HASH_METHOD)
+        self.method_prefix = None
+        self._executor = None
+        self._pid = None
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self.stats = {'hashed': 0, 'verified': 0, 'rehashed': 0, 'rejected': 0,
+                      'timeouts': 0, 'pool_restarts': 0}
+        hasher = weakref.ref(self)
+        os.register_at_fork(after_in_child=lambda: hasher() and hasher()._after_fork_in_child())
+
+    def start(self):
+        """Start the pool now, while the process has no background threads to fork"""
+        try:
+            self.method_prefix = self._run(hash_method_prefix, self.method)
+        except PasswordHashingBusy as e:
+            print(f"⚠️  Password hashing pool not started, retrying on first login: {e}")
+            return
+        print(f"✅ Password hashing: {self.workers} worker(s), {self.method_prefix}")
+
+    def stop(self):
+        """Shut the pool down; the next hash starts a new one"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    def _after_fork_in_child(self):
+        # The parent's pool and lock belong to the parent; a hash worker itself has no pool
+        had_pool = self._executor is not None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._inflight = 0
+        if had_pool and not getattr(_forking, 'active', False):
+            try:
+                self._get_executor()
+            except Exception as e:
+                print(f"⚠️  Password hashing pool not restarted after fork: {e}")
+
+    def _get_executor(self):
+        # A pool inherited across a fork can't be used; make a new one
+        if self._executor is None or self._pid != os.getpid():
+            executor = ProcessPoolExecutor(self.workers,
+                                           mp_context=multiprocessing.get_context('fork'))
+            # Fork every worker now (the fork context starts them all on the first submit)
+            _forking.active = True
+            try:
+                executor.submit(int).result()
+            except Exception:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+            finally:
+                _forking.active = False
+            self._executor = executor
+            self._pid = os.getpid()
+            self._inflight = 0
+        return self._executor
+
+    def _release(self, future=None):
+        with self._lock:
+            self._inflight -= 1
+
+    def _run(self, func, *args):
+        if self.workers <= 0:
+            return func(*args)
+        with self._lock:
+            try:
+                executor = self._get_executor()
+            except (BrokenProcessPool, OSError) as e:
+                raise PasswordHashingBusy(f'Password hashing pool unavailable: {e}')
+            if self._inflight >= self.workers + self.max_queue:
+                self.stats['rejected'] += 1
+                raise PasswordHashingBusy('Too many password checks in progress')
+            self._inflight += 1
+        try:
+            future = executor.submit(func, *args)
+        except (BrokenProcessPool, RuntimeError) as e:
+            self._release()
+            self._discard(executor)
+            raise PasswordHashingBusy(f'Password hashing pool unavailable: {e}')
+        # The slot frees when the hash really finishes, even if this caller gave up
+        future.add_done_callback(self._release)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            self.stats['timeouts'] += 1
+            raise PasswordHashingBusy('Password check timed out')
+        except BrokenProcessPool as e:
+            self._discard(executor)
+            raise PasswordHashingBusy(f'Password hashing pool unavailable: {e}')
+
+    def _discard(self, executor):
+        # A worker died (e.g. OOM-killed); the next call starts a fresh pool
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+                self.stats['pool_restarts'] += 1
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def hash(self, password):
+        """New hash with the configured method and cost"""
+        hashed = self._run(generate_password_hash, password, self.method)
+        self.stats['hashed'] += 1
+        return hashed
+
+    def verify(self, stored_hash, password):
+        """(ok, new_hash): new_hash is set when the stored hash should be replaced"""
+        if self.method_prefix is None:
+            self.method_prefix = self._run(hash_method_prefix, self.method)
+        ok, new_hash = self._run(verify_and_rehash, stored_hash, password,
+                                 self.method, self.method_prefix)
+        self.stats['verified'] += 1
+        if new_hash:
+            self.stats['rehashed'] += 1
+        return ok, new_hash
+
+    def check_user(self, user, password, get_connection):
+        """Verify a users row's password; store a fresh hash if the configured cost changed"""
+        ok, new_hash = self.verify(user['password'], password)
+        if ok and new_hash:
+            conn = get_connection()
+            # Skipped if the password was changed in the meantime
+            conn.execute('UPDATE users SET password = ? WHERE id = ? AND password = ?',
+                         (new_hash, user['id'], user['password']))
+            conn.commit()
+            conn.close()
+        return ok
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['inflight'] = self._inflight
+        stats['workers'] = self.workers
+        stats['max_queue'] = self.max_queue
+        stats['method'] = self.method_prefix or self.method
+        return stats
+
+
+# Shared by app.py and admin.py
+password_hasher = PasswordHasher()
@@ -0,0 +1,238 @@
+# rate_limiter.py - Token buckets for expensive endpoints, shared by all workers via SQLite
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import flash, jsonify, render_template, request, session
+
+# Route name -> 'burst/seconds': up to burst calls at once, refilled at burst per seconds.
+# Override or extend with RATE_LIMITS='{"login": "20/60", "mcq_create_test": "off"}'
+DEFAULT_RATE_LIMITS = {
+    'login': '10/60',
+    'signup': '5/300',
+    'admin_login': '5/60',
+    'mcq_create_test': '10/60',
+    'admin_migrate_users': '3/300',
+    'admin_backup': '2/600',
+}
+
+RATE_LIMIT_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS rate_buckets (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        allowed INTEGER NOT NULL,
+        updated REAL NOT NULL
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS rate_counters (
+        route TEXT NOT NULL,
+        scope TEXT NOT NULL,
+        allowed INTEGER NOT NULL DEFAULT 0,
+        rejected INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (route, scope)
+    ) WITHOUT ROWID
+    ''',
+]
+
+# Refill by the time since the last call, then take a token if a whole one is there.
+# Every SET expression sees the old row, so allowed and tokens agree.
+TAKE_TOKEN = '''
+    INSERT INTO rate_buckets (key, tokens, allowed, updated) VALUES (:key, :burst - 1, 1, :now)
+    ON CONFLICT (key) DO UPDATE SET
+        allowed = MIN(:burst, tokens + MAX(0, :now - updated) * :rate) >= 1,
+        tokens = MIN(:burst, tokens + MAX(0, :now - updated) * :rate)
+                 - (MIN(:burst, tokens + MAX(0, :now - updated) * :rate) >= 1),
+        updated = MAX(updated, :now)
+    RETURNING allowed, tokens
+'''
+
+COUNT_OUTCOME = '''
+    INSERT INTO rate_counters (route, scope, allowed, rejected) VALUES (?, ?, ?, ?)
+    ON CONFLICT (route, scope) DO UPDATE SET
+        allowed = allowed + excluded.allowed, rejected = rejected + excluded.rejected
+'''
+
+
+def parse_limit(spec):
+    """'10/60' -> (burst 10, 10/60 tokens per second); 'off' or None -> None"""
+    if spec in (None, '', 'off'):
+        return None
+    burst, seconds = str(spec).split('/')
+    burst, seconds = float(burst), float(seconds)
+    if burst < 1 or seconds <= 0:
+        raise ValueError(f'invalid rate limit {spec!r}')
+    return burst, burst / seconds
+
+
+def load_rate_limits():
+    """Default limits merged with any JSON overrides from RATE_LIMITS"""
+    specs = dict(DEFAULT_RATE_LIMITS)
+    overrides = os.environ.get('RATE_LIMITS')
+    if overrides:
+        try:
+            specs.update(json.loads(overrides))
+        except (ValueError, AttributeError) as e:
+            print(f"⚠️  Ignoring invalid RATE_LIMITS: {e}")
+    limits = {}
+    for route, spec in specs.items():
+        try:
+            limits[route] = parse_limit(spec)
+        except ValueError as e:
+            print(f"⚠️  Rate limit for {route} disabled: {e}")
+            limits[route] = None
+    return limits
+
+
+class RateLimiter:
+    """Per-route token buckets keyed by client IP, by user once logged in, and by account.
+
+    Buckets live in one small SQLite file, so every gunicorn worker on the host
+    draws from the same buckets; a check is one short write transaction. If that
+    file can't be used the request is let through (and counted as a backend error).
+    """
+
+    def __init__(self, db_file=None, limits=None, busy_timeout=None):
+        self.db_file = db_file or os.environ.get(
+            'RATE_LIMIT_DB', os.path.join(os.environ.get('DATA_DIR', '/var/data'), 'rate_limits.db'))
+        self.limits = load_rate_limits() if limits is None else limits
+        if busy_timeout is None:
+            busy_timeout = float(os.environ.get('RATE_LIMIT_BUSY_TIMEOUT', 0.5))
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self.stats = {}  # route -> this process's counters
+
+    def _connect(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.db_file, timeout=self.busy_timeout, isolation_level=None)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = OFF')  # losing a few tokens in a crash is harmless
+        for create_sql in RATE_LIMIT_SCHEMA:
+            conn.execute(create_sql)
+        self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _count(self, route, outcome):
+        with self._lock:
+            counters = self.stats.setdefault(route, {'allowed': 0, 'rejected': 0, 'backend_errors': 0})
+            counters[outcome] += 1
+
+    def check(self, route, keys):
+        """(allowed, retry_after seconds) for one call to route by the given client keys"""
+        limit = self.limits.get(route)
+        if limit is None or not keys:
+            return True, 0
+        burst, rate = limit
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                results = [(scope, conn.execute(TAKE_TOKEN, {'key': f'{route}:{scope}:{value}',
+                                                             'burst': burst, 'rate': rate,
+                                                             'now': now}).fetchone())
+                           for scope, value in keys]
+                allowed = all(row[0] for _, row in results)
+                if not allowed:
+                    # Give back the tokens the other keys just paid for a call that won't run
+                    for scope, value in keys:
+                        conn.execute('''UPDATE rate_buckets SET tokens = MIN(?, tokens + 1)
+                                        WHERE key = ? AND allowed''',
+                                     (burst, f'{route}:{scope}:{value}'))
+                for scope, row in results:
+                    conn.execute(COUNT_OUTCOME, (route, scope, int(allowed), int(not row[0])))
+                self._purge_idle(conn, now)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            print(f"⚠️ Rate limiter unavailable, letting {route} through: {e}")
+            self._count(route, 'backend_errors')
+            return True, 0
+
+        if allowed:
+            self._count(route, 'allowed')
+            return True, 0
+        self._count(route, 'rejected')
+        # Until every exhausted bucket has refilled one whole token
+        missing = max(1 - row[1] for _, row in results if not row[0])
+        return False, max(1, math.ceil(missing / rate))
+
+    def _purge_idle(self, conn, now):
+        # A bucket idle for longer than its refill time is full again: same as no row
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        longest = max((burst / rate for burst, rate in filter(None, self.limits.values())), default=0)
+        conn.execute('DELETE FROM rate_buckets WHERE updated < ?', (now - longest,))
+
+    def client_keys(self, account_field=None):
+        # remote_addr is the real client only behind ProxyFix (see app.py)
+        keys = [('ip', request.remote_addr or 'unknown')]
+        if session.get('user_id'):
+            keys.append(('user', session['user_id']))
+        account = request.form.get(account_field, '').strip().lower() if account_field else ''
+        if account:
+            keys.append(('account', account))
+        return keys
+
+    def limit(self, route, methods=None, template=None, account_field=None):
+        """Decorator: reject over-limit calls with 429 and Retry-After.
+
+        methods limits only those HTTP methods (e.g. POST for login forms); with a
+        template the page is rendered again with a flash message, otherwise the
+        reply is JSON for JSON requests and plain text for the rest. account_field
+        names a form field (the submitted email) that gets a bucket of its own, so
+        guesses at one account are limited however many addresses they come from.
+        """
+        def decorator(f):
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                if methods and request.method not in methods:
+                    return f(*args, **kwargs)
+                allowed, retry_after = self.check(route, self.client_keys(account_field))
+                if allowed:
+                    return f(*args, **kwargs)
+                message = f'Too many requests. Please try again in {retry_after} seconds.'
+                headers = {'Retry-After': str(retry_after)}
+                if template:
+                    flash(message)
+                    return render_template(template), 429, headers
+                if request.is_json:
+                    return jsonify({'success': False, 'message': message}), 429, headers
+                return message, 429, headers
+            return decorated
+        return decorator
+
+    def get_stats(self):
+        with self._lock:
+            local = {route: dict(counters) for route, counters in self.stats.items()}
+        shared = {}
+        try:
+            for route, scope, allowed, rejected in self._connect().execute(
+                    'SELECT route, scope, allowed, rejected FROM rate_counters ORDER BY route, scope'):
+                shared.setdefault(route, {})[scope] = {'allowed': allowed, 'rejected': rejected}
+        except sqlite3.Error as e:
+            shared = {'error': str(e)}
+        return {
+            'limits': {route: (f'{limit[0]:g}/{limit[0] / limit[1]:g}s' if limit else 'off')
+                       for route, limit in self.limits.items()},
+            'this_process': local,
+            'all_workers': shared,
+            'db_file': self.db_file,
+        }
+
+
+# Shared by app.py, mcq.py and the admin routes in dynamic_db_handler.py
+rate_limiter = RateLimiter()
@@ -0,0 +1,194 @@
+# study_analytics.py - In-process study-activity counters, flushed into user_analytics
+import atexit
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from dynamic_db_handler import dynamic_db_handler
+
+# Event name -> user_analytics counter it increments
+EVENT_COUNTERS = {
+    'question_viewed': 'questions_viewed',
+    'answer_viewed': 'answers_viewed',
+    'topic_completed': 'topics_completed',
+}
+
+# Counters are added to the stored row; databases_accessed is merged as a set
+ANALYTICS_UPSERT = '''
+    INSERT INTO user_analytics (user_id, date, questions_viewed, answers_viewed,
+                                topics_completed, study_time_minutes, databases_accessed)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, date) DO UPDATE SET
+        questions_viewed = questions_viewed + excluded.questions_viewed,
+        answers_viewed = answers_viewed + excluded.answers_viewed,
+        topics_completed = topics_completed + excluded.topics_completed,
+        study_time_minutes = study_time_minutes + excluded.study_time_minutes,
+        databases_accessed = (
+            SELECT json_group_array(value) FROM (
+                SELECT value FROM json_each(COALESCE(user_analytics.databases_accessed, '[]'))
+                UNION
+                SELECT value FROM json_each(excluded.databases_accessed)
+            )
+        )
+'''
+
+
+def _new_bucket():
+    bucket = {counter: 0 for counter in EVENT_COUNTERS.values()}
+    bucket['study_seconds'] = 0.0
+    bucket['databases'] = set()
+    return bucket
+
+
+class StudyActivityAggregator:
+    """Per-user daily counters kept in memory and upserted in one batch every flush interval.
+
+    record() only touches a dict. Study time is the sum of gaps between a user's
+    consecutive events, except gaps longer than the session gap, which end a session.
+    Whole minutes are written; the leftover seconds wait for the next flush.
+    db_file may be a function of user_id (e.g. UserShardRouter.shard_file); rows are
+    then upserted one transaction per file.
+    """
+
+    def __init__(self, db_file, flush_interval=None, session_gap_minutes=None):
+        self.db_file = db_file
+        if flush_interval is None:
+            flush_interval = float(os.environ.get('STUDY_ANALYTICS_FLUSH_SECONDS', 30))
+        if session_gap_minutes is None:
+            session_gap_minutes = float(os.environ.get('STUDY_SESSION_GAP_MINUTES', 30))
+        self.flush_interval = flush_interval
+        self.session_gap = session_gap_minutes * 60
+        self._buckets = {}     # (user_id, date) -> counters
+        self._last_event = {}  # user_id -> monotonic time of the previous event
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.stats = {'events': 0, 'sessions': 0, 'flushes': 0, 'rows_written': 0, 'flush_errors': 0}
+        # Counters still in memory are written when the worker process exits normally
+        atexit.register(self.stop)
+
+    def _ensure_worker(self):
+        # Started lazily so forked server workers each get their own thread
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='study-analytics', daemon=True)
+        self._thread.start()
+
+    def record(self, user_id, event, source_db=None):
+        """Count one study event for a logged-in user (no database work)"""
+        counter = EVENT_COUNTERS.get(event)
+        if not user_id or counter is None or self._stop.is_set():
+            return
+        now = time.monotonic()
+        key = (user_id, datetime.date.today().isoformat())
+        with self._lock:
+            self._ensure_worker()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = _new_bucket()
+            bucket[counter] += 1
+            if source_db:
+                bucket['databases'].add(os.path.basename(source_db))
+            previous = self._last_event.get(user_id)
+            if previous is not None and now - previous <= self.session_gap:
+                bucket['study_seconds'] += now - previous
+            else:
+                self.stats['sessions'] += 1
+            self._last_event[user_id] = now
+            self.stats['events'] += 1
+
+    def flush(self):
+        """Upsert everything counted so far in one transaction"""
+        with self._lock:
+            buckets, self._buckets = self._buckets, {}
+            # Forget sessions that have gone idle
+            cutoff = time.monotonic() - self.session_gap
+            self._last_event = {user_id: seen for user_id, seen in self._last_event.items()
+                                if seen >= cutoff}
+            active_users = set(self._last_event)
+
+        rows, carry = {}, {}
+        for (user_id, date), bucket in buckets.items():
+            minutes, seconds = divmod(bucket['study_seconds'], 60)
+            # Part-minutes wait for the user's next events; an ended session drops them
+            if seconds and user_id in active_users:
+                carry[(user_id, date)] = seconds
+            if not minutes and not any(bucket[counter] for counter in EVENT_COUNTERS.values()):
+                continue
+            rows.setdefault(self._file_for(user_id), []).append((
+                user_id, date, bucket['questions_viewed'], bucket['answers_viewed'],
+                bucket['topics_completed'], int(minutes), json.dumps(sorted(bucket['databases']))))
+
+        written = 0
+        for db_file, file_rows in rows.items():
+            try:
+                conn = dynamic_db_handler.get_connection(db_file, readonly=False)
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                    conn.executemany(ANALYTICS_UPSERT, file_rows)
+                    conn.commit()
+                except Exception:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    raise
+                finally:
+                    conn.close()
+            except (sqlite3.Error, FileNotFoundError) as e:
+                print(f"⚠️ Study analytics flush to {db_file} failed, "
+                      f"keeping {len(file_rows)} rows for the next one: {e}")
+                self.stats['flush_errors'] += 1
+                failed = {(row[0], row[1]) for row in file_rows}
+                self._merge_back({key: bucket for key, bucket in buckets.items() if key in failed})
+                carry = {key: seconds for key, seconds in carry.items() if key not in failed}
+                continue
+            written += len(file_rows)
+
+        self._merge_back({key: dict(_new_bucket(), study_seconds=seconds)
+                          for key, seconds in carry.items()})
+        if written:
+            self.stats['flushes'] += 1
+            self.stats['rows_written'] += written
+        return written
+
+    def _file_for(self, user_id):
+        return self.db_file(user_id) if callable(self.db_file) else self.db_file
+
+    def _merge_back(self, buckets):
+        with self._lock:
+            for key, old in buckets.items():
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = _new_bucket()
+                for counter in EVENT_COUNTERS.values():
+                    bucket[counter] += old[counter]
+                bucket['study_seconds'] += old['study_seconds']
+                bucket['databases'] |= old['databases']
+
+    def stop(self, timeout=10.0):
+        """Stop the flush thread and write what is left"""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout)
+        self.flush()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['pending_rows'] = len(self._buckets)
+            stats['active_sessions'] = len(self._last_event)
+        stats['flush_interval_s'] = self.flush_interval
+        stats['session_gap_minutes'] = self.session_gap / 60
+        return stats
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ Study analytics flush error: {e}")
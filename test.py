@@ -1,23 +1,47 @@
 from flask import Blueprint, render_template, abort, request, redirect, url_for, flash, session, jsonify
 import sqlite3
-# At top of test.py
+from dynamic_db_handler import dynamic_db_handler
+from attempt_store import AttemptStore
+from test_papers import TestPaperCache
 import os
-DATABASE = os.environ.get('TEST_DB_FILE', '/var/data/test.db')
-
-def get_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
-
 
 test_bp = Blueprint('test_bp', __name__, template_folder='templates')
 DATABASE = os.environ.get('TEST_DB_FILE', 'test.db')
 
 
 def get_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    # Pooled connection; close() hands it back to the pool
+    return dynamic_db_handler.get_connection(DATABASE)
+
+
+# In-progress answers live server-side; the session only holds test_<id>_attempt -> token
+attempt_store = AttemptStore(DATABASE)
+# Questions, answer key and info of each test, shared by every candidate taking it
+test_papers = TestPaperCache(DATABASE)
+
+
+@test_bp.record_once
+def migrate_test_database(state):
+    # DATABASE may live outside the scanned data directory, so rescans would never migrate it
+    success, message = dynamic_db_handler.migrate_database(DATABASE, 'test')
+    if not success:
+        print(f"❌ {message}")
+
+
+def attempt_key(test_id):
+    return f'test_{test_id}_attempt'
+
+
+def load_attempt(test_id, total, create=False):
+    """This session's attempt at the test (a new one if create and there is none)"""
+    user_id = session.get('user_id')
+    state = attempt_store.get(session.get(attempt_key(test_id)), test_id, user_id)
+    if state is None and create:
+        state = attempt_store.create(test_id, user_id, total)
+        session[attempt_key(test_id)] = state.token
+    if state is not None:
+        state.resize(total)
+    return state
 
 
 @test_bp.route('/tests')
@@ -70,57 +94,50 @@ def view_test_questions(test_id):
 
 @test_bp.route('/tests/<int:test_id>/start')
 def start_test(test_id):
-    session[f'test_{test_id}_answers'] = {}
-    session[f'test_{test_id}_marked'] = []
-    session[f'test_{test_id}_skipped'] = []
+    paper = test_papers.get(test_id)
+    # A restart abandons the previous attempt
+    old_token = session.pop(attempt_key(test_id), None)
+    if old_token:
+        attempt_store.delete(old_token)
+    load_attempt(test_id, len(paper) if paper else 0, create=True)
     return redirect(url_for('test_bp.single_question', test_id=test_id, q_num=1))
 
 
 @test_bp.route('/tests/<int:test_id>/question/<int:q_num>', methods=['GET', 'POST'])
 def single_question(test_id, q_num):
-    conn = get_connection()
-    try:
-        questions = conn.execute(
-            '''SELECT id, subject, topic, question, option_a, option_b, option_c, option_d, correct_answer
-               FROM test_questions WHERE test_id = ? ORDER BY id''',
-            (test_id,)
-        ).fetchall()
-        test = conn.execute('SELECT * FROM test_info WHERE id = ?', (test_id,)).fetchone()
-    finally:
-        conn.close()
-
-    if not test or not questions or q_num < 1 or q_num > len(questions):
+    paper = test_papers.get(test_id)
+    if not paper or q_num < 1 or q_num > len(paper):
         abort(404)
 
+    test, questions = paper.test, paper.questions
     question = questions[q_num - 1]
-
-    answer_key = f'test_{test_id}_answers'
-    mark_key = f'test_{test_id}_marked'
-    skip_key = f'test_{test_id}_skipped'
-
-    if answer_key not in session:
-        session[answer_key] = {}
-    if mark_key not in session:
-        session[mark_key] = []
-    if skip_key not in session:
-        session[skip_key] = []
-
-    answers = session[answer_key]
-    marked = set(session[mark_key])
-    skipped = set(session[skip_key])
+    index = q_num - 1
+    state = load_attempt(test_id, len(questions), create=True)
+
+    def render(state):
+        answers, marked, skipped = state.as_dicts(paper.question_ids)
+        return render_template(
+            'test/single_question.html',
+            test=test,
+            question=question,
+            q_num=q_num,
+            total=len(questions),
+            selected_answer=answers.get(str(question['id']), None),
+            marked_questions=marked,
+            skipped_questions=skipped,
+            duration_minutes=test['duration_minutes']
+        )
 
     if request.method == 'POST':
         selected_option = request.form.get('answer')
         nav = request.form.get('nav')  # previous, next, submit, skip
 
         if nav == 'skip':
-            # Mark the question as skipped
-            skipped.add(str(question['id']))
-            session[skip_key] = list(skipped)
-            # Remove answer if it exists, since it's skipped
-            if str(question['id']) in answers:
-                del answers[str(question['id'])]
-                session[answer_key] = answers
+            # Mark the question as skipped and remove its answer
+            def skip(state):
+                state.set_skipped(index, True)
+                state.set_answer(index, None)
+            attempt_store.update(state, skip)
             # Navigate forward if possible
             next_q_num = q_num + 1 if q_num < len(questions) else q_num
             return redirect(url_for('test_bp.single_question', test_id=test_id, q_num=next_q_num))
@@ -128,29 +145,17 @@ def single_question(test_id, q_num):
         if nav in ('next', 'submit'):
             if not selected_option:
                 flash("Please select an option or choose Skip.")
-                return render_template(
-                    'test/single_question.html',
-                    test=test,
-                    question=question,
-                    q_num=q_num,
-                    total=len(questions),
-                    selected_answer=answers.get(str(question['id']), None),
-                    marked_questions=marked,
-                    skipped_questions=skipped,
-                    duration_minutes=test['duration_minutes']
-                )
+                return render(state)
             # Save answer and remove from skipped if any
-            answers[str(question['id'])] = selected_option
-            session[answer_key] = answers
-            if str(question['id']) in skipped:
-                skipped.remove(str(question['id']))
-                session[skip_key] = list(skipped)
+            def save(state):
+                state.set_answer(index, selected_option)
+                state.set_skipped(index, False)
+            attempt_store.update(state, save)
 
         elif nav == 'previous':
             # Save answer if selected before going back
             if selected_option:
-                answers[str(question['id'])] = selected_option
-                session[answer_key] = answers
+                attempt_store.update(state, lambda state: state.set_answer(index, selected_option))
 
         # Navigate accordingly
         if nav == 'previous':
@@ -162,112 +167,108 @@ def single_question(test_id, q_num):
         elif nav == 'submit':
             return redirect(url_for('test_bp.submit_test', test_id=test_id))
 
-    return render_template(
-        'test/single_question.html',
-        test=test,
-        question=question,
-        q_num=q_num,
-        total=len(questions),
-        selected_answer=answers.get(str(question['id']), None),
-        marked_questions=marked,
-        skipped_questions=skipped,
-        duration_minutes=test['duration_minutes']
-    )
+    return render(state)
 
 
 # AJAX toggle mark
 @test_bp.route('/tests/<int:test_id>/question/<int:q_num>/toggle_mark', methods=['POST'])
 def toggle_mark_ajax(test_id, q_num):
-    conn = get_connection()
-    try:
-        questions = conn.execute('SELECT id FROM test_questions WHERE test_id = ? ORDER BY id', (test_id,)).fetchall()
-    finally:
-        conn.close()
-
-    if not questions or q_num < 1 or q_num > len(questions):
+    paper = test_papers.get(test_id)
+    if not paper or q_num < 1 or q_num > len(paper):
         return jsonify({'success': False, 'error': 'Invalid question'}), 400
 
-    q_id_str = str(questions[q_num - 1]['id'])
-
-    mark_key = f'test_{test_id}_marked'
-    if mark_key not in session:
-        session[mark_key] = []
-    marked = set(session[mark_key])
-
-    if q_id_str in marked:
-        marked.remove(q_id_str)
-        marked_now = False
-    else:
-        marked.add(q_id_str)
-        marked_now = True
-
-    session[mark_key] = list(marked)
+    index = q_num - 1
+    state = load_attempt(test_id, len(paper), create=True)
+    state = attempt_store.update(state, lambda state: state.set_marked(index, not state.is_marked(index)))
+    if state is None:
+        return jsonify({'success': False, 'error': 'Attempt expired'}), 409
+    marked_now = state.is_marked(index)
 
     return jsonify({'success': True, 'marked': marked_now})
 
 
 @test_bp.route('/tests/<int:test_id>/review')
 def review_test(test_id):
-    conn = get_connection()
-    try:
-        questions = conn.execute('''SELECT id FROM test_questions WHERE test_id = ? ORDER BY id''', (test_id,)).fetchall()
-        test = conn.execute('SELECT * FROM test_info WHERE id = ?', (test_id,)).fetchone()
-    finally:
-        conn.close()
-    if not test or not questions:
+    paper = test_papers.get(test_id)
+    if not paper:
         abort(404)
 
-    answer_key = f'test_{test_id}_answers'
-    mark_key = f'test_{test_id}_marked'
-    skip_key = f'test_{test_id}_skipped'
-
-    answers = session.get(answer_key, {})
-    marked = set(session.get(mark_key, []))
-    skipped = set(session.get(skip_key, []))
+    state = load_attempt(test_id, len(paper))
+    answers, marked, skipped = state.as_dicts(paper.question_ids) if state else ({}, set(), set())
 
     return render_template('test/review.html',
-                           test=test,
-                           questions=questions,
+                           test=paper.test,
+                           questions=paper.questions,
                            answers=answers,
                            marked=marked,
                            skipped=skipped)
 
-@test_bp.route('/tests/<int:test_id>/review-attempted')
-def review_attempted(test_id):
-    print(f"DEBUG REVIEW_ATTEMPTED: test_id={test_id}")
-    
+def get_attempt(conn, test_id, user_id, attempt_id=None):
+    """One submitted attempt of this user at the test (the latest unless attempt_id is given)"""
+    if attempt_id:
+        return conn.execute('''
+            SELECT * FROM test_attempts WHERE id = ? AND test_id = ? AND user_id IS ?
+        ''', (attempt_id, test_id, user_id)).fetchone()
+    return conn.execute('''
+        SELECT * FROM test_attempts WHERE test_id = ? AND user_id IS ?
+        ORDER BY id DESC LIMIT 1
+    ''', (test_id, user_id)).fetchone()
+
+
+def attempt_questions(conn, paper, attempt_id):
+    """The paper's questions with this attempt's user_answer and is_correct (None if no response)"""
+    responses = {row['question_id']: row for row in conn.execute(
+        'SELECT question_id, user_answer, is_correct FROM user_responses WHERE attempt_id = ?',
+        (attempt_id,))}
+    questions = []
+    for q in paper.questions:
+        response = responses.get(q['id'])
+        questions.append(dict(q, user_answer=response['user_answer'] if response else None,
+                              is_correct=response['is_correct'] if response else None))
+    return questions
+
+
+def is_correct_answer(question):
+    return question['user_answer'] is not None and question['is_correct'] == 1
+
+
+def is_wrong_answer(question):
+    # Unanswered questions are stored with is_correct = 0 but are not wrong answers
+    return question['user_answer'] is not None and question['is_correct'] != 1
+
+
+def review_attempt(test_id):
+    """(paper, attempt, questions) for the review pages; attempt is None if there is none"""
+    paper = test_papers.get(test_id)
+    if not paper:
+        return None, None, None
     conn = get_connection()
     try:
-        test = conn.execute('SELECT * FROM test_info WHERE id = ?', (test_id,)).fetchone()
-        print(f"DEBUG: Test '{test['test_name'] if test else 'NOT FOUND'}'")
-        if not test:
-            flash(f"Test ID {test_id} not found!")
-            return redirect(url_for('test_bp.list_tests'))
-        
-        user_id = session.get('user_id', 1)
-        print(f"DEBUG: Looking for user_id={user_id}")
-        
-        all_questions = conn.execute('''
-            SELECT tq.*, ur.user_answer, ur.is_correct
-            FROM test_questions tq
-            LEFT JOIN user_responses ur ON tq.id = ur.question_id 
-                AND ur.test_id = ? AND ur.user_id = ?
-            WHERE tq.test_id = ?
-            ORDER BY tq.id
-        ''', (test_id, user_id, test_id)).fetchall()
-        print(f"DEBUG: Total questions found: {len(all_questions)}")
-        
-        correct_questions = [q for q in all_questions if q['is_correct'] == 1]
-        incorrect_questions = [q for q in all_questions if q['is_correct'] == 0]
-        unanswered_questions = [q for q in all_questions if q['is_correct'] is None]
-        
-        print(f"DEBUG: Correct={len(correct_questions)}, Wrong={len(incorrect_questions)}, Unanswered={len(unanswered_questions)}")
-        
+        attempt = get_attempt(conn, test_id, session.get('user_id', 1), request.args.get('attempt', type=int))
+        questions = attempt_questions(conn, paper, attempt['id']) if attempt else None
     finally:
         conn.close()
-    
+    return paper, attempt, questions
+
+
+@test_bp.route('/tests/<int:test_id>/review-attempted')
+def review_attempted(test_id):
+    paper, attempt, all_questions = review_attempt(test_id)
+    if not paper:
+        flash(f"Test ID {test_id} not found!")
+        return redirect(url_for('test_bp.list_tests'))
+    if not attempt:
+        flash("You haven't submitted this test yet.")
+        return redirect(url_for('test_bp.list_tests'))
+
+    # Same split as the graded totals in test_attempts (paper.grade)
+    correct_questions = [q for q in all_questions if is_correct_answer(q)]
+    incorrect_questions = [q for q in all_questions if is_wrong_answer(q)]
+    unanswered_questions = [q for q in all_questions if q['user_answer'] is None]
+
     return render_template('test/review_attempted.html',
-                           test=test,
+                           test=paper.test,
+                           attempt_id=attempt['id'],
                            correct_count=len(correct_questions),
                            incorrect_count=len(incorrect_questions),
                            unanswered_count=len(unanswered_questions),
@@ -277,56 +278,33 @@ def review_attempted(test_id):
 
 @test_bp.route('/tests/<int:test_id>/review/<string:filter_type>/<int:q_index>')
 def review_question(test_id, filter_type, q_index):
-    print(f"DEBUG: review_question - test_id={test_id}, filter={filter_type}, q_index={q_index}")
-    
-    conn = get_connection()
-    try:
-        # 1. Verify test exists
-        test = conn.execute('SELECT * FROM test_info WHERE id = ?', (test_id,)).fetchone()
-        if not test:
-            flash(f"Test ID {test_id} not found!")
-            return redirect(url_for('test_bp.list_tests'))
-        
-        user_id = session.get('user_id', 1)
-        
-        # 2. Base LEFT JOIN query for ALL questions
-        base_query = '''
-            SELECT tq.*, ur.user_answer, ur.is_correct, tq.explanation
-            FROM test_questions tq
-            LEFT JOIN user_responses ur ON tq.id = ur.question_id 
-                AND ur.test_id = ? AND ur.user_id = ?
-            WHERE tq.test_id = ?
-        '''
-        
-        # 3. Filter by filter_type
-        if filter_type == 'correct':
-            where_clause = ' AND (ur.is_correct = 1 OR ur.is_correct IS NULL)'
-        elif filter_type == 'incorrect':
-            where_clause = ' AND ur.is_correct = 0'
-        elif filter_type == 'all':
-            where_clause = ''  # Show ALL questions
-        else:
-            abort(404, "Invalid filter")
-        
-        questions = conn.execute(base_query + where_clause, (test_id, user_id, test_id)).fetchall()
-        print(f"DEBUG: Filter '{filter_type}' returned {len(questions)} questions")
-        
-        if not questions or q_index < 1 or q_index > len(questions):
-            flash("No questions found for this filter")
-            return redirect(url_for('test_bp.review_attempted', test_id=test_id))
-        
-        # 4. Current question + navigation
-        question = questions[q_index - 1]
-        prev_q = q_index - 1 if q_index > 1 else None
-        next_q = q_index + 1 if q_index < len(questions) else None
-        
-        print(f"DEBUG: Showing question {question['id']}: user_answer={question['user_answer']}, is_correct={question['is_correct']}")
-        
-    finally:
-        conn.close()
-    
+    if filter_type not in ('correct', 'incorrect', 'all'):
+        abort(404, "Invalid filter")
+
+    paper, attempt, questions = review_attempt(test_id)
+    if not paper:
+        flash(f"Test ID {test_id} not found!")
+        return redirect(url_for('test_bp.list_tests'))
+    if not attempt:
+        flash("You haven't submitted this test yet.")
+        return redirect(url_for('test_bp.list_tests'))
+
+    if filter_type == 'correct':
+        questions = [q for q in questions if is_correct_answer(q)]
+    elif filter_type == 'incorrect':
+        questions = [q for q in questions if is_wrong_answer(q)]
+
+    if not questions or q_index < 1 or q_index > len(questions):
+        flash("No questions found for this filter")
+        return redirect(url_for('test_bp.review_attempted', test_id=test_id, attempt=attempt['id']))
+
+    question = questions[q_index - 1]
+    prev_q = q_index - 1 if q_index > 1 else None
+    next_q = q_index + 1 if q_index < len(questions) else None
+
     return render_template('test/review_question.html',
-                           test=test,
+                           test=paper.test,
+                           attempt_id=attempt['id'],
                            question=question,
                            q_index=q_index,
                            total=len(questions),
@@ -336,57 +314,59 @@ def review_question(test_id, filter_type, q_index):
 
 @test_bp.route('/tests/<int:test_id>/submit', methods=['GET', 'POST'])
 def submit_test(test_id):
-    print(f"DEBUG SUBMIT: test_id={test_id}")
-    
     if request.method == 'POST' and request.form.get('review') == 'review':
-        print("DEBUG: Redirecting to review")
         return redirect(url_for('test_bp.review_attempted', test_id=test_id))
-    
+
+    paper = test_papers.get(test_id)
+    if not paper:
+        flash(f"Test ID {test_id} not found!")
+        return redirect(url_for('test_bp.list_tests'))
+
+    user_id = session.get('user_id', 1)
+    state = load_attempt(test_id, len(paper))
+
     conn = get_connection()
     try:
-        # DEBUG: Check test exists
-        test = conn.execute('SELECT * FROM test_info WHERE id = ?', (test_id,)).fetchone()
-        print(f"DEBUG: Test found: {test['test_name'] if test else 'NOT FOUND'}")
-        if not test:
-            flash(f"Test ID {test_id} not found!")
-            return redirect(url_for('test_bp.list_tests'))
-        
-        questions = conn.execute(
-            'SELECT id, correct_answer FROM test_questions WHERE test_id = ? ORDER BY id',
-            (test_id,)
-        ).fetchall()
-        print(f"DEBUG: Questions found: {len(questions)}")
-        
-        user_id = session.get('user_id', 1)
-        answer_key = f'test_{test_id}_answers'
-        answers = session.get(answer_key, {})
-        print(f"DEBUG: Session answers: {answers}")
-        
-        for q in questions:
-            qid = str(q['id'])
-            user_answer = answers.get(qid)
-            is_correct = 1 if user_answer and user_answer.upper() == q['correct_answer'].upper() else 0
-            print(f"DEBUG Q{q['id']}: user='{user_answer}', correct='{q['correct_answer']}', score={is_correct}")
-            
-            conn.execute('''
-                INSERT INTO user_responses (test_id, user_id, question_id, user_answer, is_correct)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (test_id, user_id, q['id'], user_answer, is_correct))
-        
-        conn.commit()
-        print("DEBUG: Responses saved")
-        
-        total = len(questions)
-        correct = sum(1 for q in questions if answers.get(str(q['id'])) 
-                     and answers.get(str(q['id'])).upper() == q['correct_answer'].upper())
-        wrong = sum(1 for q in questions if answers.get(str(q['id'])) 
-                   and answers.get(str(q['id'])).upper() != q['correct_answer'].upper())
-        unanswered = total - correct - wrong
-        
+        if state is None:
+            # Nothing in progress (e.g. submit pressed twice): show the last result
+            attempt = get_attempt(conn, test_id, user_id)
+            if not attempt:
+                flash("Start the test before submitting it.")
+                return redirect(url_for('test_bp.start_test', test_id=test_id))
+        else:
+            # Graded once, here; review pages read the stored results
+            correct, wrong, unanswered = paper.grade(state.answers)
+            row = conn.execute('''
+                INSERT INTO test_attempts (test_id, user_id, token, total, correct, wrong, unanswered)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (token) DO NOTHING
+                RETURNING id
+            ''', (test_id, user_id, state.token, len(paper), correct, wrong, unanswered)).fetchone()
+            if row:
+                conn.executemany('''
+                    INSERT INTO user_responses (attempt_id, test_id, user_id, question_id, user_answer, is_correct)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', [(row[0], test_id, user_id, question_id, state.answer(index),
+                       int(bool(state.answers[index]) and state.answers[index] == paper.answer_key[index]))
+                      for index, question_id in enumerate(paper.question_ids)])
+            conn.commit()
+            # A concurrent submit of the same attempt already stored it
+            attempt = conn.execute('SELECT * FROM test_attempts WHERE token = ?', (state.token,)).fetchone()
     finally:
         conn.close()
 
-    for key in [f'test_{test_id}_answers', f'test_{test_id}_marked', f'test_{test_id}_skipped']:
-        session.pop(key, None)
+    token = session.pop(attempt_key(test_id), None)
+    if token:
+        attempt_store.delete(token)
+
+    return render_template('test/report.html', test=paper.test, attempt_id=attempt['id'],
+                           total=attempt['total'], correct=attempt['correct'],
+                           wrong=attempt['wrong'], unanswered=attempt['unanswered'])
+
 
-    return render_template('test/report.html', test=test, total=total, correct=correct, wrong=wrong, unanswered=unanswered)
+@test_bp.route('/admin/test_metrics')
+def test_metrics():
+    """Runtime metrics for the compiled test papers and in-progress attempts"""
+    if session.get('user_type') != 'admin':
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+    return jsonify({'papers': test_papers.get_stats(), 'attempts': attempt_store.get_stats()})
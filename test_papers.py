@@ -0,0 +1,141 @@
+# test_papers.py - Immutable compiled test papers, cached per test until the test changes
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+
+from attempt_store import OPTIONS
+from dynamic_db_handler import dynamic_db_handler, find_question_position
+
+
+class CompiledPaper:
+    """One test's info and questions in id order, plus its answer key.
+
+    questions are read-only mappings (question['option_a'] works as with a row);
+    answer_key has one byte per question in attempt_store's encoding (1..4 = A..D,
+    0 = no usable key), so an attempt is graded by comparing bytes.
+    """
+
+    __slots__ = ('test_id', 'version', 'test', 'questions', 'question_ids', 'answer_key')
+
+    def __init__(self, test_id, version, test, questions):
+        self.test_id = test_id
+        self.version = version
+        self.test = MappingProxyType(dict(test))
+        self.questions = tuple(MappingProxyType(dict(row)) for row in questions)
+        self.question_ids = tuple(q['id'] for q in self.questions)
+        self.answer_key = bytes(
+            OPTIONS.index(answer) + 1 if answer and answer in OPTIONS else 0
+            for answer in ((q['correct_answer'] or '').strip().upper() for q in self.questions))
+
+    def __len__(self):
+        return len(self.questions)
+
+    def position(self, question_id):
+        """0-based position of a question in the paper (None if it isn't in it)"""
+        return find_question_position(self.question_ids, question_id)
+
+    def grade(self, answers):
+        """(correct, wrong, unanswered) for one byte per question of given answers"""
+        correct = wrong = 0
+        for given, key in zip(answers, self.answer_key):
+            if not given:
+                continue
+            if given == key:
+                correct += 1
+            else:
+                wrong += 1
+        return correct, wrong, len(self) - correct - wrong
+
+
+class TestPaperCache:
+    """LRU of CompiledPaper per test_id, checked against test_paper_versions on every use.
+
+    The version row is bumped by triggers on test_info and test_questions (test
+    migration v3), so attempt and response writes to the same file leave cached
+    papers alone. A file without the table (not migrated yet) is compiled every time.
+    """
+
+    def __init__(self, db_file, max_papers=None):
+        self.db_file = db_file
+        if max_papers is None:
+            max_papers = int(os.environ.get('TEST_PAPER_CACHE_SIZE', 64))
+        self.max_papers = max_papers
+        self._papers = OrderedDict()  # (db path, test_id) -> CompiledPaper
+        self._lock = threading.Lock()
+        self._compile_lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0, 'unversioned': 0}
+
+    def _version(self, conn, test_id):
+        try:
+            row = conn.execute('SELECT version FROM test_paper_versions WHERE test_id = ?',
+                               (test_id,)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        # No row: nothing of this test was written since the table was made (it doesn't exist)
+        return row[0] if row else 0
+
+    def _cached(self, key, version, count=True):
+        with self._lock:
+            paper = self._papers.get(key)
+            if paper is None:
+                if count:
+                    self.stats['misses'] += 1
+                return None
+            if paper.version != version:
+                del self._papers[key]
+                self.stats['stale'] += 1
+                return None
+            self._papers.move_to_end(key)
+            self.stats['hits'] += 1
+            return paper
+
+    def get(self, test_id):
+        """The compiled paper, or None if the test doesn't exist or has no questions"""
+        key = (os.path.abspath(self.db_file), test_id)
+        conn = dynamic_db_handler.get_connection(self.db_file)
+        try:
+            version = self._version(conn, test_id)
+            if version is None:
+                self.stats['unversioned'] += 1
+                return self._compile(conn, test_id, None)
+            paper = self._cached(key, version)
+            if paper is not None:
+                return paper
+            # One compile per paper when a whole exam hall starts at once
+            with self._compile_lock:
+                paper = self._cached(key, version, count=False)
+                if paper is None:
+                    paper = self._compile(conn, test_id, version)
+                    if paper is not None:
+                        self._store(key, paper)
+            return paper
+        finally:
+            conn.close()
+
+    def _compile(self, conn, test_id, version):
+        # The version was read first: a write landing in between only makes the entry stale
+        test = conn.execute('SELECT * FROM test_info WHERE id = ?', (test_id,)).fetchone()
+        if not test:
+            return None
+        questions = conn.execute('SELECT * FROM test_questions WHERE test_id = ? ORDER BY id',
+                                 (test_id,)).fetchall()
+        if not questions:
+            return None
+        return CompiledPaper(test_id, version, test, questions)
+
+    def _store(self, key, paper):
+        with self._lock:
+            self._papers[key] = paper
+            self._papers.move_to_end(key)
+            while len(self._papers) > self.max_papers:
+                self._papers.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['papers'] = len(self._papers)
+        stats['max_papers'] = self.max_papers
+        return stats
@@ -0,0 +1,109 @@
+# conftest.py - Every test runs against throwaway databases in a temporary DATA_DIR
+import itertools
+import os
+import sqlite3
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = tempfile.mkdtemp(prefix='qbank-tests-')
+# Outside DATA_DIR, as on hosts where TEST_DB_FILE points elsewhere: only the blueprint migrates it
+TEST_DB_FILE = os.path.join(tempfile.mkdtemp(prefix='qbank-tests-exams-'), 'exams.db')
+
+# Read by the modules at import time, so set before any of them is imported
+os.environ.update({
+    'DATA_DIR': DATA_DIR,
+    'TEST_DB_FILE': TEST_DB_FILE,
+    'RATE_LIMIT_DB': os.path.join(DATA_DIR, 'rate_limits.db'),
+    'RATE_LIMITS': '{"login": "off", "signup": "off", "admin_login": "off"}',
+    'PASSWORD_HASH_WORKERS': '0',
+    'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+    'USER_SHARD_REFRESH': '0',
+})
+sys.path.insert(0, ROOT)
+
+QBANK_SCHEMA = '''
+    CREATE TABLE qbank (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        subject TEXT, exam_type TEXT, year TEXT, category TEXT, chapter TEXT,
+        topic TEXT, subtopic TEXT, question TEXT, answer TEXT
+    )
+'''
+
+# (subject, chapter, topic, number of questions)
+QBANK_TOPICS = [
+    ('Anatomy', 'Abdomen', 'Appendix', 3),
+    ('Anatomy', 'Abdomen', 'Kidney', 2),
+    ('Physiology', 'Renal', 'Filtration', 2),
+]
+
+
+def seed_qbank(path):
+    conn = sqlite3.connect(path)
+    conn.execute(QBANK_SCHEMA)
+    for subject, chapter, topic, count in QBANK_TOPICS:
+        conn.executemany(
+            'INSERT INTO qbank (subject, chapter, topic, question, answer) VALUES (?, ?, ?, ?, ?)',
+            [(subject, chapter, topic, f'{topic} question {i}', f'{topic} answer {i}')
+             for i in range(1, count + 1)])
+    conn.commit()
+    conn.close()
+
+
+def seed_test_db(path, schema):
+    conn = sqlite3.connect(path)
+    for create_sql in schema.values():
+        conn.execute(create_sql)
+    conn.execute("INSERT INTO test_info (id, test_name, duration_minutes) VALUES (1, 'Mock 1', 30)")
+    conn.executemany('''
+        INSERT INTO test_questions (test_id, subject, topic, question, option_a, option_b,
+                                    option_c, option_d, correct_answer, explanation)
+        VALUES (1, 'Anatomy', 'Appendix', ?, 'a', 'b', 'c', 'd', ?, NULL)
+    ''', [(f'Test question {i}', answer) for i, answer in enumerate('abcda', 1)])
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture(scope='session')
+def appmod():
+    """The application module, imported once against the seeded DATA_DIR"""
+    from dynamic_db_handler import dynamic_db_handler
+    seed_qbank(os.path.join(DATA_DIR, '1st_year.db'))
+    seed_test_db(os.environ['TEST_DB_FILE'], dynamic_db_handler.get_test_schema())
+    dynamic_db_handler.refresh_databases()
+    # app.py keeps the central user database in the working directory
+    os.chdir(DATA_DIR)
+    import app
+    app.app.config['TESTING'] = True
+    yield app
+    # Write out the background writers now: at interpreter exit the working directory
+    # is the repository again, and the relative admin_users.db would be the repo's own
+    app.study_activity.stop()
+    for queue in list(app.user_shards._queues.values()):
+        queue.stop()
+
+
+@pytest.fixture
+def client(appmod):
+    return appmod.app.test_client()
+
+
+_user_numbers = itertools.count(1)
+
+
+@pytest.fixture
+def user(appmod, client):
+    """A freshly signed-up user logged in on client; returns (user_id, email)"""
+    email = f'user{next(_user_numbers)}@example.com'
+    client.post('/signup', data={'username': email.split('@')[0], 'email': email, 'password': 'pw'})
+    client.post('/login', data={'username': email, 'password': 'pw'})
+    with client.session_transaction() as session:
+        return session['user_id'], email
+
+
+def flush_user_writes(appmod):
+    """Write out everything the coalescing user-state queues are holding"""
+    for queue in list(appmod.user_shards._queues.values()):
+        queue.flush(5)
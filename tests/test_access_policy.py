@@ -0,0 +1,76 @@
+# Versioned topic access policy (access_policy.py)
+import sqlite3
+
+import pytest
+
+from access_policy import TopicAccessPolicy
+from dynamic_db_handler import dynamic_db_handler
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    path = str(tmp_path / 'admin_users.db')
+    sqlite3.connect(path).close()
+    yield path
+    dynamic_db_handler.close_pool(path)
+
+
+@pytest.fixture
+def policy(db_file):
+    policy = TopicAccessPolicy(db_file, refresh_interval=0)
+    policy.initialize()
+    return policy
+
+
+def test_topic_then_subject_then_site_default(policy):
+    assert policy.requires_login('Anatomy', 'Kidney')
+
+    policy.set_topic('Anatomy', '*', False)
+    assert not policy.requires_login('anatomy', 'Appendix')
+    assert policy.requires_login('Physiology', 'Filtration')
+
+    policy.set_topic('ANATOMY', 'kidney', True)
+    assert policy.requires_login('Anatomy', 'Kidney')
+    assert not policy.requires_login('Anatomy', 'Appendix')
+
+    policy.set_topic('*', '*', False)
+    assert not policy.requires_login('Physiology', 'Filtration')
+    assert policy.requires_login('Anatomy', 'Kidney')
+
+
+def test_replace_all_drops_the_old_rules(policy):
+    policy.set_topic('Anatomy', '*', False)
+    policy.replace_all([('Physiology', 'Filtration')])
+    assert policy.requires_login('Anatomy', 'Appendix')
+    assert not policy.requires_login('physiology', 'filtration')
+    assert policy.requires_login('Physiology', 'Renal')
+
+
+def test_other_workers_reload_only_on_a_version_bump(policy, db_file):
+    other = TopicAccessPolicy(db_file, refresh_interval=0)
+    other.refresh(force=True)
+    assert other.requires_login('Anatomy', 'Appendix')
+
+    # A row written without bumping the version is not picked up
+    conn = sqlite3.connect(db_file)
+    conn.execute("INSERT INTO topic_access_policy (subject, topic, requires_login) VALUES ('Anatomy', 'Appendix', 0)")
+    conn.commit()
+    assert other.requires_login('Anatomy', 'Appendix')
+
+    conn.execute('UPDATE topic_access_policy_version SET version = version + 1')
+    conn.commit()
+    conn.close()
+    assert not other.requires_login('Anatomy', 'Appendix')
+
+    policy.set_topic('Anatomy', 'Appendix', True)
+    assert other.requires_login('Anatomy', 'Appendix')
+    assert other.version == policy.version
+
+
+def test_version_is_checked_at_most_once_per_interval(policy, db_file):
+    other = TopicAccessPolicy(db_file, refresh_interval=3600)
+    other.refresh(force=True)
+    policy.set_topic('Anatomy', '*', False)
+    assert other.requires_login('Anatomy', 'Appendix')
+    other.refresh(force=True)
+    assert not other.requires_login('Anatomy', 'Appendix')
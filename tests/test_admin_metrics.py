@@ -0,0 +1,28 @@
+# Runtime metrics routes are for admins only (app.py, dynamic_db_handler.py, test.py)
+import pytest
+
+METRICS_URLS = [
+    '/admin/write_behind_metrics',
+    '/admin/study_analytics_metrics',
+    '/admin/password_hash_metrics',
+    '/admin/rate_limit_metrics',
+    '/admin/db_metrics',
+    '/admin/test_metrics',
+]
+
+
+@pytest.mark.parametrize('url', METRICS_URLS)
+def test_metrics_are_refused_to_anonymous_users_and_students(client, user, url):
+    assert client.get(url).status_code == 403
+    with client.session_transaction() as session:
+        session.clear()
+    assert client.get(url).status_code == 403
+
+
+@pytest.mark.parametrize('url', METRICS_URLS)
+def test_admin_sees_metrics(client, url):
+    with client.session_transaction() as session:
+        session['user_type'] = 'admin'
+    response = client.get(url)
+    assert response.status_code == 200
+    assert 'success' not in response.get_json()
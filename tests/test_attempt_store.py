@@ -0,0 +1,89 @@
+# Server-side test attempt state (attempt_store.py)
+import sqlite3
+
+import pytest
+
+from attempt_store import AttemptState, AttemptStore
+from dynamic_db_handler import dynamic_db_handler
+from migrations import ATTEMPT_STATE_SCHEMA
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    path = str(tmp_path / 'attempts.db')
+    conn = sqlite3.connect(path)
+    conn.execute(ATTEMPT_STATE_SCHEMA)
+    conn.commit()
+    conn.close()
+    yield path
+    dynamic_db_handler.close_pool(path)
+
+
+def test_answers_are_one_byte_and_flags_one_bit_per_question():
+    state = AttemptState.empty('t', 1, 7, 10)
+    assert (len(state.answers), len(state.marked), len(state.skipped)) == (10, 2, 2)
+
+    state.set_answer(0, 'b')
+    state.set_answer(1, 'E')  # not an option: no answer
+    state.set_marked(9, True)
+    state.set_skipped(3, True)
+    assert bytes(state.answers[:2]) == b'\x02\x00'
+    assert bytes(state.marked) == b'\x00\x02'
+    assert state.as_dicts(list(range(100, 110))) == ({'100': 'B'}, {'109'}, {'103'})
+
+
+def test_resize_drops_flags_of_removed_questions():
+    state = AttemptState.empty('t', 1, 7, 10)
+    state.set_marked(9, True)
+    state.set_answer(9, 'A')
+    state.resize(9)
+    state.resize(10)
+    assert not state.is_marked(9) and state.answer(9) is None
+
+
+def test_attempt_belongs_to_its_test_and_user(db_file):
+    store = AttemptStore(db_file)
+    state = store.create(1, 7, 5)
+    assert store.get(state.token, 1, 7).version == 0
+    assert store.get(state.token, 1, 8) is None
+    assert store.get(state.token, 2, 7) is None
+    assert store.get('unknown', 1, 7) is None
+
+
+def test_concurrent_clicks_from_two_workers_both_land(db_file):
+    worker_a, worker_b = AttemptStore(db_file), AttemptStore(db_file)
+    token = worker_a.create(1, 7, 5).token
+    seen_by_a = worker_a.get(token, 1, 7)
+    seen_by_b = worker_b.get(token, 1, 7)
+
+    worker_a.update(seen_by_a, lambda state: state.set_answer(0, 'C'))
+    # b's copy is one version behind: its write is retried on top of a's
+    result = worker_b.update(seen_by_b, lambda state: state.set_marked(2, True))
+    assert result.version == 2
+    assert worker_b.stats['write_conflicts'] == 1
+
+    final = AttemptStore(db_file).get(token, 1, 7)
+    assert final.answer(0) == 'C' and final.is_marked(2)
+
+
+def test_cached_state_is_checked_against_the_stored_version(db_file):
+    worker_a, worker_b = AttemptStore(db_file), AttemptStore(db_file)
+    token = worker_a.create(1, 7, 5).token
+    worker_b.update(worker_b.get(token, 1, 7), lambda state: state.set_answer(4, 'D'))
+
+    assert worker_a.get(token, 1, 7).answer(4) == 'D'
+    assert worker_a.get(token, 1, 7).answer(4) == 'D'
+    assert (worker_a.stats['cache_misses'], worker_a.stats['cache_hits']) == (1, 1)
+
+
+def test_deleted_and_expired_attempts_are_gone(db_file):
+    store = AttemptStore(db_file, ttl_hours=0)
+    token = store.create(1, 7, 5).token
+    store.delete(token)
+    assert store.get(token, 1, 7) is None
+
+    stale = store.create(1, 7, 5).token
+    store._last_purge = 0
+    store.create(1, 8, 5)
+    assert store.get(stale, 1, 7) is None
+    assert store.stats['expired'] == 1
@@ -0,0 +1,73 @@
+# Keyset pagination of a user's bookmarks (app.load_bookmark_page)
+import sqlite3
+
+import pytest
+
+from dynamic_db_handler import dynamic_db_handler
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute(dynamic_db_handler.get_user_shard_schema()['user_bookmarks'])
+    # Three bookmarks per timestamp, so the page cuts fall inside runs of ties
+    for question_id in range(1, 23):
+        subject = 'Anatomy' if question_id % 2 else 'Physiology'
+        conn.execute('''INSERT INTO user_bookmarks (user_id, question_id, subject, topic, source_database, created_at)
+                        VALUES (7, ?, ?, 'T', '1st_year.db', ?)''',
+                     (question_id, subject, f'2024-01-01 10:00:{question_id // 3:02d}'))
+        conn.execute('''INSERT INTO user_bookmarks (user_id, question_id, subject, topic, source_database, created_at)
+                        VALUES (8, ?, 'Anatomy', 'T', '1st_year.db', '2024-01-01 10:00:00')''', (question_id,))
+    yield conn
+    conn.close()
+
+
+def walk(appmod, conn, subject=None, page_size=5, between_pages=None):
+    seen, cursor, pages = [], None, 0
+    while True:
+        rows, cursor = appmod.load_bookmark_page(conn, 7, subject=subject, cursor=cursor, page_size=page_size)
+        assert len(rows) <= page_size
+        seen += [row['question_id'] for row in rows]
+        pages += 1
+        if cursor is None:
+            return seen, pages
+        if between_pages:
+            between_pages()
+
+
+def newest_first(conn, subject=None):
+    query = 'SELECT question_id FROM user_bookmarks WHERE user_id = 7'
+    if subject:
+        query += f" AND subject = '{subject}'"
+    return [row[0] for row in conn.execute(query + ' ORDER BY created_at DESC, id DESC')]
+
+
+def test_pages_cover_every_bookmark_once_in_order(appmod, conn):
+    for page_size in (1, 3, 5, 22, 50):
+        seen, pages = walk(appmod, conn, page_size=page_size)
+        assert seen == newest_first(conn)
+        assert pages == max(1, -(-22 // page_size))
+
+
+def test_subject_filter_pages_only_that_subject(appmod, conn):
+    seen, _ = walk(appmod, conn, subject='anatomy', page_size=4)
+    assert seen == newest_first(conn, 'Anatomy')
+    assert len(seen) == 11
+
+
+def test_bookmarks_added_while_paging_do_not_shift_later_pages(appmod, conn):
+    expected = newest_first(conn)
+    added = iter(range(100, 200))
+
+    def bookmark_something_new():
+        conn.execute('''INSERT INTO user_bookmarks (user_id, question_id, subject, topic, source_database, created_at)
+                        VALUES (7, ?, 'Anatomy', 'T', '1st_year.db', '2024-01-02 00:00:00')''', (next(added),))
+    seen, _ = walk(appmod, conn, page_size=4, between_pages=bookmark_something_new)
+    assert seen == expected
+
+
+def test_bad_cursor_starts_from_the_first_page(appmod, conn):
+    rows, cursor = appmod.load_bookmark_page(conn, 7, cursor='garbage', page_size=5)
+    assert [row['question_id'] for row in rows] == newest_first(conn)[:5]
+    assert cursor is not None
@@ -0,0 +1,113 @@
+# Per-file connection pools (dynamic_db_handler.ConnectionPool) and their reset after a fork
+import os
+import signal
+import sqlite3
+import time
+
+import pytest
+
+from dynamic_db_handler import ConnectionPool, dynamic_db_handler
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    path = str(tmp_path / 'pool.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)')
+    conn.commit()
+    conn.close()
+    yield path
+    dynamic_db_handler.close_pool(path)
+
+
+def test_closed_connection_goes_back_to_the_pool(db_file):
+    conn = dynamic_db_handler.get_connection(db_file)
+    raw = conn._conn
+    conn.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute('SELECT 1')
+
+    again = dynamic_db_handler.get_connection(db_file)
+    assert again._conn is raw
+    again.close()
+
+
+def test_release_rolls_back_uncommitted_writes(db_file):
+    conn = dynamic_db_handler.get_connection(db_file, readonly=False)
+    conn.execute("INSERT INTO items (name) VALUES ('draft')")
+    conn.close()
+
+    conn = dynamic_db_handler.get_connection(db_file)
+    assert conn.execute('SELECT COUNT(*) FROM items').fetchone()[0] == 0
+    conn.close()
+
+
+def test_full_pool_times_out(db_file):
+    pool = ConnectionPool(db_file, max_size=1, timeout=0.05)
+    held = pool.acquire()
+    with pytest.raises(sqlite3.OperationalError, match='exhausted'):
+        pool.acquire()
+    held.close()
+    pool.acquire().close()
+    assert pool.get_stats()['timeouts'] == 1
+    pool.close_all()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_child_gets_fresh_pools_even_if_the_lock_was_held(db_file):
+    conn = dynamic_db_handler.get_connection(db_file)
+    parent_raw = conn._conn
+    conn.close()
+    parent_pools = dynamic_db_handler._pools
+
+    # As if another thread was creating a pool at the moment a worker was forked
+    with dynamic_db_handler._pools_lock:
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                if dynamic_db_handler._pools_lock.acquire(timeout=2):
+                    dynamic_db_handler._pools_lock.release()
+                    child = dynamic_db_handler.get_connection(db_file)
+                    fresh = child._conn is not parent_raw
+                    child.close()
+                    kept = dynamic_db_handler._inherited_pools[-1] is parent_pools
+                    status = 0 if fresh and kept else 2
+            finally:
+                os._exit(status)
+    # A child stuck on the inherited lock would never exit
+    deadline = time.monotonic() + 10
+    while True:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done or time.monotonic() > deadline:
+            break
+        time.sleep(0.01)
+    if not done:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    assert done and os.waitstatus_to_exitcode(status) == 0
+
+    # The parent's pooled connection survived the child
+    conn = dynamic_db_handler.get_connection(db_file)
+    assert conn._conn is parent_raw
+    assert conn.execute('SELECT COUNT(*) FROM items').fetchone()[0] == 0
+    conn.close()
+
+
+def count_items(db_file):
+    conn = sqlite3.connect(db_file)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_request_teardown_drops_uncommitted_writes(appmod, db_file):
+    with appmod.app.test_request_context('/'):
+        conn = dynamic_db_handler.get_connection(db_file, readonly=False)
+        conn.execute("INSERT INTO items (name) VALUES ('kept')")
+        conn.commit()
+        # A helper that gave up half-way and swallowed the error
+        conn.execute("INSERT INTO items (name) VALUES ('half-done')")
+        conn.close()
+    assert count_items(db_file) == 1
@@ -0,0 +1,46 @@
+# Database discovery snapshot and its change detection (dynamic_db_handler.py)
+import os
+import sqlite3
+
+import pytest
+
+from conftest import DATA_DIR, seed_qbank
+
+
+def test_discovery_snapshot_is_read_only(appmod):
+    snapshot = appmod.dynamic_db_handler.discovered_databases
+    assert [os.path.basename(db['file']) for db in snapshot['qbank']] == ['1st_year.db']
+    with pytest.raises(TypeError):
+        snapshot['qbank'] = []
+    with pytest.raises(TypeError):
+        snapshot['qbank'][0]['file'] = 'other.db'
+
+
+def test_user_database_writes_do_not_trigger_a_rescan(appmod):
+    handler = appmod.dynamic_db_handler
+    handler.check_for_database_changes()
+    rescans = handler.discovery_stats['rescans']
+
+    conn = sqlite3.connect(os.path.join(DATA_DIR, 'admin_users.db'))
+    conn.execute("INSERT INTO users (username, email, password) VALUES ('w', 'wal@example.com', 'x')")
+    conn.commit()
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+
+    assert handler.check_for_database_changes() is False
+    assert handler.discovery_stats['rescans'] == rescans
+
+
+def test_new_content_database_is_picked_up(appmod):
+    handler = appmod.dynamic_db_handler
+    path = os.path.join(DATA_DIR, '2nd_year.db')
+    seed_qbank(path)
+    try:
+        assert handler.check_for_database_changes() is True
+        assert sorted(os.path.basename(db['file']) for db in handler.discovered_databases['qbank']) == [
+            '1st_year.db', '2nd_year.db']
+    finally:
+        handler.close_pool(path)
+        os.remove(path)
+        handler.check_for_database_changes()
+    assert os.path.abspath(handler.lookup_subject_database('Anatomy')) == os.path.join(DATA_DIR, '1st_year.db')
@@ -0,0 +1,119 @@
+# Versioned schema migrations (migrations.py) as run by dynamic_db_handler.migrate_database
+import os
+import sqlite3
+import subprocess
+import sys
+
+from conftest import ROOT, seed_qbank
+from dynamic_db_handler import dynamic_db_handler
+from migrations import MIGRATIONS
+
+
+def create_file(path, *categories, user_version=0):
+    conn = sqlite3.connect(path)
+    for category in categories:
+        for create_sql in dynamic_db_handler.db_categories[category]['schema'].values():
+            conn.execute(create_sql)
+    conn.execute(f'PRAGMA user_version = {user_version}')
+    conn.commit()
+    conn.close()
+    return str(path)
+
+
+def query(db_file, sql):
+    conn = sqlite3.connect(db_file)
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+
+def tables(db_file):
+    return {name for name, in query(db_file, "SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def latest(category):
+    return MIGRATIONS[category][-1][0]
+
+
+def test_each_category_of_a_file_keeps_its_own_version(tmp_path):
+    db_file = create_file(tmp_path / 'mcq_test.db', 'mcq', 'test')
+    for category in ('mcq', 'test'):
+        assert dynamic_db_handler.migrate_database(db_file, category)[0]
+    dynamic_db_handler.close_pool(db_file)
+
+    assert dict(query(db_file, 'SELECT category, version FROM schema_migrations')) == {
+        'mcq': latest('mcq'), 'test': latest('test')}
+    assert 'test_attempt_state' in tables(db_file)
+
+
+def test_shared_legacy_user_version_is_not_trusted(tmp_path):
+    # The old single counter: mcq ran v1-v2, then test skipped its v1-v2 and ran v3-v4
+    db_file = create_file(tmp_path / 'mcq_test.db', 'mcq', 'test', user_version=4)
+    assert dynamic_db_handler.migrate_database(db_file, 'test')[0]
+    dynamic_db_handler.close_pool(db_file)
+
+    assert 'test_attempt_state' in tables(db_file)
+    assert query(db_file, "SELECT version FROM schema_migrations WHERE category = 'test'") == [(latest('test'),)]
+
+
+def test_legacy_user_version_of_a_single_category_file_is_kept(tmp_path):
+    db_file = create_file(tmp_path / 'mock_test.db', 'test', user_version=latest('test'))
+    assert dynamic_db_handler.migrate_database(db_file, 'test')[0]
+    dynamic_db_handler.close_pool(db_file)
+
+    # Nothing pending, so nothing ran again
+    assert 'test_attempt_state' not in tables(db_file)
+
+
+def test_file_without_the_category_tables_is_skipped(tmp_path):
+    db_file = str(tmp_path / 'test_results.db')
+    sqlite3.connect(db_file).close()
+    success, message = dynamic_db_handler.migrate_database(db_file, 'test')
+    dynamic_db_handler.close_pool(db_file)
+
+    assert success and 'not migrated' in message
+    assert tables(db_file) == set()
+
+
+def run_python(data_dir, *args):
+    return subprocess.run([sys.executable, *args], cwd=ROOT, env={**os.environ, 'DATA_DIR': str(data_dir)},
+                          capture_output=True, text=True, timeout=60)
+
+
+def test_migrations_imports_first_without_touching_databases(tmp_path):
+    seed_qbank(str(tmp_path / '1st_year.db'))
+    result = run_python(tmp_path, '-c', 'import migrations, dynamic_db_handler')
+    assert result.returncode == 0, result.stderr
+    assert 'catalog_topics' not in tables(str(tmp_path / '1st_year.db'))
+
+
+def test_status_reports_without_migrating(tmp_path):
+    db_file = str(tmp_path / '1st_year.db')
+    seed_qbank(db_file)
+    result = run_python(tmp_path, 'migrations.py', '--status')
+    assert result.returncode == 0, result.stderr
+    assert f"{db_file}: qbank v0 ({latest('qbank')} pending)" in result.stdout
+    assert tables(db_file) == {'qbank', 'sqlite_sequence'}
+
+
+def test_mcq_columns_come_from_the_migrations(tmp_path):
+    db_file = str(tmp_path / 'old_mcq.db')
+    conn = sqlite3.connect(db_file)
+    conn.execute('CREATE TABLE mcq_questions (id INTEGER PRIMARY KEY, subject TEXT, topic TEXT, question TEXT)')
+    conn.execute('CREATE TABLE mcq_tests (id INTEGER PRIMARY KEY, test_name TEXT, subject TEXT)')
+    conn.close()
+    try:
+        assert dynamic_db_handler.migrate_database(db_file, 'mcq')[0]
+        assert {'chapter', 'difficulty', 'source'} <= {row[1] for row in query(db_file, 'PRAGMA table_info(mcq_questions)')}
+        assert 'is_public' in {row[1] for row in query(db_file, 'PRAGMA table_info(mcq_tests)')}
+
+        # Dropped by hand after the migration ran: the next migrate_database puts it back
+        dynamic_db_handler.close_pool(db_file)
+        conn = sqlite3.connect(db_file)
+        conn.execute('ALTER TABLE mcq_questions DROP COLUMN source')
+        conn.close()
+        assert dynamic_db_handler.migrate_database(db_file, 'mcq')[0]
+        assert 'source' in {row[1] for row in query(db_file, 'PRAGMA table_info(mcq_questions)')}
+    finally:
+        dynamic_db_handler.close_pool(db_file)
@@ -0,0 +1,44 @@
+# Full-text search over a user's own notes: /notes/search (app.py)
+from conftest import flush_user_writes
+
+
+def save_note(client, question_id, note):
+    assert client.post('/save_note', json={'question_id': question_id, 'subject': 'Anatomy',
+                                           'note': note}).get_json() == {'success': True}
+
+
+def search(client, text):
+    return client.get('/notes/search', query_string={'q': text})
+
+
+def test_search_finds_own_notes_by_word_prefix(appmod, client, user):
+    save_note(client, 1, 'Appendicitis: pain starts around the umbilicus')
+    save_note(client, 4, 'Renal colic radiates to the groin')
+    flush_user_writes(appmod)
+
+    results = search(client, 'append').get_json()['results']
+    assert [r['question_id'] for r in results] == [1]
+    assert results[0]['snippet'].startswith('<mark>Appendicitis</mark>')
+    assert (results[0]['subject'], results[0]['topic']) == ('Anatomy', 'Appendix')
+    assert [r['question_id'] for r in search(client, 'renal groin').get_json()['results']] == [4]
+
+
+def test_other_users_notes_are_not_searched(appmod, client, user):
+    other = appmod.app.test_client()
+    other.post('/signup', data={'username': 'other', 'email': 'notes-other@example.com', 'password': 'pw'})
+    other.post('/login', data={'username': 'notes-other@example.com', 'password': 'pw'})
+    save_note(other, 2, 'ligament of Treitz')
+    flush_user_writes(appmod)
+
+    assert search(client, 'treitz').get_json()['results'] == []
+    assert [r['question_id'] for r in search(other, 'treitz').get_json()['results']] == [2]
+
+
+def test_query_syntax_in_the_text_is_searched_literally(client, user):
+    response = search(client, 'NOT "owner : u1" OR *')
+    assert response.status_code == 200
+    assert response.get_json()['results'] == []
+
+
+def test_search_requires_login(client):
+    assert search(client, 'append').status_code == 401
@@ -0,0 +1,111 @@
+# Password hashing pool (password_hashing.py) and the admin blueprint's login (admin.py)
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+from flask import Flask
+from werkzeug.security import generate_password_hash
+
+import admin
+from password_hashing import PasswordHasher, PasswordHashingBusy
+
+CHEAP = 'pbkdf2:sha256:1000'
+
+
+@pytest.fixture
+def pooled():
+    hasher = PasswordHasher(workers=1, max_queue=0, timeout=5, method=CHEAP)
+    yield hasher
+    hasher.stop()
+
+
+def test_inline_hash_and_verify():
+    hasher = PasswordHasher(workers=0, method=CHEAP)
+    stored = hasher.hash('secret')
+    assert stored.startswith('pbkdf2:sha256:1000$')
+    assert hasher.verify(stored, 'secret') == (True, None)
+    assert hasher.verify(stored, 'wrong') == (False, None)
+
+
+def test_hash_made_with_other_parameters_is_replaced_on_login():
+    hasher = PasswordHasher(workers=0, method=CHEAP)
+    ok, new_hash = hasher.verify(generate_password_hash('secret', 'pbkdf2:sha256:2000'), 'secret')
+    assert ok and new_hash.startswith('pbkdf2:sha256:1000$')
+    assert hasher.get_stats()['rehashed'] == 1
+
+
+def test_worker_process_verifies(pooled):
+    stored = pooled.hash('secret')
+    assert pooled.verify(stored, 'secret') == (True, None)
+    assert pooled.get_stats()['inflight'] == 0
+
+
+def test_full_pool_refuses_at_once(pooled):
+    pooled.start()
+    busy = threading.Thread(target=pooled._run, args=(time.sleep, 0.5))
+    busy.start()
+    time.sleep(0.05)
+    try:
+        with pytest.raises(PasswordHashingBusy, match='Too many'):
+            pooled.hash('secret')
+    finally:
+        busy.join()
+    assert pooled.get_stats()['rejected'] == 1
+
+
+def test_slow_hash_times_out(pooled):
+    pooled.timeout = 0.05
+    with pytest.raises(PasswordHashingBusy, match='timed out'):
+        pooled._run(time.sleep, 0.5)
+    assert pooled.get_stats()['timeouts'] == 1
+
+
+def test_forked_server_worker_gets_a_pool_of_its_own(pooled):
+    pooled.start()
+    parent_pool = pooled._executor
+    pid = os.fork()
+    if pid == 0:
+        # Built by the after-fork hook, before this process could start any thread
+        ok = (pooled._executor is not None and pooled._executor is not parent_pool
+              and pooled._pid == os.getpid() and pooled.verify(pooled.hash('pw'), 'pw')[0])
+        pooled.stop()
+        os._exit(0 if ok else 1)
+    deadline = time.monotonic() + 10
+    while True:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            break
+        if time.monotonic() > deadline:
+            os.kill(pid, 9)
+            os.waitpid(pid, 0)
+            pytest.fail('forked worker hung')
+        time.sleep(0.05)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert pooled._executor is parent_pool
+
+
+def test_admin_blueprint_login_stores_the_upgraded_hash(tmp_path, monkeypatch):
+    db_file = str(tmp_path / 'admin_users.db')
+    conn = sqlite3.connect(db_file)
+    conn.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT, email TEXT, '
+                 'password TEXT, user_type TEXT)')
+    conn.execute("INSERT INTO users VALUES (1, 'root', 'root@example.com', ?, 'admin')",
+                 (generate_password_hash('secret', 'pbkdf2:sha256:2000'),))
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(admin, 'USER_DB_FILE', db_file)
+    monkeypatch.setattr(admin, 'password_hasher', PasswordHasher(workers=0, method=CHEAP))
+
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.register_blueprint(admin.admin_bp)
+    response = app.test_client().post('/admin/login', data={'username': 'root@example.com',
+                                                            'password': 'secret'})
+    assert response.status_code == 302 and response.location.endswith('/admin/dashboard')
+
+    conn = sqlite3.connect(db_file)
+    stored, = conn.execute('SELECT password FROM users WHERE id = 1').fetchone()
+    conn.close()
+    assert stored.startswith('pbkdf2:sha256:1000$')
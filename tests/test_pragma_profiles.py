@@ -0,0 +1,86 @@
+# Per-category SQLite PRAGMA profiles applied to pooled connections (dynamic_db_handler.py)
+import sqlite3
+
+import pytest
+
+from dynamic_db_handler import DEFAULT_PRAGMA_PROFILES, apply_pragma_profile, dynamic_db_handler, load_pragma_profiles
+
+
+def create_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)')
+    conn.commit()
+    conn.close()
+    return path
+
+
+def pragma(conn, name):
+    return conn.execute(f'PRAGMA {name}').fetchone()[0]
+
+
+@pytest.fixture
+def pool_files():
+    files = []
+    yield files
+    for path in files:
+        dynamic_db_handler.close_pool(path)
+
+
+def test_query_only_rejects_writes_on_read_connections(tmp_path):
+    conn = sqlite3.connect(create_db(str(tmp_path / 'content.db')))
+    apply_pragma_profile(conn, DEFAULT_PRAGMA_PROFILES['read_heavy'], readonly=True)
+    assert pragma(conn, 'query_only') == 1
+    with pytest.raises(sqlite3.OperationalError, match='readonly'):
+        conn.execute("INSERT INTO items (name) VALUES ('x')")
+    conn.close()
+
+
+def test_writers_skip_query_only_and_readers_skip_journal_mode(tmp_path):
+    path = create_db(str(tmp_path / 'content.db'))
+    conn = sqlite3.connect(path)
+    apply_pragma_profile(conn, DEFAULT_PRAGMA_PROFILES['read_heavy'], readonly=False)
+    assert pragma(conn, 'query_only') == 0
+    conn.execute("INSERT INTO items (name) VALUES ('x')")
+    conn.commit()
+    apply_pragma_profile(conn, DEFAULT_PRAGMA_PROFILES['write_heavy'], readonly=True)
+    assert pragma(conn, 'journal_mode') == 'delete'
+    conn.close()
+
+
+def test_content_reads_get_the_read_heavy_profile(tmp_path, pool_files):
+    path = create_db(str(tmp_path / 'pragma_year.db'))
+    pool_files.append(path)
+    conn = dynamic_db_handler.get_connection(path)
+    try:
+        assert pragma(conn, 'query_only') == 1
+        assert pragma(conn, 'cache_size') == -32000
+        assert pragma(conn, 'temp_store') == 2  # MEMORY
+    finally:
+        conn.close()
+    assert dynamic_db_handler._get_pool(path, True).get_stats()['profile'] == 'read_heavy'
+
+
+def test_user_database_writers_run_in_wal(tmp_path, pool_files):
+    path = create_db(str(tmp_path / 'admin_users.db'))
+    pool_files.append(path)
+    conn = dynamic_db_handler.get_connection(path, readonly=False)
+    try:
+        assert pragma(conn, 'journal_mode') == 'wal'
+        assert pragma(conn, 'synchronous') == 1  # NORMAL
+        assert pragma(conn, 'busy_timeout') == 10000
+        assert pragma(conn, 'query_only') == 0
+        conn.execute("INSERT INTO items (name) VALUES ('x')")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_profile_overrides_merge_and_bad_json_is_ignored(monkeypatch):
+    monkeypatch.setenv('DB_PRAGMA_PROFILES', '{"read_heavy": {"cache_size": -64000}, "tiny": {"cache_size": 100}}')
+    profiles = load_pragma_profiles()
+    assert profiles['read_heavy']['cache_size'] == -64000
+    assert profiles['read_heavy']['query_only'] == 'ON'
+    assert profiles['tiny'] == {'cache_size': 100}
+
+    monkeypatch.setenv('DB_PRAGMA_PROFILES', 'not json')
+    assert load_pragma_profiles() == DEFAULT_PRAGMA_PROFILES
@@ -0,0 +1,51 @@
+# Hot qbank query plans and the guard against full scans (dynamic_db_handler.py)
+import sqlite3
+
+import pytest
+
+import dynamic_db_handler as handler_module
+from conftest import seed_qbank
+from db_schema import QBANK_INDEXES
+from dynamic_db_handler import QueryPlanError, dynamic_db_handler, verify_qbank_query_plans
+
+
+@pytest.fixture
+def qbank_file(tmp_path):
+    path = str(tmp_path / 'plans_year.db')
+    seed_qbank(path)
+    assert dynamic_db_handler.migrate_database(path, 'qbank')[0]
+    yield path
+    dynamic_db_handler.close_pool(path)
+
+
+def test_migrated_qbank_passes_the_guard(qbank_file):
+    conn = sqlite3.connect(qbank_file)
+    verify_qbank_query_plans(conn)
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {handler_module.QBANK_QUERIES['topic_question_ids']}",
+                        ('Anatomy', 'Appendix')).fetchall()
+    assert any('USING' in row[3] and 'INDEX' in row[3] for row in plan)
+    conn.close()
+
+
+def test_dropped_indexes_raise_query_plan_error(qbank_file):
+    conn = sqlite3.connect(qbank_file)
+    for name in QBANK_INDEXES:
+        conn.execute(f'DROP INDEX {name}')
+    with pytest.raises(QueryPlanError, match='topic_question_ids: SCAN qbank'):
+        verify_qbank_query_plans(conn)
+    conn.close()
+
+    # migrate_database puts them back before it checks the plans
+    assert dynamic_db_handler.migrate_database(qbank_file, 'qbank')[0]
+    conn = sqlite3.connect(qbank_file)
+    verify_qbank_query_plans(conn)
+    conn.close()
+
+
+def test_lower_subject_query_is_reported_as_a_regression(qbank_file, monkeypatch):
+    queries = dict(handler_module.QBANK_QUERIES)
+    queries['topic_question_ids'] = 'SELECT id FROM qbank WHERE LOWER(subject) = ? AND topic = ? ORDER BY id'
+    monkeypatch.setattr(handler_module, 'QBANK_QUERIES', queries)
+    success, message = dynamic_db_handler.migrate_database(qbank_file, 'qbank')
+    assert not success
+    assert 'QUERY PLAN REGRESSION' in message
@@ -0,0 +1,76 @@
+# Per-topic question id arrays cached until their database changes (dynamic_db_handler.py)
+import sqlite3
+from array import array
+
+import pytest
+
+from conftest import seed_qbank
+from dynamic_db_handler import QuestionIdCache, dynamic_db_handler
+
+
+def ids(*values):
+    return array('q', values)
+
+
+def entry_size(count):
+    return 8 * count + QuestionIdCache.ENTRY_OVERHEAD
+
+
+def test_least_recently_used_topic_is_evicted_first():
+    cache = QuestionIdCache(max_bytes=3 * entry_size(2))
+    for topic in 'abc':
+        cache.put(('x.db', 'anatomy', topic), 'sig', ids(1, 2))
+    assert cache.get(('x.db', 'anatomy', 'a'), 'sig') == ids(1, 2)
+    cache.put(('x.db', 'anatomy', 'd'), 'sig', ids(3, 4))
+
+    assert cache.get(('x.db', 'anatomy', 'b'), 'sig') is None
+    for topic in 'acd':
+        assert cache.get(('x.db', 'anatomy', topic), 'sig') is not None
+    stats = cache.get_stats()
+    assert (stats['entries'], stats['bytes'], stats['evictions']) == (3, 3 * entry_size(2), 1)
+
+
+def test_replacing_an_entry_keeps_the_byte_count_and_oversized_arrays_are_skipped():
+    cache = QuestionIdCache(max_bytes=entry_size(10))
+    cache.put(('x.db', 'anatomy', 'a'), 'sig', ids(1, 2, 3))
+    cache.put(('x.db', 'anatomy', 'a'), 'sig', ids(1, 2))
+    cache.put(('x.db', 'anatomy', 'big'), 'sig', array('q', range(11)))
+    assert cache.get_stats()['bytes'] == entry_size(2)
+    assert cache.get(('x.db', 'anatomy', 'big'), 'sig') is None
+
+
+def test_changed_signature_and_invalidate_drop_entries():
+    cache = QuestionIdCache(max_bytes=10 * entry_size(1))
+    cache.put(('x.db', 'anatomy', 'a'), 'old', ids(1))
+    cache.put(('y.db', 'anatomy', 'a'), 'old', ids(1))
+    assert cache.get(('x.db', 'anatomy', 'a'), 'new') is None
+    assert cache.get(('x.db', 'anatomy', 'a'), 'old') is None
+    assert cache.get_stats()['stale'] == 1
+
+    cache.put(('x.db', 'anatomy', 'b'), 'old', ids(1))
+    cache.invalidate('x.db')
+    assert cache.get(('y.db', 'anatomy', 'a'), 'old') == ids(1)
+    assert cache.get_stats()['bytes'] == entry_size(1)
+
+
+@pytest.fixture
+def qbank_file(tmp_path):
+    path = str(tmp_path / 'cache_year.db')
+    seed_qbank(path)
+    yield path
+    dynamic_db_handler.close_pool(path)
+
+
+def test_topic_ids_reload_after_the_database_changes(qbank_file):
+    assert list(dynamic_db_handler.get_topic_question_ids(qbank_file, 'anatomy', 'Appendix')) == [1, 2, 3]
+    hits = dynamic_db_handler.question_id_cache.get_stats()['hits']
+    assert list(dynamic_db_handler.get_topic_question_ids(qbank_file, 'Anatomy', 'Appendix')) == [1, 2, 3]
+    assert dynamic_db_handler.question_id_cache.get_stats()['hits'] == hits + 1
+
+    conn = sqlite3.connect(qbank_file)
+    conn.execute("INSERT INTO qbank (id, subject, topic, question) VALUES (50, 'Anatomy', 'Appendix', 'new')")
+    conn.commit()
+    conn.close()
+    stale = dynamic_db_handler.question_id_cache.get_stats()['stale']
+    assert list(dynamic_db_handler.get_topic_question_ids(qbank_file, 'Anatomy', 'Appendix')) == [1, 2, 3, 50]
+    assert dynamic_db_handler.question_id_cache.get_stats()['stale'] == stale + 1
@@ -0,0 +1,104 @@
+# Shared token-bucket rate limiter (rate_limiter.py)
+import os
+
+import pytest
+from flask import Flask, jsonify
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from rate_limiter import RateLimiter, load_rate_limits, parse_limit
+
+
+@pytest.fixture
+def limiter(tmp_path):
+    return RateLimiter(db_file=str(tmp_path / 'rate_limits.db'),
+                       limits={'login': parse_limit('3/60'), 'search': None})
+
+
+def test_parse_limit():
+    assert parse_limit('10/60') == (10.0, 10 / 60)
+    assert parse_limit('off') is None
+    with pytest.raises(ValueError):
+        parse_limit('0/60')
+
+
+def test_overrides_come_from_the_environment(monkeypatch):
+    monkeypatch.setenv('RATE_LIMITS', '{"login": "off", "export": "1/10"}')
+    limits = load_rate_limits()
+    assert limits['login'] is None
+    assert limits['export'] == (1.0, 0.1)
+    assert limits['signup'] == parse_limit('5/300')
+
+
+def test_burst_then_retry_after(limiter):
+    keys = [('ip', '10.0.0.1')]
+    assert [limiter.check('login', keys)[0] for _ in range(3)] == [True, True, True]
+    assert limiter.check('login', keys) == (False, 20)
+    # Another client has its own bucket; an unlimited route has none
+    assert limiter.check('login', [('ip', '10.0.0.2')]) == (True, 0)
+    assert all(limiter.check('search', keys)[0] for _ in range(10))
+
+
+def test_rejected_call_does_not_cost_the_other_keys(limiter):
+    for _ in range(3):
+        assert limiter.check('login', [('ip', 'shared-nat'), ('user', 1)])[0]
+    # User 1 is out of tokens; the IP's bucket gets its token back
+    assert not limiter.check('login', [('ip', 'office'), ('user', 1)])[0]
+    assert limiter.check('login', [('ip', 'office'), ('user', 2)])[0]
+    assert limiter.check('login', [('ip', 'office'), ('user', 3)])[0]
+    assert limiter.check('login', [('ip', 'office'), ('user', 4)])[0]
+    assert not limiter.check('login', [('ip', 'office'), ('user', 5)])[0]
+    assert limiter.get_stats()['all_workers']['login']['user'] == {'allowed': 6, 'rejected': 1}
+
+
+def test_unusable_database_lets_requests_through(tmp_path):
+    limiter = RateLimiter(db_file=os.path.join(str(tmp_path), 'missing', 'rate_limits.db'),
+                          limits={'login': parse_limit('1/60')})
+    assert limiter.check('login', [('ip', '10.0.0.1')]) == (True, 0)
+    assert limiter.check('login', [('ip', '10.0.0.1')]) == (True, 0)
+    assert limiter.get_stats()['this_process']['login']['backend_errors'] == 2
+
+
+def test_decorator_answers_429_with_retry_after(limiter):
+    app = Flask(__name__)
+    app.secret_key = 'test'
+
+    @app.route('/login', methods=['GET', 'POST'])
+    @limiter.limit('login', methods=['POST'])
+    def login():
+        return jsonify({'success': True})
+
+    client = app.test_client()
+    for _ in range(3):
+        assert client.post('/login', json={}).status_code == 200
+    response = client.post('/login', json={})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '20'
+    assert response.get_json()['success'] is False
+    assert client.get('/login').status_code == 200
+
+
+def test_clients_behind_the_proxy_and_accounts_have_their_own_buckets(limiter):
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+
+    @app.route('/login', methods=['POST'])
+    @limiter.limit('login', methods=['POST'], account_field='username')
+    def login():
+        return jsonify({'success': True})
+
+    client = app.test_client()
+
+    def attempt(client_ip, email):
+        return client.post('/login', data={'username': email, 'password': 'x'},
+                           headers={'X-Forwarded-For': client_ip}).status_code
+
+    # One client using up its bucket leaves the others behind the same proxy alone
+    assert [attempt('203.0.113.1', f'u{i}@example.com') for i in range(4)] == [200, 200, 200, 429]
+    assert attempt('203.0.113.2', 'u9@example.com') == 200
+    # Guesses at one account are limited however many addresses they come from
+    assert [attempt(f'198.51.100.{i}', ' Victim@Example.com') for i in range(4)] == [200, 200, 200, 429]
+
+
+def test_app_trusts_the_reverse_proxy(appmod):
+    assert isinstance(appmod.app.wsgi_app, ProxyFix)
@@ -0,0 +1,113 @@
+# In-memory study-activity counters flushed into user_analytics (study_analytics.py)
+import datetime
+import json
+import sqlite3
+
+import pytest
+
+import study_analytics
+from dynamic_db_handler import dynamic_db_handler
+from study_analytics import StudyActivityAggregator
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(study_analytics.time, 'monotonic', clock)
+    return clock
+
+
+def create_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute(dynamic_db_handler.get_user_shard_schema()['user_analytics'])
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    path = create_db(str(tmp_path / 'analytics.db'))
+    yield path
+    dynamic_db_handler.close_pool(path)
+
+
+@pytest.fixture
+def make_aggregator():
+    aggregators = []
+
+    def make(db_file):
+        aggregator = StudyActivityAggregator(db_file, flush_interval=3600, session_gap_minutes=30)
+        aggregators.append(aggregator)
+        return aggregator
+    yield make
+    for aggregator in aggregators:
+        aggregator._stop.set()
+
+
+def stored(db_file, user_id):
+    conn = sqlite3.connect(db_file)
+    conn.row_factory = sqlite3.Row
+    try:
+        row = conn.execute('SELECT * FROM user_analytics WHERE user_id = ? AND date = ?',
+                           (user_id, datetime.date.today().isoformat())).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def test_counters_add_up_across_flushes(make_aggregator, db_file, clock):
+    aggregator = make_aggregator(db_file)
+    aggregator.record(7, 'question_viewed', '/data/1st_year.db')
+    aggregator.record(7, 'answer_viewed', '/data/1st_year.db')
+    aggregator.record(7, 'unknown_event')
+    aggregator.record(None, 'question_viewed')
+    assert aggregator.flush() == 1
+
+    aggregator.record(7, 'question_viewed', '/data/2nd_year.db')
+    assert aggregator.flush() == 1
+    row = stored(db_file, 7)
+    assert (row['questions_viewed'], row['answers_viewed']) == (2, 1)
+    assert sorted(json.loads(row['databases_accessed'])) == ['1st_year.db', '2nd_year.db']
+
+
+def test_study_time_is_the_gaps_within_a_session(make_aggregator, db_file, clock):
+    aggregator = make_aggregator(db_file)
+    for offset in (0, 90, 150):
+        clock.now = 1000 + offset
+        aggregator.record(7, 'question_viewed')
+    aggregator.flush()
+    assert stored(db_file, 7)['study_time_minutes'] == 2
+
+    # 30 leftover seconds plus 30 more make the third minute; a long break adds nothing
+    clock.now = 1180
+    aggregator.record(7, 'question_viewed')
+    clock.now = 1180 + 31 * 60
+    aggregator.record(7, 'question_viewed')
+    aggregator.flush()
+    assert stored(db_file, 7)['study_time_minutes'] == 3
+    assert aggregator.stats['sessions'] == 2
+
+
+def test_failed_flush_keeps_the_counts(make_aggregator, tmp_path, clock):
+    path = str(tmp_path / 'later.db')
+    sqlite3.connect(path).close()
+    aggregator = make_aggregator(path)
+    aggregator.record(7, 'topic_completed')
+    assert aggregator.flush() == 0
+    assert aggregator.stats['flush_errors'] == 1
+
+    create_db(path)
+    try:
+        assert aggregator.flush() == 1
+        assert stored(path, 7)['topics_completed'] == 1
+    finally:
+        dynamic_db_handler.close_pool(path)
@@ -0,0 +1,19 @@
+# Subject routing index (dynamic_db_handler.py)
+import os
+
+from conftest import DATA_DIR
+
+
+def test_subjects_route_to_their_database(appmod):
+    handler = appmod.dynamic_db_handler
+    path = os.path.join(DATA_DIR, '1st_year.db')
+    assert os.path.abspath(handler.lookup_subject_database('Anatomy')) == path
+    assert os.path.abspath(handler.lookup_subject_database('physiology')) == path
+    assert handler.lookup_subject_database('Botany') is None
+
+
+def test_subject_totals_come_from_the_topic_catalog(appmod):
+    totals = appmod.get_all_qbank_subjects()
+    assert totals['Anatomy'][0]['question_count'] == 5
+    assert totals['Anatomy'][0]['topic_count'] == 2
+    assert totals['Physiology'][0]['question_count'] == 2
@@ -0,0 +1,39 @@
+# Subject page built from a constant number of connections and queries (app.show_subject)
+import pytest
+
+
+@pytest.fixture
+def statements(appmod, monkeypatch):
+    """SQL statements run on the request's connections"""
+    handler = appmod.dynamic_db_handler
+    original = handler._get_request_connection
+    seen, traced_conns = [], []
+
+    def traced(db_file, readonly):
+        conn = original(db_file, readonly)
+        conn._conn.set_trace_callback(seen.append)
+        traced_conns.append(conn._conn)
+        return conn
+    monkeypatch.setattr(handler, '_get_request_connection', traced)
+    yield seen
+    for raw in traced_conns:
+        raw.set_trace_callback(None)
+
+
+def load_subject(client, subject, statements):
+    statements.clear()
+    response = client.get(f'/subject/{subject}')
+    assert response.status_code == 200
+    return int(response.headers['X-DB-Connections-Opened']), len(statements)
+
+
+def test_subject_page_cost_does_not_grow_with_the_topic_count(client, user, statements):
+    # Anatomy has two topics, Physiology one; the qbank file and the user's shard
+    anatomy = load_subject(client, 'Anatomy', statements)
+    physiology = load_subject(client, 'Physiology', statements)
+    assert anatomy[0] == physiology[0] == 2
+    assert anatomy[1] == physiology[1]
+
+
+def test_anonymous_subject_page_opens_no_more_connections(client, statements):
+    assert load_subject(client, 'Anatomy', statements)[0] <= 2
@@ -0,0 +1,63 @@
+# Taking a test end to end: attempt state, submit, and the review pages (test.py)
+import os
+import re
+import sqlite3
+
+
+def stored_rows(sql, params=()):
+    conn = sqlite3.connect(os.environ['TEST_DB_FILE'])
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def answer(client, q_num, nav, option=None):
+    data = {'nav': nav}
+    if option:
+        data['answer'] = option
+    return client.post(f'/tests/1/question/{q_num}', data=data)
+
+
+def take_test(client):
+    """Key is a b c d a: two right, one wrong, one skipped, one never answered"""
+    client.get('/tests/1/start')
+    answer(client, 1, 'next', 'A')
+    answer(client, 2, 'next', 'C')
+    answer(client, 3, 'skip')
+    assert client.post('/tests/1/question/4/toggle_mark').get_json() == {'success': True, 'marked': True}
+    return answer(client, 5, 'submit', 'A')
+
+
+def test_submit_grades_the_attempt(appmod, client, user):
+    user_id, _ = user
+    take_test(client)
+    client.post('/tests/1/submit')
+
+    assert stored_rows('SELECT total, correct, wrong, unanswered FROM test_attempts WHERE user_id = ?',
+                     (user_id,)) == [(5, 2, 1, 2)]
+    assert stored_rows('''SELECT user_answer FROM user_responses WHERE user_id = ?
+                                ORDER BY question_id''', (user_id,)) == [('A',), ('C',), (None,), (None,), ('A',)]
+
+
+def test_submitting_twice_stores_one_attempt(appmod, client, user):
+    user_id, _ = user
+    take_test(client)
+    client.post('/tests/1/submit')
+    client.post('/tests/1/submit')
+    assert stored_rows('SELECT COUNT(*) FROM test_attempts WHERE user_id = ?', (user_id,)) == [(1,)]
+
+
+def test_review_matches_the_graded_totals(appmod, client, user):
+    take_test(client)
+    client.post('/tests/1/submit')
+
+    page = client.get('/tests/1/review-attempted').get_data(as_text=True)
+    counts = re.findall(r'<br><strong>(\d+)</strong>', page)
+    assert counts[:3] == ['2', '1', '5']
+
+    # Only the answered-and-wrong question is listed as incorrect, not the unanswered ones
+    assert 'Test question 2' in client.get('/tests/1/review/incorrect/1').get_data(as_text=True)
+    assert client.get('/tests/1/review/incorrect/2').status_code == 302
+    assert client.get('/tests/1/review/correct/3').status_code == 302
+    assert 'Test question 5' in client.get('/tests/1/review/correct/2').get_data(as_text=True)
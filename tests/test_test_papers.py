@@ -0,0 +1,90 @@
+# Compiled test-paper cache and its invalidation (test_papers.py)
+import sqlite3
+
+import pytest
+
+import test_papers
+from conftest import seed_test_db
+from dynamic_db_handler import dynamic_db_handler
+
+
+def make_test_db(path, migrate=True):
+    seed_test_db(path, dynamic_db_handler.get_test_schema())
+    if migrate:
+        assert dynamic_db_handler.migrate_database(path, 'test')[0]
+    return path
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    path = make_test_db(str(tmp_path / 'papers_test.db'))
+    yield path
+    dynamic_db_handler.close_pool(path)
+
+
+def write(db_file, sql, params=()):
+    conn = sqlite3.connect(db_file)
+    conn.execute(sql, params)
+    conn.commit()
+    conn.close()
+
+
+def test_paper_grades_by_its_answer_key(db_file):
+    paper = test_papers.TestPaperCache(db_file).get(1)
+    assert len(paper) == 5
+    assert paper.answer_key == b'\x01\x02\x03\x04\x01'
+    assert paper.position(paper.question_ids[3]) == 3
+    assert paper.grade(b'\x01\x03\x00\x04\x00') == (2, 1, 2)
+    with pytest.raises(TypeError):
+        paper.questions[0]['question'] = 'changed'
+
+
+def test_unknown_test_is_none(db_file):
+    assert test_papers.TestPaperCache(db_file).get(99) is None
+
+
+def test_answers_and_attempts_leave_the_paper_cached(db_file):
+    cache = test_papers.TestPaperCache(db_file)
+    paper = cache.get(1)
+    write(db_file, '''INSERT INTO test_attempts (test_id, user_id, total, correct, wrong, unanswered)
+                      VALUES (1, 7, 5, 0, 0, 5)''')
+    write(db_file, '''INSERT INTO user_responses (attempt_id, test_id, user_id, question_id, user_answer)
+                      VALUES (1, 1, 7, ?, 'A')''', (paper.question_ids[0],))
+    assert cache.get(1) is paper
+    assert (cache.stats['misses'], cache.stats['hits']) == (1, 1)
+
+
+@pytest.mark.parametrize('change', [
+    "UPDATE test_questions SET correct_answer = 'd' WHERE id = (SELECT MIN(id) FROM test_questions)",
+    "UPDATE test_info SET duration_minutes = 45 WHERE id = 1",
+    "DELETE FROM test_questions WHERE id = (SELECT MAX(id) FROM test_questions)",
+])
+def test_editing_the_test_recompiles_it(db_file, change):
+    cache = test_papers.TestPaperCache(db_file)
+    paper = cache.get(1)
+    write(db_file, change)
+    fresh = cache.get(1)
+    assert fresh is not paper and fresh.version != paper.version
+    assert (fresh.answer_key, dict(fresh.test), len(fresh)) != (paper.answer_key, dict(paper.test), len(paper))
+    assert cache.stats['stale'] == 1
+
+
+def test_least_recently_used_paper_is_evicted(db_file):
+    write(db_file, "INSERT INTO test_info (id, test_name, duration_minutes) VALUES (2, 'Mock 2', 30)")
+    write(db_file, '''INSERT INTO test_questions (test_id, subject, topic, question, option_a, option_b,
+                                                  option_c, option_d, correct_answer)
+                      VALUES (2, 'Anatomy', 'Kidney', 'q', 'a', 'b', 'c', 'd', 'b')''')
+    cache = test_papers.TestPaperCache(db_file, max_papers=1)
+    cache.get(1)
+    cache.get(2)
+    assert cache.get_stats()['papers'] == 1 and cache.stats['evictions'] == 1
+
+
+def test_unmigrated_file_is_compiled_every_time(tmp_path):
+    db_file = make_test_db(str(tmp_path / 'legacy_test.db'), migrate=False)
+    cache = test_papers.TestPaperCache(db_file)
+    try:
+        assert cache.get(1) is not cache.get(1)
+        assert cache.stats['unversioned'] == 2
+    finally:
+        dynamic_db_handler.close_pool(db_file)
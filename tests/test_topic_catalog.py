@@ -0,0 +1,79 @@
+# catalog_topics kept current by triggers on qbank (db_schema.py, migrations.build_topic_catalog)
+import sqlite3
+
+import pytest
+
+from conftest import seed_qbank
+from dynamic_db_handler import dynamic_db_handler
+from migrations import build_topic_catalog
+
+
+@pytest.fixture
+def conn(tmp_path):
+    path = str(tmp_path / 'catalog_year.db')
+    seed_qbank(path)
+    assert dynamic_db_handler.migrate_database(path, 'qbank')[0]
+    dynamic_db_handler.close_pool(path)
+    conn = sqlite3.connect(path)
+    yield conn
+    conn.close()
+
+
+def catalog(conn):
+    return conn.execute('''
+        SELECT subject, chapter, topic, question_count, first_id, ordinal
+        FROM catalog_topics ORDER BY subject, chapter, topic
+    ''').fetchall()
+
+
+def rebuilt(conn):
+    """What a full rebuild from the current qbank rows gives"""
+    conn.execute('SAVEPOINT rebuild')
+    try:
+        build_topic_catalog(conn)
+        return catalog(conn)
+    finally:
+        conn.execute('ROLLBACK TO rebuild')
+        conn.execute('RELEASE rebuild')
+
+
+def insert(conn, subject, chapter, topic):
+    conn.execute('INSERT INTO qbank (subject, chapter, topic, question) VALUES (?, ?, ?, ?)',
+                 (subject, chapter, topic, 'q'))
+
+
+def test_seeded_catalog_matches_a_rebuild(conn):
+    assert catalog(conn) == rebuilt(conn)
+    assert ('Anatomy', 'Abdomen', 'Appendix', 3, 1, 1) in catalog(conn)
+
+
+@pytest.mark.parametrize('change', [
+    # new topic sorting before the existing ones: later ordinals move
+    lambda conn: insert(conn, 'Anatomy', 'Abdomen', 'Adrenal'),
+    lambda conn: insert(conn, 'Anatomy', None, 'Loose'),
+    lambda conn: insert(conn, 'Botany', 'Roots', 'Xylem'),
+    # rows without a subject or topic are not cataloged
+    lambda conn: insert(conn, None, 'Abdomen', 'Appendix'),
+    lambda conn: insert(conn, 'Anatomy', 'Abdomen', None),
+    # first_id moves when the first question goes
+    lambda conn: conn.execute("DELETE FROM qbank WHERE id = 1"),
+    # last question of a topic: the topic disappears and ordinals close up
+    lambda conn: conn.execute("DELETE FROM qbank WHERE topic = 'Appendix'"),
+    lambda conn: conn.execute("UPDATE qbank SET topic = 'Bladder' WHERE id = 4"),
+    lambda conn: conn.execute("UPDATE qbank SET chapter = 'Pelvis' WHERE topic = 'Kidney'"),
+    lambda conn: conn.execute("UPDATE qbank SET subject = 'Physiology' WHERE id = 2"),
+    lambda conn: conn.execute("UPDATE qbank SET subject = NULL WHERE id = 6"),
+    # content edits leave the catalog alone
+    lambda conn: conn.execute("UPDATE qbank SET answer = 'edited' WHERE id = 3"),
+])
+def test_triggers_match_a_full_rebuild(conn, change):
+    change(conn)
+    assert catalog(conn) == rebuilt(conn)
+
+
+def test_many_changes_in_a_row_match_a_full_rebuild(conn):
+    for i in range(20):
+        insert(conn, 'Anatomy', f'Chapter {i % 3}', f'Topic {i % 5}')
+    conn.execute("DELETE FROM qbank WHERE id % 3 = 0")
+    conn.execute("UPDATE qbank SET topic = 'Topic 9' WHERE id % 4 = 1")
+    assert catalog(conn) == rebuilt(conn)
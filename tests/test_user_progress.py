@@ -0,0 +1,46 @@
+# Incrementally maintained per-subject progress: user_progress (migrations.py, app.py)
+import sqlite3
+
+from conftest import flush_user_writes
+
+
+def complete(client, subject, topic):
+    assert client.post('/complete_topic', json={'subject': subject, 'topic': topic}).get_json() == {
+        'success': True}
+
+
+def admin_progress(appmod, user_id):
+    admin = appmod.app.test_client()
+    with admin.session_transaction() as session:
+        session['user_type'] = 'admin'
+    return {row['subject'].lower(): (row['completed_topics'], row['total_topics'])
+            for row in admin.get(f'/admin/user_progress/{user_id}').get_json()['progress']}
+
+
+def test_completions_count_each_topic_once(appmod, client, user):
+    user_id, _ = user
+    complete(client, 'Anatomy', 'Appendix')
+    complete(client, 'anatomy', 'Appendix')
+    complete(client, 'Anatomy', 'Kidney')
+    complete(client, 'Physiology', 'Filtration')
+    flush_user_writes(appmod)
+
+    assert admin_progress(appmod, user_id) == {'anatomy': (2, 2), 'physiology': (1, 1)}
+
+
+def test_removing_a_completion_counts_down(appmod, client, user):
+    user_id, _ = user
+    complete(client, 'Anatomy', 'Appendix')
+    complete(client, 'Anatomy', 'Kidney')
+    flush_user_writes(appmod)
+
+    conn = sqlite3.connect(appmod.user_shards.shard_file(user_id))
+    conn.execute("DELETE FROM user_topic_completion WHERE user_id = ? AND topic = 'Kidney'", (user_id,))
+    conn.commit()
+    conn.close()
+    assert admin_progress(appmod, user_id) == {'anatomy': (1, 2)}
+
+
+def test_progress_is_admin_only(client, user):
+    user_id, _ = user
+    assert client.get(f'/admin/user_progress/{user_id}').status_code == 403
@@ -0,0 +1,128 @@
+# Per-user shard routing and online resharding (user_shards.py)
+import os
+import sqlite3
+
+import pytest
+
+from dynamic_db_handler import dynamic_db_handler
+from user_shards import Resharder, UserShardRouter, layout_files, shard_index, shard_path
+
+USER_IDS = range(1, 21)
+
+
+@pytest.fixture
+def central(tmp_path):
+    """Pre-sharding central database holding every user's activity rows"""
+    path = str(tmp_path / 'admin_users.db')
+    conn = sqlite3.connect(path)
+    for create_sql in dynamic_db_handler.get_centralized_user_schema().values():
+        conn.execute(create_sql)
+    for user_id in USER_IDS:
+        conn.execute('INSERT INTO users (id, username, email, password) VALUES (?, ?, ?, ?)',
+                     (user_id, f'u{user_id}', f'u{user_id}@example.com', 'x'))
+        conn.execute('''INSERT INTO user_bookmarks (user_id, question_id, subject, topic, source_database)
+                        VALUES (?, 1, 'Anatomy', 'Appendix', '1st_year.db')''', (user_id,))
+        conn.execute('''INSERT INTO user_notes (user_id, question_id, note, source_database)
+                        VALUES (?, 1, ?, '1st_year.db')''', (user_id, f'note {user_id}'))
+        conn.execute('''INSERT INTO user_topic_completion (user_id, subject, topic, source_database)
+                        VALUES (?, 'Anatomy', 'Appendix', '1st_year.db')''', (user_id,))
+    conn.commit()
+    conn.close()
+    assert dynamic_db_handler.migrate_database(path, 'users')[0]
+    yield path
+    for count in (1, 2, 3):
+        for db_file in layout_files(path, count):
+            dynamic_db_handler.close_pool(db_file)
+
+
+def user_ids_in(db_file, table):
+    conn = sqlite3.connect(db_file)
+    try:
+        return {row[0] for row in conn.execute(f'SELECT user_id FROM {table}')}
+    finally:
+        conn.close()
+
+
+def test_shard_index_is_stable_and_one_shard_is_the_central_file():
+    assert [shard_index(user_id, 4) for user_id in (1, 2, 3)] == [shard_index(u, 4) for u in ('1', '2', '3')]
+    assert shard_path('/data/admin_users.db', 0, 1) == '/data/admin_users.db'
+    assert shard_path('/data/admin_users.db', 2, 3) == os.path.join('/data', 'user_shard_2_of_3.db')
+
+
+def test_existing_central_rows_keep_a_single_shard(central, monkeypatch):
+    monkeypatch.setenv('USER_DB_SHARDS', '3')
+    router = UserShardRouter(central, refresh_interval=0)
+    router.initialize()
+    assert router.shard_file(7) == central
+
+
+def test_reshard_moves_every_user_and_back(central):
+    success, message = Resharder(central, batch_size=7, grace_seconds=0).run(3)
+    assert success, message
+
+    router = UserShardRouter(central, refresh_interval=0)
+    router.initialize()
+    assert router.get_stats()['shard_count'] == 3
+    assert user_ids_in(central, 'user_bookmarks') == set()
+    for user_id in USER_IDS:
+        shard = router.shard_file(user_id)
+        assert shard == shard_path(central, shard_index(user_id, 3), 3)
+        for table in ('user_bookmarks', 'user_notes', 'user_topic_completion', 'user_progress'):
+            assert user_id in user_ids_in(shard, table)
+    moved = set().union(*(user_ids_in(f, 'user_notes') for f in layout_files(central, 3)))
+    assert moved == set(USER_IDS)
+
+    success, message = Resharder(central, grace_seconds=0).run(1)
+    assert success, message
+    assert user_ids_in(central, 'user_notes') == set(USER_IDS)
+    assert all(user_ids_in(f, 'user_notes') == set() for f in layout_files(central, 3))
+
+
+def test_legacy_user_migration_writes_activity_rows_to_their_shards(tmp_path, monkeypatch):
+    central = str(tmp_path / 'admin_users.db')
+    conn = sqlite3.connect(central)
+    for create_sql in dynamic_db_handler.get_centralized_user_schema().values():
+        conn.execute(create_sql)
+    conn.commit()
+    conn.close()
+    monkeypatch.setenv('USER_DB_SHARDS', '3')
+    router = UserShardRouter(central, refresh_interval=0)
+    router.initialize()
+
+    legacy = str(tmp_path / 'legacy_year.db')
+    conn = sqlite3.connect(legacy)
+    conn.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT, email TEXT, password TEXT, created_at TEXT)')
+    conn.execute('CREATE TABLE bookmarks (user_id INTEGER, question_id INTEGER, subject TEXT, topic TEXT, created_at TEXT)')
+    conn.execute('''CREATE TABLE user_notes (user_id INTEGER, question_id INTEGER, note TEXT,
+                                             created_at TEXT, updated_at TEXT)''')
+    for user_id in USER_IDS:
+        conn.execute("INSERT INTO users VALUES (?, ?, ?, 'x', '2024-01-01')",
+                     (user_id, f'u{user_id}', f'u{user_id}@example.com'))
+        conn.execute("INSERT INTO bookmarks VALUES (?, 1, 'Anatomy', 'Appendix', '2024-01-01')", (user_id,))
+        conn.execute("INSERT INTO user_notes VALUES (?, 1, 'n', '2024-01-01', '2024-01-01')", (user_id,))
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(type(dynamic_db_handler), 'discovered_databases',
+                        property(lambda self: {'qbank': [{'file': legacy}]}))
+    monkeypatch.setattr(dynamic_db_handler, 'refresh_databases', lambda: None)
+    try:
+        success, message = dynamic_db_handler.migrate_users_to_centralized_db(router)
+        assert success, message
+        conn = sqlite3.connect(central)
+        assert conn.execute('SELECT COUNT(*) FROM users').fetchone()[0] == len(USER_IDS)
+        conn.close()
+        assert user_ids_in(central, 'user_bookmarks') == set()
+        for user_id in USER_IDS:
+            shard = router.shard_file(user_id)
+            assert shard != central
+            assert user_id in user_ids_in(shard, 'user_bookmarks')
+            assert user_id in user_ids_in(shard, 'user_notes')
+    finally:
+        for db_file in [central, legacy] + layout_files(central, 3):
+            dynamic_db_handler.close_pool(db_file)
+
+
+def test_mcq_shares_the_app_shard_router(appmod):
+    import mcq
+    assert mcq.user_shards is appmod.user_shards
@@ -0,0 +1,114 @@
+# Bookmark/note/completion state: /save_note, /api/user_state/batch and the per-question loader (app.py)
+import re
+import sqlite3
+
+from conftest import flush_user_writes
+
+
+def user_rows(appmod, user_id, sql):
+    conn = sqlite3.connect(appmod.user_shards.shard_file(user_id))
+    try:
+        return conn.execute(sql, (user_id,)).fetchall()
+    finally:
+        conn.close()
+
+
+def save_note(client, note):
+    return client.post('/save_note', json={'question_id': 1, 'subject': 'Anatomy', 'note': note}).get_json()
+
+
+def test_save_note_then_clear_it(appmod, client, user):
+    user_id, _ = user
+    assert save_note(client, 'hello world') == {'success': True}
+    flush_user_writes(appmod)
+    assert user_rows(appmod, user_id, 'SELECT note FROM user_notes WHERE user_id = ?') == [('hello world',)]
+
+    assert save_note(client, '') == {'success': True}
+    flush_user_writes(appmod)
+    assert user_rows(appmod, user_id, 'SELECT note FROM user_notes WHERE user_id = ?') == []
+
+
+def test_answer_page_note_payload_saves_the_note(appmod, client, user):
+    page_url = '/subject/Anatomy/topic/Appendix/answer/1'
+    page = client.get(page_url).get_data(as_text=True)
+    body = re.search(r'function saveNote\(questionId\).*?JSON\.stringify\(\{(.*?)\}\)', page, re.S).group(1)
+    sent = dict(re.findall(r"(\w+): '?([^',\n]*)'?", body))
+    assert set(sent) == {'question_id', 'subject', 'note'}
+
+    payload = {'question_id': 1, 'subject': sent['subject'], 'note': 'umbilical pain first'}
+    assert client.post('/save_note', json=payload).get_json() == {'success': True}
+    flush_user_writes(appmod)
+    assert 'umbilical pain first</textarea>' in client.get(page_url).get_data(as_text=True)
+
+
+def test_batch_applies_each_operation_and_reports_failures(appmod, client, user):
+    user_id, _ = user
+    result = client.post('/api/user_state/batch', json={'operations': [
+        {'op': 'bookmark_on', 'question_id': 2, 'subject': 'Anatomy', 'topic': 'Appendix'},
+        {'op': 'note_upsert', 'question_id': 2, 'subject': 'Anatomy', 'note': ' kidney '},
+        {'op': 'bookmark_on', 'question_id': 3, 'subject': 'Anatomy'},
+        {'op': 'explode'},
+        {'op': 'topic_complete', 'subject': 'Anatomy', 'topic': 'Appendix'},
+    ]}).get_json()
+    assert [r['success'] for r in result['results']] == [True, True, False, False, True]
+    assert result['results'][2]['message'] == 'Missing topic'
+
+    assert user_rows(appmod, user_id, 'SELECT question_id FROM user_bookmarks WHERE user_id = ?') == [(2,)]
+    assert user_rows(appmod, user_id, 'SELECT note FROM user_notes WHERE user_id = ?') == [('kidney',)]
+    assert user_rows(appmod, user_id,
+                     'SELECT topic FROM user_topic_completion WHERE user_id = ?') == [('Appendix',)]
+
+
+def test_batch_note_without_text_deletes_the_note(appmod, client, user):
+    user_id, _ = user
+    ops = [{'op': 'note_upsert', 'question_id': 4, 'subject': 'Anatomy', 'note': 'x'},
+           {'op': 'note_upsert', 'question_id': 4, 'subject': 'Anatomy'}]
+    result = client.post('/api/user_state/batch', json={'operations': ops}).get_json()
+    assert [r['success'] for r in result['results']] == [True, True]
+    assert result['results'][1]['changed'] is True
+    assert user_rows(appmod, user_id, 'SELECT note FROM user_notes WHERE user_id = ?') == []
+
+
+def test_batch_requires_login(client):
+    response = client.post('/api/user_state/batch', json={'operations': [{'op': 'bookmark_on'}]})
+    assert response.status_code == 401
+
+
+def question_state(appmod, user_id, question_id=1, subject='Anatomy', topic='Appendix'):
+    with appmod.app.test_request_context():
+        return appmod.get_question_user_state(user_id, question_id, subject, topic)
+
+
+def seed_state(appmod, user_id, source_db, note):
+    conn = sqlite3.connect(appmod.user_shards.shard_file(user_id))
+    conn.execute('''INSERT INTO user_bookmarks (user_id, question_id, subject, topic, source_database)
+                    VALUES (?, 1, 'Anatomy', 'Appendix', ?)''', (user_id, source_db))
+    conn.execute('''INSERT INTO user_notes (user_id, question_id, note, source_database)
+                    VALUES (?, 1, ?, ?)''', (user_id, note, source_db))
+    conn.execute('''INSERT INTO user_topic_completion (user_id, subject, topic, source_database)
+                    VALUES (?, 'Anatomy', 'Appendix', ?)''', (user_id, source_db))
+    conn.commit()
+    conn.close()
+
+
+def test_question_state_is_scoped_to_the_source_database(appmod, user):
+    user_id, _ = user
+    # Same question id and topic in another year's database
+    seed_state(appmod, user_id, '2nd_year.db', 'other year')
+    empty = {'bookmarked': False, 'note': None, 'topic_completed': False}
+    assert question_state(appmod, user_id) == empty
+
+    seed_state(appmod, user_id, appmod.find_subject_database('Anatomy'), 'this year')
+    assert question_state(appmod, user_id) == {'bookmarked': True, 'note': 'this year', 'topic_completed': True}
+    assert question_state(appmod, user_id, question_id=2) == {'bookmarked': False, 'note': None,
+                                                              'topic_completed': True}
+    assert question_state(appmod, user_id, topic='Kidney')['topic_completed'] is False
+    assert question_state(appmod, None) == empty
+
+
+def test_question_state_is_loaded_once_per_request(appmod, user):
+    user_id, _ = user
+    with appmod.app.test_request_context():
+        first = appmod.get_question_user_state(user_id, 1, 'Anatomy', 'Appendix')
+        assert appmod.get_question_user_state(user_id, 1, 'anatomy', 'Appendix') is first
+        assert appmod.get_question_user_state(user_id, 2, 'Anatomy', 'Appendix') is not first
@@ -0,0 +1,94 @@
+# Coalescing background writer (write_behind.py)
+import sqlite3
+
+import pytest
+
+from dynamic_db_handler import dynamic_db_handler
+from write_behind import WriteBehindQueue
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    path = str(tmp_path / 'writes.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE kv (key TEXT PRIMARY KEY, value TEXT)')
+    conn.commit()
+    conn.close()
+    yield path
+    dynamic_db_handler.close_pool(path)
+
+
+@pytest.fixture
+def make_queue(db_file):
+    queues = []
+
+    def make(**options):
+        options.setdefault('flush_interval_ms', 60000)  # only explicit flushes write
+        queue = WriteBehindQueue(db_file, **options)
+        queues.append(queue)
+        return queue
+    yield make
+    for queue in queues:
+        queue.stop()
+
+
+def put(conn, key, value):
+    conn.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, value))
+
+
+def fail(conn, key, value):
+    raise ValueError('bad write')
+
+
+def stored(db_file):
+    conn = sqlite3.connect(db_file)
+    try:
+        return dict(conn.execute('SELECT key, value FROM kv'))
+    finally:
+        conn.close()
+
+
+def test_newer_write_replaces_the_pending_one(make_queue, db_file):
+    queue = make_queue()
+    for value in ('draft 1', 'draft 2', 'final'):
+        assert queue.submit('note', put, ('note', value))
+    assert queue.flush(timeout=5)
+
+    assert stored(db_file) == {'note': 'final'}
+    stats = queue.get_stats()
+    assert (stats['submitted'], stats['coalesced'], stats['written']) == (3, 2, 1)
+
+
+def test_one_bad_write_does_not_drop_the_batch(make_queue, db_file):
+    queue = make_queue()
+    queue.submit('a', put, ('a', '1'))
+    queue.submit('b', fail, ('b', '2'))
+    queue.submit('c', put, ('c', '3'))
+    assert queue.flush(timeout=5)
+
+    assert stored(db_file) == {'a': '1', 'c': '3'}
+    stats = queue.get_stats()
+    assert (stats['written'], stats['failed'], stats['batches']) == (2, 1, 1)
+
+
+def test_full_queue_hands_the_write_back(make_queue):
+    queue = make_queue(max_pending=1, submit_timeout=0.01)
+    assert queue.submit('a', put, ('a', '1'))
+    assert queue.submit('a', put, ('a', '2'))  # same key: coalesced, needs no room
+    assert not queue.submit('b', put, ('b', '1'))
+    assert queue.get_stats()['rejected'] == 1
+
+
+def test_wait_for_owner_sees_its_own_writes(make_queue, db_file):
+    queue = make_queue()
+    queue.submit('login:7', put, ('login:7', 'now'), owner=7)
+    assert queue.wait_for_owner(7, timeout=5)
+    assert stored(db_file) == {'login:7': 'now'}
+
+
+def test_stop_flushes_and_refuses_later_writes(make_queue, db_file):
+    queue = make_queue()
+    queue.submit('a', put, ('a', '1'))
+    queue.stop()
+    assert stored(db_file) == {'a': '1'}
+    assert not queue.submit('b', put, ('b', '1'))
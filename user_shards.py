@@ -0,0 +1,502 @@
+# user_shards.py - Per-user activity tables spread over shard files by user_id hash
+#
+# Usage:
+#   python user_shards.py status  [--central admin_users.db]
+#   python user_shards.py reshard --shards 4 [--central admin_users.db] [--batch 200]
+#
+# The users table (accounts, logins) always stays in the central admin_users.db.
+# Bookmarks, notes, topic completions, analytics and MCQ results of a user live in
+# shard crc32(user_id) % shard_count, so writers for different users mostly hit
+# different files and different SQLite write locks. With one shard that shard is the
+# central file itself, i.e. exactly the layout from before sharding.
+import argparse
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from flask import g, has_app_context
+
+from dynamic_db_handler import dynamic_db_handler
+from study_analytics import ANALYTICS_UPSERT
+from write_behind import WriteBehindQueue
+
+# Table -> how a copied row merges with a row the target shard already has.
+# user_progress is not copied: the completion triggers rebuild it in the target.
+ACTIVITY_TABLES = {
+    'user_bookmarks': 'ON CONFLICT (user_id, question_id, source_database) DO NOTHING',
+    'user_notes': '''
+        ON CONFLICT (user_id, question_id, source_database) DO UPDATE
+            SET note = excluded.note, updated_at = excluded.updated_at
+            WHERE excluded.updated_at > user_notes.updated_at
+    ''',
+    'user_topic_completion': 'ON CONFLICT (user_id, subject, topic, source_database) DO NOTHING',
+    'user_analytics': None,  # counters are added up, see ANALYTICS_UPSERT
+    'mcq_results': 'ON CONFLICT (user_id, test_id, completed_at) DO NOTHING',
+}
+
+USER_SHARD_SCHEMA = {
+    # Single row; target_shard_count is set while a reshard is running
+    'user_shard_layout': '''
+        CREATE TABLE IF NOT EXISTS user_shard_layout (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            shard_count INTEGER NOT NULL,
+            target_shard_count INTEGER,
+            cutover INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL
+        )
+    ''',
+    # Users already copied to the target layout during a reshard
+    'user_shard_moves': '''
+        CREATE TABLE IF NOT EXISTS user_shard_moves (
+            user_id INTEGER PRIMARY KEY
+        )
+    ''',
+}
+
+
+def shard_index(user_id, shard_count):
+    """Stable across processes and restarts (unlike hash())"""
+    return zlib.crc32(str(int(user_id)).encode()) % shard_count
+
+
+def shard_path(central_db_file, index, shard_count):
+    if shard_count == 1:
+        return central_db_file
+    return os.path.join(os.path.dirname(central_db_file),
+                        f'user_shard_{index}_of_{shard_count}.db')
+
+
+def layout_files(central_db_file, shard_count):
+    return [shard_path(central_db_file, i, shard_count) for i in range(shard_count)]
+
+
+def _has_activity_rows(conn):
+    return any(conn.execute(f'SELECT EXISTS (SELECT 1 FROM {table})').fetchone()[0]
+               for table in ACTIVITY_TABLES if dynamic_db_handler.table_exists(conn, table))
+
+
+def _same_file(a, b):
+    return os.path.abspath(a) == os.path.abspath(b)
+
+
+class UserShardRouter:
+    """Maps a user_id to the database file holding that user's activity rows.
+
+    The layout is read from the central file and re-checked at most once per refresh
+    interval. While a reshard runs, a user is routed to the new layout once the
+    resharding tool has copied them (user_shard_moves), or once it has cut over.
+    """
+
+    def __init__(self, central_db_file, refresh_interval=None):
+        self.central_db_file = central_db_file
+        if refresh_interval is None:
+            refresh_interval = float(os.environ.get('USER_SHARD_REFRESH', 2))
+        self.refresh_interval = refresh_interval
+        # (shard_count, target_shard_count, cutover), swapped in one assignment
+        self._layout = (1, None, False)
+        self.version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._queues_lock = threading.Lock()
+
+    def initialize(self):
+        """Create the layout tables (first run: USER_DB_SHARDS shards) and every shard file"""
+        configured = os.environ.get('USER_DB_SHARDS')
+        requested = max(1, int(configured or 1))
+        conn = dynamic_db_handler.get_connection(self.central_db_file, readonly=False)
+        try:
+            for create_sql in USER_SHARD_SCHEMA.values():
+                conn.execute(create_sql)
+            # Existing rows in the central file have to be moved by the resharding tool
+            initial = 1 if _has_activity_rows(conn) else requested
+            conn.execute('''
+                INSERT INTO user_shard_layout (id, shard_count, version) VALUES (1, ?, 1)
+                ON CONFLICT (id) DO NOTHING
+            ''', (initial,))
+            conn.commit()
+        finally:
+            conn.close()
+
+        self.refresh(force=True)
+        shard_count, target, _ = self._layout
+        if configured and shard_count != requested and target is None:
+            print(f"⚠️  USER_DB_SHARDS={requested} but the user data is laid out in {shard_count} "
+                  f"shard(s); run 'python user_shards.py reshard --shards {requested}'")
+        for db_file in self.active_files():
+            success, message = self.prepare_shard(db_file)
+            if not success:
+                print(f"❌ {message}")
+        print(f"✅ User activity data in {shard_count} shard(s)"
+              + (f", resharding to {target}" if target else ''))
+
+    def prepare_shard(self, db_file):
+        """Create a shard file with the activity tables, migrations and subject totals"""
+        if _same_file(db_file, self.central_db_file):
+            return True, f"{db_file} is the central database"
+        conn = sqlite3.connect(db_file)
+        try:
+            for create_sql in dynamic_db_handler.get_user_shard_schema().values():
+                conn.execute(create_sql)
+            conn.commit()
+        finally:
+            conn.close()
+        success, message = dynamic_db_handler.migrate_database(db_file, 'user_shards')
+        if success:
+            self._copy_topic_totals(db_file)
+        return success, message
+
+    def _copy_topic_totals(self, db_file):
+        # New progress rows in the shard take their total from subject_topic_totals
+        central = dynamic_db_handler.get_connection(self.central_db_file)
+        try:
+            try:
+                rows = [tuple(row) for row in central.execute(
+                    'SELECT subject, source_database, total_topics FROM subject_topic_totals')]
+            except sqlite3.OperationalError:
+                return
+        finally:
+            central.close()
+        conn = dynamic_db_handler.get_connection(db_file, readonly=False)
+        try:
+            conn.executemany('''
+                INSERT OR IGNORE INTO subject_topic_totals (subject, source_database, total_topics)
+                VALUES (?, ?, ?)
+            ''', rows)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def refresh(self, force=False):
+        """Reload the layout if its version moved; checked at most once per interval"""
+        if not force and time.monotonic() - self._checked_at < self.refresh_interval:
+            return
+        # One thread checks at a time; the others keep using the current layout
+        if not self._lock.acquire(blocking=force):
+            return
+        try:
+            self._checked_at = time.monotonic()
+            conn = dynamic_db_handler.get_connection(self.central_db_file)
+            try:
+                row = conn.execute('''
+                    SELECT shard_count, target_shard_count, cutover, version
+                    FROM user_shard_layout WHERE id = 1
+                ''').fetchone()
+            finally:
+                conn.close()
+            if row is not None and row['version'] != self.version:
+                self._layout = (row['shard_count'], row['target_shard_count'], bool(row['cutover']))
+                self.version = row['version']
+        except sqlite3.Error as e:
+            # Not initialized in this database yet: everything stays in the central file
+            if 'no such table' not in str(e):
+                print(f"Error refreshing user shard layout: {e}")
+        finally:
+            self._lock.release()
+
+    def _is_moved(self, user_id):
+        # Memoized per request: one lookup however many times a request routes the user
+        moved = g.setdefault('_user_shard_moves', {}) if has_app_context() else {}
+        if user_id not in moved:
+            conn = dynamic_db_handler.get_connection(self.central_db_file)
+            try:
+                moved[user_id] = conn.execute('SELECT 1 FROM user_shard_moves WHERE user_id = ?',
+                                              (user_id,)).fetchone() is not None
+            finally:
+                conn.close()
+        return moved[user_id]
+
+    def shard_file(self, user_id):
+        """Database file holding this user's activity rows"""
+        self.refresh()
+        shard_count, target, cutover = self._layout
+        user_id = int(user_id)
+        if target is not None and (cutover or self._is_moved(user_id)):
+            shard_count = target
+        return shard_path(self.central_db_file, shard_index(user_id, shard_count), shard_count)
+
+    def get_connection(self, user_id=None):
+        """Connection to the user's shard; without a user_id, to the central database"""
+        if user_id is None:
+            return dynamic_db_handler.get_connection(self.central_db_file)
+        return dynamic_db_handler.get_connection(self.shard_file(user_id))
+
+    def active_files(self):
+        """Every file that may hold activity rows right now (both layouts during a reshard)"""
+        self.refresh()
+        shard_count, target, _ = self._layout
+        files = layout_files(self.central_db_file, shard_count)
+        if target is not None:
+            files += [f for f in layout_files(self.central_db_file, target) if f not in files]
+        return files
+
+    def write_queue(self, user_id=None):
+        """Write-behind queue of the user's shard (the central database without a user_id)"""
+        db_file = self.central_db_file if user_id is None else self.shard_file(user_id)
+        key = os.path.abspath(db_file)
+        queue = self._queues.get(key)
+        if queue is None:
+            with self._queues_lock:
+                queue = self._queues.get(key)
+                if queue is None:
+                    queue = self._queues[key] = WriteBehindQueue(db_file)
+        return queue
+
+    def wait_for_owner(self, owner, timeout=2.0):
+        """Read-your-writes across every shard's queue"""
+        return all([queue.wait_for_owner(owner, timeout) for queue in list(self._queues.values())])
+
+    def get_stats(self):
+        shard_count, target, cutover = self._layout
+        return {
+            'shard_count': shard_count,
+            'target_shard_count': target,
+            'cutover': cutover,
+            'version': self.version,
+            'write_queues': {path: queue.get_stats() for path, queue in list(self._queues.items())},
+        }
+
+
+# --------------------
+# ONLINE RESHARDING
+# --------------------
+class Resharder:
+    """Moves every user's activity rows into a new shard layout while the app keeps serving.
+
+    1. Record the target layout; app workers pick it up within their refresh interval.
+    2. Sweep the old files in batches of users. Per batch the source file is write-locked,
+       rows are copied into the target shards, the users are recorded in user_shard_moves
+       (from then on the app routes them to the target) and deleted from the source.
+    3. Cut over: every user now routes to the target. A last sweep moves rows a worker
+       wrote to an old file just before it saw the move.
+    4. Make the target the layout and clear the moves.
+    """
+
+    def __init__(self, central_db_file, batch_size=200, grace_seconds=None):
+        self.central_db_file = central_db_file
+        self.batch_size = batch_size
+        if grace_seconds is None:
+            # Long enough for every worker to re-read the layout
+            grace_seconds = 2 * float(os.environ.get('USER_SHARD_REFRESH', 2)) + 1
+        self.grace_seconds = grace_seconds
+        self.router = UserShardRouter(central_db_file, refresh_interval=0)
+        self.stats = {'users_moved': 0, 'rows_copied': 0, 'batches': 0}
+
+    def _update_layout(self, assignments, params=()):
+        conn = dynamic_db_handler.get_connection(self.central_db_file, readonly=False)
+        try:
+            conn.execute(f'UPDATE user_shard_layout SET {assignments}, version = version + 1 '
+                         f'WHERE id = 1', params)
+            conn.commit()
+        finally:
+            conn.close()
+        self.router.refresh(force=True)
+
+    def run(self, new_count):
+        self.router.initialize()
+        shard_count, target, _ = self.router._layout
+        if target is not None and target != new_count:
+            return False, f"A reshard to {target} shards is already in progress; finish it first"
+        if target is None and shard_count == new_count:
+            return True, f"User data is already in {new_count} shard(s)"
+
+        old_count = shard_count
+        # Target files exist before any worker can route to them
+        for db_file in layout_files(self.central_db_file, new_count):
+            success, message = self.router.prepare_shard(db_file)
+            if not success:
+                return False, message
+        if target is None:
+            self._update_layout('target_shard_count = ?, cutover = 0', (new_count,))
+            print(f"🔀 Resharding {old_count} -> {new_count}; waiting {self.grace_seconds}s "
+                  f"for workers to see the new layout")
+            time.sleep(self.grace_seconds)
+        else:
+            print(f"🔀 Resuming reshard {old_count} -> {new_count}")
+
+        sources = self.source_files(old_count, new_count)
+        # Repeat until a pass finds nothing left behind by concurrent writers
+        for _ in range(3):
+            if not self.sweep(sources, new_count):
+                break
+
+        self._update_layout('cutover = 1')
+        print(f"🔀 Cut over to {new_count} shards; waiting {self.grace_seconds}s")
+        time.sleep(self.grace_seconds)
+        self.sweep(sources, new_count)
+
+        conn = dynamic_db_handler.get_connection(self.central_db_file, readonly=False)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('''
+                UPDATE user_shard_layout
+                SET shard_count = ?, target_shard_count = NULL, cutover = 0, version = version + 1
+                WHERE id = 1
+            ''', (new_count,))
+            conn.execute('DELETE FROM user_shard_moves')
+            conn.commit()
+        finally:
+            conn.close()
+        leftovers = [f for f in sources if not _same_file(f, self.central_db_file)]
+        message = (f"Resharded {old_count} -> {new_count}: {self.stats['users_moved']} users, "
+                   f"{self.stats['rows_copied']} rows in {self.stats['batches']} batches")
+        if leftovers:
+            message += f"; the emptied files can be deleted: {', '.join(leftovers)}"
+        return True, message
+
+    def source_files(self, old_count, new_count):
+        """Old layout's files plus the central file (legacy rows), minus the target's own files"""
+        targets = layout_files(self.central_db_file, new_count)
+        sources = layout_files(self.central_db_file, old_count) + [self.central_db_file]
+        unique = []
+        for db_file in sources:
+            if os.path.exists(db_file) and not any(_same_file(db_file, t) for t in targets + unique):
+                unique.append(db_file)
+        return unique
+
+    def sweep(self, sources, new_count):
+        """Move every user found in the source files; returns how many were moved"""
+        moved = 0
+        for source in sources:
+            conn = dynamic_db_handler.get_connection(source, readonly=False)
+            try:
+                tables = [t for t in ACTIVITY_TABLES if dynamic_db_handler.table_exists(conn, t)]
+                if not tables:
+                    continue
+                user_ids = [row[0] for row in conn.execute(
+                    ' UNION '.join(f'SELECT user_id FROM {t}' for t in tables))]
+            finally:
+                conn.close()
+            for start in range(0, len(user_ids), self.batch_size):
+                moved += self.move_users(source, tables, user_ids[start:start + self.batch_size],
+                                         new_count)
+            if user_ids:
+                print(f"  {source}: moved {len(user_ids)} users")
+        return moved
+
+    def move_users(self, source, tables, user_ids, new_count):
+        placeholders = ', '.join('?' * len(user_ids))
+        src = dynamic_db_handler.get_connection(source, readonly=False)
+        try:
+            # Holds the source's write lock: no app write for these users lands mid-move
+            src.execute('BEGIN IMMEDIATE')
+            by_target = {}
+            for table in tables:
+                rows = src.execute(f'SELECT * FROM {table} WHERE user_id IN ({placeholders})',
+                                   user_ids).fetchall()
+                for row in rows:
+                    target = shard_path(self.central_db_file,
+                                        shard_index(row['user_id'], new_count), new_count)
+                    by_target.setdefault(target, {}).setdefault(table, []).append(row)
+
+            central_is_target = any(_same_file(t, self.central_db_file) for t in by_target)
+            for target, table_rows in by_target.items():
+                self._copy_rows(target, table_rows,
+                                user_ids if _same_file(target, self.central_db_file) else None)
+            # Routed to the target from now on (same transaction as the delete if central is the source)
+            if _same_file(source, self.central_db_file):
+                self._record_moves(src, user_ids)
+            elif not central_is_target:
+                central = dynamic_db_handler.get_connection(self.central_db_file, readonly=False)
+                try:
+                    self._record_moves(central, user_ids)
+                    central.commit()
+                finally:
+                    central.close()
+
+            for table in tables:
+                src.execute(f'DELETE FROM {table} WHERE user_id IN ({placeholders})', user_ids)
+            if dynamic_db_handler.table_exists(src, 'user_progress'):
+                src.execute(f'DELETE FROM user_progress WHERE user_id IN ({placeholders})', user_ids)
+            src.commit()
+        except Exception:
+            if src.in_transaction:
+                src.rollback()
+            raise
+        finally:
+            src.close()
+        self.stats['users_moved'] += len(user_ids)
+        self.stats['batches'] += 1
+        return len(user_ids)
+
+    def _record_moves(self, conn, user_ids):
+        conn.executemany('INSERT OR IGNORE INTO user_shard_moves (user_id) VALUES (?)',
+                         [(user_id,) for user_id in user_ids])
+
+    def _copy_rows(self, target, table_rows, record_moves_for=None):
+        conn = dynamic_db_handler.get_connection(target, readonly=False)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for table, rows in table_rows.items():
+                if table == 'user_analytics':
+                    conn.executemany(ANALYTICS_UPSERT, [
+                        (row['user_id'], row['date'], row['questions_viewed'] or 0,
+                         row['answers_viewed'] or 0, row['topics_completed'] or 0,
+                         row['study_time_minutes'] or 0, row['databases_accessed'] or '[]')
+                        for row in rows])
+                else:
+                    # Fresh ids in the target; the natural keys decide conflicts
+                    columns = [c for c in rows[0].keys() if c != 'id']
+                    conn.executemany(
+                        f"INSERT INTO {table} ({', '.join(columns)}) "
+                        f"VALUES ({', '.join('?' * len(columns))}) {ACTIVITY_TABLES[table]}",
+                        [tuple(row[c] for c in columns) for row in rows])
+                self.stats['rows_copied'] += len(rows)
+            if record_moves_for:
+                self._record_moves(conn, record_moves_for)
+            conn.commit()
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+
+def print_status(central_db_file):
+    router = UserShardRouter(central_db_file)
+    router.initialize()
+    shard_count, target, cutover = router._layout
+    print(f"Layout v{router.version}: {shard_count} shard(s)"
+          + (f", resharding to {target}{' (cut over)' if cutover else ''}" if target else ''))
+    for db_file in router.active_files():
+        conn = dynamic_db_handler.get_connection(db_file)
+        try:
+            counts = {t: conn.execute(f'SELECT COUNT(*) FROM {t}').fetchone()[0]
+                      for t in ACTIVITY_TABLES if dynamic_db_handler.table_exists(conn, t)}
+        finally:
+            conn.close()
+        print(f"  {db_file}: " + ', '.join(f"{t}={n}" for t, n in counts.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='User activity shards')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name in ('status', 'reshard'):
+        sub = subparsers.add_parser(name)
+        sub.add_argument('--central', default=os.environ.get('USER_DB_FILE', 'admin_users.db'),
+                         help='central user database (default: admin_users.db)')
+        if name == 'reshard':
+            sub.add_argument('--shards', type=int, required=True)
+            sub.add_argument('--batch', type=int, default=200, help='users per move transaction')
+            sub.add_argument('--grace', type=float, default=None,
+                             help='seconds to wait for app workers to see a layout change')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.central):
+        raise SystemExit(f"❌ {args.central} not found")
+    if args.command == 'status':
+        print_status(args.central)
+        return
+    if args.shards < 1:
+        raise SystemExit("❌ --shards must be at least 1")
+    success, message = Resharder(args.central, args.batch, args.grace).run(args.shards)
+    print(f"{'✅' if success else '❌'} {message}")
+    if not success:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
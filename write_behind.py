@@ -0,0 +1,223 @@
+# write_behind.py - Background writer that coalesces low-value user-DB writes
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from dynamic_db_handler import dynamic_db_handler
+
+
+def _is_busy(error):
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+class WriteBehindQueue:
+    """Last-write-wins queue of idempotent writes, flushed in grouped transactions.
+
+    Writes are keyed; a newer write for a pending key replaces the older one.
+    A background thread commits up to max_batch writes per transaction every
+    flush_interval_ms, or sooner once max_batch writes are waiting. When
+    max_pending distinct keys are waiting, submit() blocks for up to
+    submit_timeout seconds and then returns False so the caller can write
+    synchronously instead.
+    """
+
+    def __init__(self, db_file, flush_interval_ms=None, max_batch=None, max_pending=None,
+                 submit_timeout=None):
+        self.db_file = db_file
+        if flush_interval_ms is None:
+            flush_interval_ms = float(os.environ.get('WRITE_BEHIND_FLUSH_MS', 200))
+        if max_batch is None:
+            max_batch = int(os.environ.get('WRITE_BEHIND_MAX_BATCH', 200))
+        if max_pending is None:
+            max_pending = int(os.environ.get('WRITE_BEHIND_MAX_PENDING', 5000))
+        if submit_timeout is None:
+            submit_timeout = float(os.environ.get('WRITE_BEHIND_SUBMIT_TIMEOUT', 0.5))
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        self._pending = OrderedDict()  # key -> (func, args, owner)
+        self._inflight = 0
+        self._owners = Counter()  # owner -> writes pending or in flight
+        self._flush_requested = False
+        self._stopping = False
+        self._thread = None
+        self._pid = None
+        self._cond = threading.Condition()
+        self.stats = {
+            'submitted': 0, 'coalesced': 0, 'rejected': 0, 'written': 0,
+            'failed': 0, 'batches': 0, 'retries': 0, 'max_batch_size': 0
+        }
+        # Guaranteed flush when the worker process exits normally
+        atexit.register(self.stop)
+
+    def _ensure_worker(self):
+        # Started lazily so forked server workers each get their own thread
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def submit(self, key, func, args=(), owner=None, timeout=None):
+        """Queue func(conn, *args) under key; False means the caller must write it now"""
+        if timeout is None:
+            timeout = self.submit_timeout
+        with self._cond:
+            if self._stopping:
+                return False
+            self._ensure_worker()
+            if key not in self._pending:
+                has_room = self._cond.wait_for(
+                    lambda: self._stopping or len(self._pending) < self.max_pending, timeout)
+                if not has_room or self._stopping:
+                    self.stats['rejected'] += 1
+                    return False
+            self.stats['submitted'] += 1
+            previous = self._pending.pop(key, None)
+            if previous is not None:
+                self.stats['coalesced'] += 1
+                self._owners[previous[2]] -= 1
+            self._pending[key] = (func, args, owner)
+            self._owners[owner] += 1
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._cond.notify_all()
+            return True
+
+    def wait_for_owner(self, owner, timeout=2.0):
+        """Block until every queued write for owner is committed (read-your-writes)"""
+        with self._cond:
+            if not self._owners.get(owner):
+                return True
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._owners.get(owner), timeout)
+
+    def flush(self, timeout=None):
+        """Write everything queued so far"""
+        with self._cond:
+            if not self._pending and not self._inflight:
+                return True
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._pending and not self._inflight, timeout)
+
+    def stop(self, timeout=10.0):
+        """Flush what is queued, then stop the worker; later submits return False"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats['pending'] = len(self._pending)
+            stats['inflight'] = self._inflight
+        stats['flush_interval_ms'] = self.flush_interval * 1000
+        stats['max_batch'] = self.max_batch
+        stats['max_pending'] = self.max_pending
+        return stats
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._pending and not self._stopping:
+                self._cond.wait()
+            deadline = time.monotonic() + self.flush_interval
+            while not (self._stopping or self._flush_requested
+                       or len(self._pending) >= self.max_batch):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = []
+            while self._pending and len(batch) < self.max_batch:
+                batch.append(self._pending.popitem(last=False))
+            self._inflight = len(batch)
+            if not self._pending:
+                self._flush_requested = False
+            # Writers blocked on a full queue can go ahead
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return  # stopping and drained
+            try:
+                written, failed = self._write_batch(batch)
+            except sqlite3.OperationalError as e:
+                if not _is_busy(e):
+                    print(f"❌ Write-behind batch of {len(batch)} dropped: {e}")
+                    self._finish(batch, 0, len(batch))
+                    continue
+                # Database busy/locked: put back whatever was not superseded and retry
+                print(f"⚠️ Write-behind batch of {len(batch)} deferred: {e}")
+                self._requeue(batch)
+                time.sleep(self.flush_interval)
+                continue
+            except Exception as e:
+                print(f"❌ Write-behind batch of {len(batch)} dropped: {e}")
+                written, failed = 0, len(batch)
+            self._finish(batch, written, failed)
+
+    def _write_batch(self, batch):
+        conn = dynamic_db_handler.get_connection(self.db_file, readonly=False)
+        written = failed = 0
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for key, (func, args, owner) in batch:
+                # One bad write must not take the rest of the batch with it
+                conn.execute('SAVEPOINT write_behind_item')
+                try:
+                    func(conn, *args)
+                    conn.execute('RELEASE write_behind_item')
+                    written += 1
+                except (sqlite3.Error, ValueError, TypeError, KeyError) as e:
+                    if isinstance(e, sqlite3.OperationalError) and _is_busy(e):
+                        raise
+                    conn.execute('ROLLBACK TO write_behind_item')
+                    conn.execute('RELEASE write_behind_item')
+                    print(f"❌ Write-behind write {key!r} failed: {e}")
+                    failed += 1
+            conn.commit()
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return written, failed
+
+    def _requeue(self, batch):
+        with self._cond:
+            self.stats['retries'] += 1
+            superseded = [item for item in batch if item[0] in self._pending]
+            for key, value in reversed(batch):
+                if key not in self._pending:
+                    self._pending[key] = value
+                    self._pending.move_to_end(key, last=False)
+            for key, (func, args, owner) in superseded:
+                self._owners[owner] -= 1
+            self._inflight = 0
+            self._cond.notify_all()
+
+    def _finish(self, batch, written, failed):
+        with self._cond:
+            for key, (func, args, owner) in batch:
+                self._owners[owner] -= 1
+                if self._owners[owner] <= 0:
+                    del self._owners[owner]
+            self._inflight = 0
+            self.stats['written'] += written
+            self.stats['failed'] += failed
+            self.stats['batches'] += 1
+            self.stats['max_batch_size'] = max(self.stats['max_batch_size'], len(batch))
+            self._cond.notify_all()